@@ -2,18 +2,47 @@ import smartpy as sp
 
 
 class Dex(sp.Contract):
+    # The delegate is re-elected at most once per epoch, about a cycle.
+    EPOCH = 4096 * 60
+
+    POOL = sp.TRecord(tezPool=sp.TMutez,
+                      tokenPool=sp.TNat,
+                      feeRate=sp.TNat,
+                      tokenAddress=sp.TAddress)
+
+    # What to do with the tokens Token.TransferAndCall sent along, packed
+    # in its data and unpacked by OnTokenTransfer.
+    ACTION = sp.TVariant(
+        TokenToTez=sp.TRecord(recipient=sp.TAddress,
+                              minTezOut=sp.TNat),
+        TokenToToken=sp.TRecord(recipient=sp.TAddress,
+                                minTokensOut=sp.TNat,
+                                tokenOutAddress=sp.TAddress),
+        InvestLiquidity=sp.TRecord(minShares=sp.TNat,
+                                   candidate=sp.TKeyHash))
+
     def __init__(self,
                  feeRate: sp.TNat,
                  tokenAddress: sp.TAddress,
                  factoryAddress: sp.TAddress,
                  delegated: sp.TKeyHash):
+        # The fields every swap reads and writes are grouped in pool.
+        self.init_type(sp.TRecord(
+            pool=self.POOL,
+            totalShares=sp.TNat,
+            shares=sp.TBigMap(sp.TAddress, sp.TNat),
+            exchanges=sp.TBigMap(sp.TAddress, sp.TAddress),
+            factoryAddress=sp.TAddress,
+            candidates=sp.TBigMap(sp.TAddress, sp.TKeyHash),
+            votes=sp.TBigMap(sp.TKeyHash, sp.TNat),
+            delegated=sp.TOption(sp.TKeyHash),
+            nextElection=sp.TTimestamp))
         self.init(
-            feeRate=sp.nat(feeRate),
-            tezPool=sp.mutez(0),
-            tokenPool=sp.nat(0),
-            invariant=sp.mutez(0),
+            pool=sp.record(tezPool=sp.mutez(0),
+                           tokenPool=sp.nat(0),
+                           feeRate=sp.nat(feeRate),
+                           tokenAddress=tokenAddress),
             totalShares=sp.nat(0),
-            tokenAddress=tokenAddress,
             factoryAddress=factoryAddress,
             # sp.TAddress, sp.TNat
             shares=sp.big_map(tkey=sp.TAddress, tvalue=sp.TNat),
@@ -21,83 +50,130 @@ class Dex(sp.Contract):
             candidates=sp.big_map(tkey=sp.TAddress, tvalue=sp.TKeyHash),
             # sp.TKeyHash, sp.TNat
             votes=sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat),
-            delegated=delegated,
-            address=tokenAddress
+            # token address, exchange address, as registered in the Factory
+            exchanges=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
+            # the baker the exchange delegates to, if any
+            delegated=sp.some(delegated),
+            # ElectDelegate may run again from this time on
+            nextElection=sp.timestamp(0)
         )
-        self.data.address = sp.to_address(sp.self)
+
+    # Every token transfer the exchange makes is built by this one global
+    # lambda.
+    @sp.global_lambda
+    def TokenTransfer(params):
+        token_contract = sp.contract(
+            sp.TRecord(account_from=sp.TAddress,
+                       destination=sp.TAddress,
+                       value=sp.TNat),
+            address=params.token,
+            entry_point="Transfer"
+        ).open_some()
+        sp.result(sp.transfer_operation(
+            sp.record(account_from=params.account_from,
+                      destination=params.destination,
+                      value=params.value),
+            sp.mutez(0),
+            token_contract))
+
+    def TransferTokensOperation(self, token, account_from, destination, value):
+        return self.TokenTransfer(sp.record(token=token,
+                                            account_from=account_from,
+                                            destination=destination,
+                                            value=value))
 
     @sp.entry_point
     def InitializeExchange(self, params):
         token_amount = sp.as_nat(params.token_amount)
         candidate = params.candidate
 
-        sp.verify(self.data.invariant == sp.mutez(0), message="Wrong invariant")
         sp.verify(self.data.totalShares == 0, message="Wrong totalShares")
         sp.verify(((sp.amount > sp.mutez(1)) & (
             sp.amount < sp.tez(500000000))), message="Wrong amount")
         sp.verify(token_amount > sp.nat(10), message="Wrong tokenAmount")
 
-        self.data.tokenPool = token_amount
-        self.data.tezPool = sp.amount
-        self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        self.data.pool.tokenPool = token_amount
+        self.data.pool.tezPool = sp.amount
         self.data.shares[sp.sender] = sp.nat(1000)
         self.data.totalShares = sp.nat(1000)
 
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-
-        sp.transfer(sp.record(account_from=sp.sender,
-                              destination=self.data.address,
-                              value=token_amount),
-                    sp.mutez(0),
-                    token_contract)
+        self.TransferTokens(sp.sender, sp.to_address(sp.self), token_amount)
 
         self.data.candidates[sp.sender] = candidate
         self.data.votes[candidate] = sp.as_nat(1000)
-        self.data.delegated = candidate
+        self.data.delegated = sp.some(candidate)
+        self.data.nextElection = sp.now.add_seconds(self.EPOCH)
 
         sp.set_delegate(sp.some(candidate))
 
+    def ReceiveTokens(self, buyer, tokensIn):
+        # buyer is None when the tokens are already here, sent by
+        # Token.TransferAndCall before OnTokenTransfer
+        if buyer is not None:
+            self.TransferTokens(buyer, sp.to_address(sp.self), tokensIn)
+
+    def TransferTokens(self,
+                       account_from: sp.TAddress,
+                       destination: sp.TAddress,
+                       value: sp.TNat):
+        sp.operations().push(self.TransferTokensOperation(
+            self.data.pool.tokenAddress, account_from, destination, value))
+
+    # Both swap directions share one fee-adjusted constant product step,
+    # compiled once into a global lambda that returns the updated pool. The
+    # product is derived from the pools:
+    # out = poolOut * inWithFee / (poolIn + inWithFee), rounded down.
+    @sp.global_lambda
+    def Swap(params):
+        sp.verify(params.amountIn > 0, message="Wrong amountIn")
+        sp.verify(params.minOut > 0, message="Wrong minOut")
+        pool = sp.local("pool", params.pool)
+        tezPool = sp.fst(sp.ediv(pool.value.tezPool, sp.mutez(1)).open_some())
+        inWithFee = abs(params.amountIn - params.amountIn / pool.value.feeRate)
+        out = sp.local("out", sp.nat(0))
+        sp.if params.tezToToken:
+            out.value = sp.fst(sp.ediv(inWithFee * pool.value.tokenPool,
+                                       tezPool + inWithFee).open_some())
+            pool.value.tezPool += sp.split_tokens(sp.mutez(1),
+                                                  params.amountIn, sp.nat(1))
+            pool.value.tokenPool = abs(pool.value.tokenPool - out.value)
+        sp.else:
+            out.value = sp.fst(sp.ediv(inWithFee * tezPool,
+                                       pool.value.tokenPool + inWithFee
+                                       ).open_some())
+            pool.value.tokenPool += params.amountIn
+            pool.value.tezPool -= sp.split_tokens(sp.mutez(1),
+                                                  out.value, sp.nat(1))
+        sp.verify(out.value >= params.minOut, message="Wrong minOut")
+        sp.result(sp.record(pool=pool.value, out=out.value))
+
+    def ToNat(self, amount: sp.TMutez) -> sp.TNat:
+        return sp.fst(sp.ediv(amount, sp.mutez(1)).open_some())
+
+    def ToMutez(self, amount: sp.TNat) -> sp.TMutez:
+        return sp.split_tokens(sp.mutez(1), amount, sp.nat(1))
+
+    def SwapPool(self, pool, tezToToken, amountIn, minOut):
+        return self.Swap(sp.record(pool=pool,
+                                   tezToToken=tezToToken,
+                                   amountIn=amountIn,
+                                   minOut=minOut))
+
+    def TezToTokenOut(self, pool, tezIn, minTokensOut):
+        return self.SwapPool(pool, True, self.ToNat(tezIn), minTokensOut).out
+
+    def TokenToTezOut(self, pool, tokensIn, minTezOut):
+        return self.ToMutez(
+            self.SwapPool(pool, False, tokensIn, minTezOut).out)
+
     def TezToToken(self,
                    recipient: sp.TAddress,
-                   tezIn: sp.TNat,
+                   tezIn: sp.TMutez,
                    minTokensOut: sp.TNat):
-        this = self.data.address
-
-        sp.verify(tezIn > sp.mutez(0), message="Wrong tezIn")
-        sp.verify(minTokensOut > 0, message="Wrong minTokensOut")
-
-        fee = sp.fst(sp.ediv(tezIn, self.data.feeRate).open_some())  # TODO: ????
-        newTezPool = sp.local("newTezPool", self.data.tezPool).value + tezIn
-        tempTezPool = abs(newTezPool - fee)
-        newTokenPool = sp.fst(sp.ediv(sp.local(
-            "newTokenPool", self.data.invariant).value, tempTezPool).open_some())
-        tokensOut = abs(
-            sp.local("tokensOut", self.data.tokenPool).value - newTokenPool)
-
-        sp.verify(tokensOut >= minTokensOut, message="Wrong minTokensOut")
-        sp.verify(tokensOut <= self.data.tokenPool, message="Wrong tokenPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.split_tokens(newTezPool, newTokenPool, sp.nat(1))
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-        sp.transfer(sp.record(account_from=this,
-                              destination=recipient,
-                              value=tokensOut),
-                    sp.mutez(0),
-                    token_contract)
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, True, self.ToNat(tezIn), minTokensOut)).value
+        self.data.pool = swapped.pool
+        self.TransferTokens(sp.to_address(sp.self), recipient, swapped.out)
 
     @sp.entry_point
     def TezToTokenPayment(self, params):
@@ -119,42 +195,11 @@ class Dex(sp.Contract):
                    recipient: sp.TAddress,
                    tokensIn: sp.TNat,
                    minTezOut: sp.TNat):
-        this = self.data.address
-
-        sp.verify(tokensIn > 0, message="Wrong tokensIn")
-        sp.verify(minTezOut > 0, message="Wrong minTezOut")
-
-        fee = tokensIn / self.data.feeRate  # TODO: ????
-        newTokenPool = sp.local(
-            "newTokenPool", self.data.tokenPool).value + tokensIn
-        tempTokenPool = abs(newTokenPool - fee)
-        newTezPool = sp.fst(sp.ediv(sp.local(
-            "newTezPool", self.data.invariant).value, tempTokenPool).open_some())
-        tezOut = abs(
-            sp.local("tezOut", self.data.tokenPool).value - newTezPool)
-
-        sp.verify(tezOut >= minTezOut, message="Wrong minTezOut")
-        sp.verify(sp.mutez(tezOut) <= self.data.tezPool, message="Wrong tezPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.mutez(newTezPool * newTokenPool)
-
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-
-
-        sp.transfer(sp.record(account_from=buyer,
-                              destination=this,
-                              value=tokensIn),
-                    sp.mutez(0),
-                    token_contract)
-        sp.send(recipient, sp.mutez(tezOut),)
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, False, tokensIn, minTezOut)).value
+        self.data.pool = swapped.pool
+        self.ReceiveTokens(buyer, tokensIn)
+        sp.send(recipient, self.ToMutez(swapped.out))
 
     @sp.entry_point
     def TokenToTezPayment(self, params):
@@ -175,57 +220,122 @@ class Dex(sp.Contract):
                         tokensIn=tokensIn,
                         minTezOut=minTezOut)
 
+    @sp.entry_point
+    def SwapBatch(self, params):
+        sp.set_type(params.swaps, sp.TList(sp.TRecord(tezToToken=sp.TBool,
+                                                      amount=sp.TNat,
+                                                      recipient=sp.TAddress,
+                                                      minOut=sp.TNat)))
+        pool = sp.local("pool", self.data.pool)
+        tezIn = sp.local("tezIn", sp.mutez(0))
+        tokensIn = sp.local("tokensIn", sp.nat(0))
+        # outputs are netted per recipient and paid out after the loop
+        tokensOut = sp.local("tokensOut", sp.map(tkey=sp.TAddress,
+                                                 tvalue=sp.TNat))
+        tezOut = sp.local("tezOut", sp.map(tkey=sp.TAddress,
+                                           tvalue=sp.TMutez))
+
+        sp.for swap in params.swaps:
+            swapped = sp.local("swapped", self.SwapPool(
+                pool.value, swap.tezToToken, swap.amount, swap.minOut)).value
+            pool.value = swapped.pool
+            sp.if swap.tezToToken:
+                tezIn.value += self.ToMutez(swap.amount)
+                tokensOut.value[swap.recipient] = tokensOut.value.get(
+                    swap.recipient, 0) + swapped.out
+            sp.else:
+                tokensIn.value += swap.amount
+                tezOut.value[swap.recipient] = tezOut.value.get(
+                    swap.recipient, sp.mutez(0)) + self.ToMutez(swapped.out)
+
+        sp.verify(tezIn.value == sp.amount, message="Wrong amount")
+        self.data.pool = pool.value
+
+        # tokens owed to the sender pay for its tokens in first
+        owed = sp.local("owed", tokensOut.value.get(sp.sender, 0)).value
+        sp.if owed > tokensIn.value:
+            tokensOut.value[sp.sender] = abs(owed - tokensIn.value)
+            tokensIn.value = 0
+        sp.else:
+            del tokensOut.value[sp.sender]
+            tokensIn.value = abs(tokensIn.value - owed)
+
+        sp.if tokensIn.value > 0:
+            self.TransferTokens(sp.sender, sp.to_address(sp.self), tokensIn.value)
+        sp.for payout in tokensOut.value.items():
+            self.TransferTokens(sp.to_address(sp.self), payout.key, payout.value)
+        sp.for payout in tezOut.value.items():
+            sp.send(payout.key, payout.value)
+
     def TokenToTokenOut(self,
                         buyer: sp.TAddress,
                         recipient: sp.TAddress,
                         tokensIn: sp.TNat,
                         minTokensOut: sp.TNat,
                         tokenOutAddress: sp.TAddress):
-        this = self.data.address
-        sp.verify(tokensIn > 0, message="Wrong tokensIn")
-        sp.verify(minTokensOut > 0, message="Wrong minTokensOut")
-
-        fee = tokensIn / self.data.feeRate  # TODO: ????
-        newTokenPool = sp.local(
-            "newTokenPool", self.data.tokenPool).value + tokensIn
-        tempTokenPool = abs(newTokenPool - fee)
-        newTezPool = sp.fst(sp.ediv(sp.local(
-            "newTezPool", self.data.invariant).value, tempTokenPool).open_some())
-        tezOut = abs(sp.local("tezOut", self.data.tezPool).value - newTezPool)
-
-        sp.verify(sp.mutez(tezOut) <= self.data.tezPool, message="Wrong tezPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.mutez(newTezPool * newTokenPool)
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
+        sp.verify(minTokensOut > 0, message="Wrong minOut")
+        # any positive amount of tez is enough, the second leg checks the
+        # tokens actually bought against minTokensOut
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, False, tokensIn, sp.nat(1))).value
+        self.data.pool = swapped.pool
+        tezOut = sp.local("tezOut", self.ToMutez(swapped.out)).value
+        self.ReceiveTokens(buyer, tokensIn)
+
+        # pay the target exchange directly once its address is cached,
+        # otherwise let the Factory look it up
+        sp.if self.data.exchanges.contains(tokenOutAddress):
+            exchange_contract = sp.contract(
+                sp.TRecord(recipient=sp.TAddress,
+                           minTokensOut=sp.TNat),
+                address=self.data.exchanges[tokenOutAddress],
+                entry_point="TezToTokenPayment"
+            ).open_some()
+            sp.transfer(sp.record(recipient=recipient,
+                                  minTokensOut=minTokensOut),
+                        tezOut,
+                        exchange_contract)
+        sp.else:
+            factory_contract = sp.contract(
+                sp.TRecord(tokenOutAddress=sp.TAddress,
+                           recipient=sp.TAddress,
+                           minTokensOut=sp.TNat),
+                address=self.data.factoryAddress,
+                entry_point="TokenToExchangeLookup"
+            ).open_some()
+            sp.transfer(sp.record(tokenOutAddress=tokenOutAddress,
+                                  recipient=recipient,
+                                  minTokensOut=minTokensOut),
+                        tezOut,
+                        factory_contract)
 
+    @sp.entry_point
+    def RegisterExchange(self, params):
+        token = params.token
         factory_contract = sp.contract(
-            sp.TRecord(tokenOutAddress=sp.TAddress,
-                       recipient=sp.TAddress,
-                       minTokensOut=sp.TNat),
+            sp.TRecord(token=sp.TAddress,
+                       contr=sp.TContract(sp.TRecord(token=sp.TAddress,
+                                                     exchange=sp.TAddress))),
             address=self.data.factoryAddress,
-            entry_point="TokenToExchangeLookup"
+            entry_point="GetExchange"
         ).open_some()
-
-        sp.transfer(sp.record(account_from=buyer,
-                              destination=this,
-                              value=tokensIn),
+        callback = sp.contract(
+            sp.TRecord(token=sp.TAddress,
+                       exchange=sp.TAddress),
+            address=sp.to_address(sp.self),
+            entry_point="CacheExchange"
+        ).open_some()
+        sp.transfer(sp.record(token=token,
+                              contr=callback),
                     sp.mutez(0),
-                    token_contract)
-
-        sp.transfer(sp.record(tokenOutAddress=tokenOutAddress,
-                              destination=recipient,
-                              value=minTokensOut),
-                    sp.mutez(tezOut),
                     factory_contract)
 
+    @sp.entry_point
+    def CacheExchange(self, params):
+        sp.verify(sp.sender == self.data.factoryAddress,
+                  message="Wrong sender")
+        self.data.exchanges[params.token] = params.exchange
+
     @sp.entry_point
     def TokenToTokenPayment(self, params):
         recipient = sp.local("recipient", params.recipient).value
@@ -258,65 +368,83 @@ class Dex(sp.Contract):
         recipient = sp.local("recipient", params.recipient).value
         minTokensOut = sp.local("minTokensOut", params.minTokensOut).value
         sp.verify(sp.sender == self.data.factoryAddress,
-                  message="Wrong minTezOut")
+                  message="Wrong sender")
         return self.TezToToken(recipient=recipient,
                                tezIn=sp.amount,
                                minTokensOut=minTokensOut)
 
-    @sp.entry_point
-    def InvestLiquidity(self, params):
-        minShares = params.minShares
-        candidate = params.candidate
-
+    def Invest(self,
+               investor: sp.TAddress,
+               minShares: sp.TNat,
+               candidate: sp.TKeyHash,
+               tokensIn=None):
         sp.verify(sp.amount > sp.mutez(0), message="Wrong amount")
         sp.verify(minShares > sp.nat(0), message="Wrong tokenAmount")
 
-        tezPerShare = sp.split_tokens(self.data.tezPool, sp.nat(1), self.data.totalShares)
-
-        sp.verify(sp.amount >= tezPerShare,
-                  message="Wrong tezPerShare")
-
-        sharesPurchased = sp.fst(sp.ediv(sp.amount, tezPerShare).open_some())
+        # shares at the pool price, tokens rounded up in favour of the pool
+        sharesPurchased = sp.local("sharesPurchased", sp.fst(sp.ediv(
+            sp.split_tokens(sp.amount, self.data.totalShares, sp.nat(1)),
+            self.data.pool.tezPool).open_some())).value
 
         sp.verify(sharesPurchased >= minShares,
                   message="Wrong sharesPurchased")
 
-        tokensPerShare = self.data.tokenPool / self.data.totalShares
-        tokensRequired = sharesPurchased * tokensPerShare
-        share = sp.local("share", self.data.shares.get(sp.sender, 0)).value
-        self.data.shares[sp.sender] = share + sharesPurchased
-        self.data.tezPool += sp.amount
-        self.data.tokenPool += tokensRequired
-        self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        tokensRequired = sp.local("tokensRequired", sp.as_nat(
+            sharesPurchased * self.data.pool.tokenPool +
+            self.data.totalShares - 1) / self.data.totalShares).value
+        share = sp.local("share", self.data.shares.get(investor, 0)).value
+        self.data.shares[investor] = share + sharesPurchased
+        self.data.pool.tezPool += sp.amount
+        self.data.pool.tokenPool += tokensRequired
         self.data.totalShares += sharesPurchased
-        sp.if self.data.candidates.contains(sp.sender):
-            prevVotes = self.data.votes.get(self.data.candidates[sp.sender], 0)
-            self.data.votes[self.data.candidates[sp.sender]] = abs(
-                prevVotes - share)
-
-        self.data.candidates[sp.sender] = candidate
-        prevVotes = self.data.votes.get(candidate, 0)
-        newVotes = prevVotes + share + sharesPurchased
-        self.data.votes[candidate] = newVotes
+        self.Vote(self.data, investor, candidate, share, sharesPurchased)
+
+        if tokensIn is None:
+            self.TransferTokens(investor, sp.to_address(sp.self),
+                                tokensRequired)
+        else:
+            # tokensIn were sent with the call, the change goes back
+            sp.verify(tokensRequired <= tokensIn,
+                      message="Wrong tokensRequired")
+            sp.if tokensIn > tokensRequired:
+                self.TransferTokens(sp.to_address(sp.self), investor,
+                                    abs(tokensIn - tokensRequired))
 
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-
-        sp.transfer(sp.record(account_from=sp.sender,
-                              destination=self.data.address,
-                              value=tokensRequired),
-                    sp.mutez(0),
-                    token_contract)
+    @sp.entry_point
+    def InvestLiquidity(self, params):
+        self.Invest(investor=sp.sender,
+                    minShares=params.minShares,
+                    candidate=params.candidate)
 
-        mainCandidateVotes = self.data.votes.get(self.data.delegated, 0)
-        sp.if mainCandidateVotes <= newVotes:
-            self.data.delegated = candidate
-            sp.set_delegate(sp.some(candidate))
+    # Token.TransferAndCall: the tokens were transferred to this contract in
+    # the same operation, data says what to do with them.
+    @sp.entry_point
+    def OnTokenTransfer(self, params):
+        sp.verify(sp.sender == self.data.pool.tokenAddress,
+                  message="Wrong sender")
+        action = sp.local("action", sp.unpack(
+            params.data, t=self.ACTION).open_some(message="Wrong data")).value
+        sp.if action.is_variant("TokenToTez"):
+            swap = action.open_variant("TokenToTez")
+            sp.verify(sp.amount == sp.mutez(0), message="Wrong amount")
+            self.TokenToTez(buyer=None,
+                            recipient=swap.recipient,
+                            tokensIn=params.value,
+                            minTezOut=swap.minTezOut)
+        sp.if action.is_variant("TokenToToken"):
+            swap = action.open_variant("TokenToToken")
+            sp.verify(sp.amount == sp.mutez(0), message="Wrong amount")
+            self.TokenToTokenOut(buyer=None,
+                                 recipient=swap.recipient,
+                                 tokensIn=params.value,
+                                 minTokensOut=swap.minTokensOut,
+                                 tokenOutAddress=swap.tokenOutAddress)
+        sp.if action.is_variant("InvestLiquidity"):
+            invest = action.open_variant("InvestLiquidity")
+            self.Invest(investor=params.account_from,
+                        minShares=invest.minShares,
+                        candidate=invest.candidate,
+                        tokensIn=params.value)
 
     @sp.entry_point
     def DivestLiquidity(self, params):
@@ -325,10 +453,13 @@ class Dex(sp.Contract):
         minTokens = params.minTokens
         sp.verify(sharesBurned > 0, message="Wrong sharesBurned")
         share = sp.local("share", self.data.shares.get(sp.sender, 0)).value
-        sp.verify(sharesBurned > share, message="Sender shares are too low")
-        self.data.shares[sp.sender] = abs(share - sharesBurned)
-        tezPerShare = sp.split_tokens(self.data.tezPool, sp.nat(1), self.data.totalShares)
-        tokensPerShare = sp.nat(self.data.tokenPool / self.data.totalShares)
+        sp.verify(sharesBurned <= share, message="Sender shares are too low")
+        sp.if share == sharesBurned:
+            del self.data.shares[sp.sender]
+        sp.else:
+            self.data.shares[sp.sender] = abs(share - sharesBurned)
+        tezPerShare = sp.split_tokens(self.data.pool.tezPool, sp.nat(1), self.data.totalShares)
+        tokensPerShare = sp.nat(self.data.pool.tokenPool / self.data.totalShares)
         tezDivested = sp.split_tokens(tezPerShare, sharesBurned, sp.nat(1))
         tokensDivested = tokensPerShare * sharesBurned
 
@@ -336,34 +467,106 @@ class Dex(sp.Contract):
         sp.verify(tokensDivested >= minTokens, message="Wrong minTokens")
 
         self.data.totalShares -= sharesBurned
-        self.data.tezPool -= tezDivested
-        self.data.tokenPool -= tokensDivested
-        sp.if self.data.totalShares == 0:
-            self.data.invariant = sp.mutez(0)
-        sp.else:
-            self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        self.data.pool.tezPool -= tezDivested
+        self.data.pool.tokenPool -= tokensDivested
 
         sp.if self.data.candidates.contains(sp.sender):
-            prevVotes = self.data.votes.get(self.data.candidates[sp.sender], 0)
-            self.data.votes[self.data.candidates[sp.sender]] = abs(
-                prevVotes - sharesBurned)
-
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
+            self.RemoveVotes(self.data, self.data.candidates[sp.sender],
+                             sharesBurned)
+            sp.if share == sharesBurned:
+                del self.data.candidates[sp.sender]
 
-        sp.transfer(sp.record(account_from=self.data.address,
-                              destination=sp.sender,
-                              value=tokensDivested),
-                    sp.mutez(0),
-                    token_contract)
+        self.TransferTokens(sp.to_address(sp.self), sp.sender, tokensDivested)
 
         sp.send(sp.sender, tezDivested)
 
+    # Liquidity operations only move votes; the delegate follows them in
+    # ElectDelegate, once per epoch.
+    def Vote(self,
+             data,
+             voter: sp.TAddress,
+             candidate: sp.TKeyHash,
+             share: sp.TNat,
+             sharesPurchased: sp.TNat):
+        sp.if data.candidates.get(voter, candidate) == candidate:
+            data.votes[candidate] = data.votes.get(
+                candidate, 0) + sharesPurchased
+            sp.if ~data.candidates.contains(voter):
+                data.candidates[voter] = candidate
+        sp.else:
+            self.RemoveVotes(data, data.candidates[voter], share)
+            data.votes[candidate] = data.votes.get(
+                candidate, 0) + share + sharesPurchased
+            data.candidates[voter] = candidate
+
+    def RemoveVotes(self, data, candidate: sp.TKeyHash, value: sp.TNat):
+        # candidates left without votes are deleted, not stored as 0
+        votes = sp.local("votes", data.votes.get(candidate, 0)).value
+        sp.if votes > value:
+            data.votes[candidate] = abs(votes - value)
+        sp.else:
+            del data.votes[candidate]
+
+    @sp.entry_point
+    def Cleanup(self, params):
+        # anyone may drop the entries of former holders and candidates
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        sp.set_type(params.candidates, sp.TList(sp.TKeyHash))
+        sp.for account in params.accounts:
+            sp.if self.data.shares.get(account, 0) == 0:
+                del self.data.shares[account]
+                del self.data.candidates[account]
+        sp.for candidate in params.candidates:
+            sp.if self.data.votes.get(candidate, 0) == 0:
+                del self.data.votes[candidate]
+
+    @sp.entry_point
+    def ElectDelegate(self, params):
+        self.Elect(self.data, params.candidate)
+
+    def Elect(self, data, candidate: sp.TKeyHash):
+        sp.verify(sp.now >= data.nextElection, message="Epoch not over")
+        # an undelegated exchange takes any candidate with votes
+        current = sp.local("current", sp.nat(0))
+        sp.if data.delegated.is_some():
+            current.value = data.votes.get(data.delegated.open_some(), 0)
+        sp.verify(data.votes.get(candidate, 0) > current.value,
+                  message="Not enough votes")
+        data.delegated = sp.some(candidate)
+        data.nextElection = sp.now.add_seconds(self.EPOCH)
+        sp.set_delegate(sp.some(candidate))
+
+    def SendReserves(self, tezPool, tokenPool, totalShares, feeRate, contr):
+        sp.transfer(sp.record(tezPool=tezPool,
+                              tokenPool=tokenPool,
+                              totalShares=totalShares,
+                              feeRate=feeRate),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetReserves(self, params):
+        self.SendReserves(self.data.pool.tezPool, self.data.pool.tokenPool,
+                          self.data.totalShares, self.data.pool.feeRate,
+                          params.contr)
+
+    # Quotes are the exact output of the swap; they fail where it would.
+    @sp.entry_point
+    def GetTezToTokenQuote(self, params):
+        tezIn = params.tezIn
+        contr = params.contr
+        sp.transfer(self.TezToTokenOut(self.data.pool, tezIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenToTezQuote(self, params):
+        tokensIn = params.tokensIn
+        contr = params.contr
+        sp.transfer(self.TokenToTezOut(self.data.pool, tokensIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
 # Tests
     @sp.add_test(name="QuipuSwap")
     def test():
@@ -390,3 +593,8 @@ class Dex(sp.Contract):
         exchange = Dex(500, fake_token.address,
                        fake_factory.address, admin.public_key_hash)
         scenario += exchange
+
+        scenario.h3("Only the token calls OnTokenTransfer")
+        scenario += exchange.OnTokenTransfer(account_from=alice.address,
+                                             value=10,
+                                             data=sp.bytes("0x")).run(sender=alice, valid=False)
@@ -1,10 +1,21 @@
 import smartpy as sp
 
+Dex = sp.import_script_from_url("file:contracts/Dex.py").Dex
+
 
 class Factory(sp.Contract):
-    def __init__(self):
+    def __init__(self, feeRate=500):
+        self.feeRate = feeRate
+        # Only the code of this Dex is used; LaunchExchange supplies the
+        # storage of every exchange it originates.
+        self.exchange = Dex(feeRate,
+                            sp.address("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"),
+                            sp.address("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"),
+                            sp.key_hash("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"))
         self.init(
-            tokenList=sp.list(t=sp.TAddress),
+            tokenCount=sp.nat(0),
+            # sp.TNat, sp.TAddress
+            tokenList=sp.big_map(tkey=sp.TNat, tvalue=sp.TAddress),
             tokenToExchange=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
             exchangeToToken=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress)
         )
@@ -12,27 +23,120 @@ class Factory(sp.Contract):
     @sp.entry_point
     def LaunchExchange(self, params):
         token = params.token
-        exchange = params.exchange
-        sp.verify(~(self.data.tokenToExchange.contains(token) |
-                    self.data.exchangeToToken.contains(exchange)),
+        tokenAmount = params.tokenAmount
+        candidate = params.candidate
+        sp.verify(~self.data.tokenToExchange.contains(token),
                   message="Exchange launched")
-        self.data.tokenList.push(token)
+
+        # With tez attached the new exchange starts with the sender's
+        # liquidity, as if InitializeExchange had been called on it.
+        seeded = sp.amount > sp.mutez(0)
+        sp.if seeded:
+            sp.verify(((sp.amount > sp.mutez(1)) & (
+                sp.amount < sp.tez(500000000))), message="Wrong amount")
+            sp.verify(tokenAmount > sp.nat(10), message="Wrong tokenAmount")
+        sp.else:
+            sp.verify(tokenAmount == 0, message="Wrong tokenAmount")
+        shares = sp.local("shares",
+                          sp.big_map(tkey=sp.TAddress, tvalue=sp.TNat))
+        candidates = sp.local("candidates",
+                              sp.big_map(tkey=sp.TAddress,
+                                         tvalue=sp.TKeyHash))
+        votes = sp.local("votes",
+                         sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat))
+        totalShares = sp.local("totalShares", sp.nat(0))
+        nextElection = sp.local("nextElection", sp.timestamp(0))
+        # Only a seeded exchange delegates from the start, to the candidate
+        # its first votes went to; an unseeded one stores no delegate until
+        # its InitializeExchange.
+        baker = sp.local("baker", sp.none, t=sp.TOption(sp.TKeyHash))
+        sp.if seeded:
+            shares.value[sp.sender] = sp.nat(1000)
+            candidates.value[sp.sender] = candidate
+            votes.value[candidate] = sp.nat(1000)
+            totalShares.value = sp.nat(1000)
+            nextElection.value = sp.now.add_seconds(Dex.EPOCH)
+            baker.value = sp.some(candidate)
+
+        exchange = sp.local("exchange", sp.create_contract(
+            contract=self.exchange,
+            storage=sp.record(
+                pool=sp.record(tezPool=sp.amount,
+                               tokenPool=tokenAmount,
+                               feeRate=sp.nat(self.feeRate),
+                               tokenAddress=token),
+                totalShares=totalShares.value,
+                shares=shares.value,
+                exchanges=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
+                factoryAddress=sp.to_address(sp.self),
+                candidates=candidates.value,
+                votes=votes.value,
+                delegated=baker.value,
+                nextElection=nextElection.value),
+            amount=sp.amount,
+            baker=baker.value)).value
+
+        # The sender approves the Factory on the token beforehand; the
+        # tokens go straight to the new exchange.
+        sp.if seeded:
+            token_contract = sp.contract(
+                sp.TRecord(account_from=sp.TAddress,
+                           destination=sp.TAddress,
+                           value=sp.TNat),
+                address=token,
+                entry_point="Transfer"
+            ).open_some()
+            sp.transfer(sp.record(account_from=sp.sender,
+                                  destination=exchange,
+                                  value=tokenAmount),
+                        sp.mutez(0),
+                        token_contract)
+
+        self.data.tokenList[self.data.tokenCount] = token
+        self.data.tokenCount += 1
         self.data.tokenToExchange[token] = exchange
         self.data.exchangeToToken[exchange] = token
 
     @sp.entry_point
     def TokenToExchangeLookup(self, params):
         tokenOutAddress = params.tokenOutAddress
-        recepient = params.recepient
+        recipient = params.recipient
         minTokensOut = params.minTokensOut
         exchange = sp.contract(sp.TRecord(recipient=sp.TAddress,
                                           minTokensOut=sp.TNat),
                                address=self.data.tokenToExchange[tokenOutAddress],
                                entry_point="TokenToTokenIn").open_some()
-        sp.transfer(sp.record(recipient=recepient,
+        sp.transfer(sp.record(recipient=recipient,
                               minTokensOut=minTokensOut),
                     sp.amount,
                     exchange)
+
+    @sp.entry_point
+    def GetExchange(self, params):
+        token = params.token
+        contr = params.contr
+        sp.set_type(contr, sp.TContract(sp.TRecord(token=sp.TAddress,
+                                                   exchange=sp.TAddress)))
+        sp.transfer(sp.record(token=token,
+                              exchange=self.data.tokenToExchange[token]),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenList(self, params):
+        offset = params.offset
+        limit = params.limit
+        contr = params.contr
+        sp.set_type(contr, sp.TContract(sp.TList(sp.TAddress)))
+        sp.verify(limit <= 100, message="Wrong limit")
+        tokens = sp.local("tokens", sp.list(t=sp.TAddress))
+        index = sp.local("index", offset + limit)
+        sp.if index.value > self.data.tokenCount:
+            index.value = self.data.tokenCount
+        sp.while index.value > offset:
+            index.value = sp.as_nat(index.value - 1)
+            tokens.value.push(self.data.tokenList[index.value])
+        sp.transfer(tokens.value, sp.tez(0), contr)
 # Tests
     @sp.add_test(name="QuipuSwap")
     def test():
@@ -54,16 +158,79 @@ class Factory(sp.Contract):
         scenario.show([admin, alice, bob, fake_token,
                        fake_factory, fake_exchange])
 
+        class Viewer(sp.Contract):
+            def __init__(self, t):
+                self.init(last=sp.none)
+                self.init_type(sp.TRecord(last=sp.TOption(t)))
+
+            @sp.entry_point
+            def target(self, params):
+                self.data.last = sp.some(params)
+
         # show its representation
         scenario.h2("Factory contract")
         factory = Factory()
         scenario += factory
 
-        scenario.h3("Launch Exchange with random addr")
+        scenario.h3("Launch Exchange without liquidity")
 
         scenario += factory.LaunchExchange(token=fake_token.address,
-                                           exchange=fake_exchange.address).run(sender=admin)
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
 
         scenario.h3("Launch another time")
         scenario += factory.LaunchExchange(token=fake_token.address,
-                                           exchange=fake_exchange.address).run(sender=admin, valid=False)
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin, valid=False)
+
+        scenario.h3("Tokens without tez")
+        scenario += factory.LaunchExchange(token=fake_exchange.address,
+                                           tokenAmount=1000,
+                                           candidate=admin.public_key_hash).run(sender=admin, valid=False)
+        scenario.verify(factory.data.tokenCount == 1)
+        scenario.verify(factory.data.tokenList[0] == fake_token.address)
+
+        scenario.h3("Launch Exchange with liquidity")
+        Token = sp.import_script_from_url("file:contracts/Token.py").Token
+        token = Token(admin.address, 1000)
+        scenario += token
+        scenario.p("Admin lets the Factory move 100 tokens into the new Dex")
+        scenario += token.Approve(spender=factory.address,
+                                  value=100).run(sender=admin)
+        scenario += factory.LaunchExchange(token=token.address,
+                                           tokenAmount=10,
+                                           candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10), valid=False)
+        scenario += factory.LaunchExchange(token=token.address,
+                                           tokenAmount=100,
+                                           candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario.verify(factory.data.tokenCount == 2)
+        scenario.verify(factory.data.tokenList[1] == token.address)
+        scenario.verify(token.data.ledger[admin.address] == 900)
+        scenario.verify(token.data.ledger[factory.data.tokenToExchange[token.address]] == 100)
+
+        scenario.h3("List tokens a page at a time")
+        scenario += factory.LaunchExchange(token=fake_exchange.address,
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
+        scenario += factory.LaunchExchange(token=fake_factory.address,
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
+        scenario.verify(factory.data.tokenCount == 4)
+        tokens = Viewer(sp.TList(sp.TAddress))
+        scenario += tokens
+        scenario += factory.GetTokenList(offset=0, limit=3,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify_equal(tokens.data.last,
+                              sp.some([fake_token.address, token.address,
+                                       fake_exchange.address]))
+        scenario.p("The last page is cut at tokenCount")
+        scenario += factory.GetTokenList(offset=3, limit=3,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify_equal(tokens.data.last, sp.some([fake_factory.address]))
+        scenario.p("A page past the end is empty")
+        scenario += factory.GetTokenList(offset=10, limit=100,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify(sp.len(tokens.data.last.open_some()) == 0)
+        scenario.p("Pages hold at most 100 tokens")
+        scenario += factory.GetTokenList(offset=0, limit=101,
+                                         contr=tokens.typed).run(sender=alice, valid=False)
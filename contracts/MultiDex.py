@@ -0,0 +1,406 @@
+import smartpy as sp
+
+Dex = sp.import_script_from_url("file:contracts/Dex.py").Dex
+
+
+class MultiDex(sp.Contract):
+    # The swap math, token transfers, the share-weighted votes and the
+    # delegate election are those of Dex, compiled into this contract. A
+    # provider votes once per pool, keyed by (token address, owner).
+    EPOCH = Dex.EPOCH
+    Swap = Dex.Swap
+    TokenTransfer = Dex.TokenTransfer
+    TransferTokensOperation = Dex.TransferTokensOperation
+    ToNat = Dex.ToNat
+    ToMutez = Dex.ToMutez
+    TezToTokenOut = Dex.TezToTokenOut
+    TokenToTezOut = Dex.TokenToTezOut
+    Vote = Dex.Vote
+    RemoveVotes = Dex.RemoveVotes
+    Elect = Dex.Elect
+    SendReserves = Dex.SendReserves
+
+    def __init__(self,
+                 feeRate: sp.TNat,
+                 delegated: sp.TKeyHash):
+        # One contract holds the pools of every token, keyed by the token
+        # address, so token-to-token swaps settle without leaving it.
+        self.init_type(sp.TRecord(
+            pools=sp.TBigMap(sp.TAddress,
+                             sp.TRecord(tezPool=sp.TMutez,
+                                        tokenPool=sp.TNat,
+                                        totalShares=sp.TNat).layout(
+                                 ("tezPool", ("tokenPool", "totalShares")))),
+            feeRate=sp.TNat,
+            shares=sp.TBigMap(sp.TPair(sp.TAddress, sp.TAddress), sp.TNat),
+            candidates=sp.TBigMap(sp.TPair(sp.TAddress, sp.TAddress),
+                                  sp.TKeyHash),
+            votes=sp.TBigMap(sp.TKeyHash, sp.TNat),
+            delegated=sp.TOption(sp.TKeyHash),
+            nextElection=sp.TTimestamp).layout(
+                ("pools", ("feeRate", ("shares",
+                                       (("candidates", "votes"),
+                                        ("delegated", "nextElection")))))))
+        self.init(
+            # token address, pool
+            pools=sp.big_map(tkey=sp.TAddress),
+            feeRate=sp.nat(feeRate),
+            # (token address, owner), sp.TNat
+            shares=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                              tvalue=sp.TNat),
+            # (token address, owner), sp.TKeyHash
+            candidates=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                  tvalue=sp.TKeyHash),
+            # sp.TKeyHash, sp.TNat
+            votes=sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat),
+            delegated=sp.some(delegated),
+            # ElectDelegate may run again from this time on
+            nextElection=sp.timestamp(0)
+        )
+
+    @sp.entry_point
+    def InitializeExchange(self, params):
+        token = params.token
+        token_amount = sp.as_nat(params.token_amount)
+        candidate = params.candidate
+
+        sp.verify(self.data.pools.get(
+            token, sp.record(tezPool=sp.mutez(0),
+                             tokenPool=sp.nat(0),
+                             totalShares=sp.nat(0))).totalShares == 0,
+            message="Wrong totalShares")
+        sp.verify(((sp.amount > sp.mutez(1)) & (
+            sp.amount < sp.tez(500000000))), message="Wrong amount")
+        sp.verify(token_amount > sp.nat(10), message="Wrong tokenAmount")
+
+        self.data.pools[token] = sp.record(tezPool=sp.amount,
+                                           tokenPool=token_amount,
+                                           totalShares=sp.nat(1000))
+        self.data.shares[sp.pair(token, sp.sender)] = sp.nat(1000)
+
+        self.TransferTokens(token, sp.sender, sp.to_address(sp.self),
+                            token_amount)
+
+        self.Vote(self.data, sp.pair(token, sp.sender), candidate, 0, 1000)
+
+    def TransferTokens(self,
+                       token: sp.TAddress,
+                       account_from: sp.TAddress,
+                       destination: sp.TAddress,
+                       value: sp.TNat):
+        sp.operations().push(self.TransferTokensOperation(
+            token, account_from, destination, value))
+
+    def Pool(self, name, token):
+        sp.verify(self.data.pools.contains(token), message="Wrong token")
+        return sp.local(name, self.data.pools[token])
+
+    def SwapPool(self, pool, tezToToken, amountIn, minOut):
+        # Dex.Swap on the reserves of one pool, with the fee of all of them
+        return self.Swap(sp.record(pool=sp.record(tezPool=pool.tezPool,
+                                                  tokenPool=pool.tokenPool,
+                                                  feeRate=self.data.feeRate),
+                                   tezToToken=tezToToken,
+                                   amountIn=amountIn,
+                                   minOut=minOut))
+
+    def Swapped(self, pool, tezToToken, amountIn, minOut, name="swapped"):
+        """Swap on ``pool`` in place; the amount bought."""
+        swapped = sp.local(name, self.SwapPool(
+            pool.value, tezToToken, amountIn, minOut)).value
+        pool.value.tezPool = swapped.pool.tezPool
+        pool.value.tokenPool = swapped.pool.tokenPool
+        return swapped.out
+
+    def TezToToken(self,
+                   token: sp.TAddress,
+                   recipient: sp.TAddress,
+                   tezIn: sp.TMutez,
+                   minTokensOut: sp.TNat):
+        pool = self.Pool("pool", token)
+        tokensOut = self.Swapped(pool, True, self.ToNat(tezIn), minTokensOut)
+        self.data.pools[token] = pool.value
+        self.TransferTokens(token, sp.to_address(sp.self), recipient,
+                            tokensOut)
+
+    @sp.entry_point
+    def TezToTokenPayment(self, params):
+        self.TezToToken(token=params.token,
+                        recipient=params.recipient,
+                        tezIn=sp.amount,
+                        minTokensOut=params.minTokensOut)
+
+    @sp.entry_point
+    def TezToTokenSwap(self, params):
+        self.TezToToken(token=params.token,
+                        recipient=sp.sender,
+                        tezIn=sp.amount,
+                        minTokensOut=params.minTokensOut)
+
+    def TokenToTez(self,
+                   token: sp.TAddress,
+                   buyer: sp.TAddress,
+                   recipient: sp.TAddress,
+                   tokensIn: sp.TNat,
+                   minTezOut: sp.TNat):
+        pool = self.Pool("pool", token)
+        tezOut = self.ToMutez(self.Swapped(pool, False, tokensIn, minTezOut))
+        self.data.pools[token] = pool.value
+        self.TransferTokens(token, buyer, sp.to_address(sp.self), tokensIn)
+        sp.send(recipient, tezOut)
+
+    @sp.entry_point
+    def TokenToTezPayment(self, params):
+        self.TokenToTez(token=params.token,
+                        buyer=sp.sender,
+                        recipient=params.recipient,
+                        tokensIn=params.tokensIn,
+                        minTezOut=params.minTezOut)
+
+    @sp.entry_point
+    def TokenToTezSwap(self, params):
+        self.TokenToTez(token=params.token,
+                        buyer=sp.sender,
+                        recipient=sp.sender,
+                        tokensIn=params.tokensIn,
+                        minTezOut=params.minTezOut)
+
+    def TokenToTokenOut(self,
+                        token: sp.TAddress,
+                        buyer: sp.TAddress,
+                        recipient: sp.TAddress,
+                        tokensIn: sp.TNat,
+                        minTokensOut: sp.TNat,
+                        tokenOutAddress: sp.TAddress):
+        sp.verify(minTokensOut > 0, message="Wrong minOut")
+        sp.verify(token != tokenOutAddress, message="Wrong tokenOutAddress")
+        # The tez bought on the first pool are sold on the second one in
+        # the same call: only the tokens move between contracts.
+        poolIn = self.Pool("poolIn", token)
+        mutezOut = self.Swapped(poolIn, False, tokensIn, sp.nat(1),
+                                name="swappedIn")
+        self.data.pools[token] = poolIn.value
+
+        poolOut = self.Pool("poolOut", tokenOutAddress)
+        tokensOut = self.Swapped(poolOut, True, mutezOut, minTokensOut,
+                                 name="swappedOut")
+        self.data.pools[tokenOutAddress] = poolOut.value
+
+        self.TransferTokens(token, buyer, sp.to_address(sp.self), tokensIn)
+        self.TransferTokens(tokenOutAddress, sp.to_address(sp.self),
+                            recipient, tokensOut)
+
+    @sp.entry_point
+    def TokenToTokenPayment(self, params):
+        self.TokenToTokenOut(
+            token=params.token,
+            buyer=sp.sender,
+            recipient=params.recipient,
+            tokensIn=params.tokensIn,
+            minTokensOut=params.minTokensOut,
+            tokenOutAddress=params.tokenOutAddress)
+
+    @sp.entry_point
+    def TokenToTokenSwap(self, params):
+        self.TokenToTokenOut(
+            token=params.token,
+            buyer=sp.sender,
+            recipient=sp.sender,
+            tokensIn=params.tokensIn,
+            minTokensOut=params.minTokensOut,
+            tokenOutAddress=params.tokenOutAddress)
+
+    @sp.entry_point
+    def InvestLiquidity(self, params):
+        token = params.token
+        minShares = params.minShares
+        candidate = params.candidate
+
+        sp.verify(sp.amount > sp.mutez(0), message="Wrong amount")
+        sp.verify(minShares > sp.nat(0), message="Wrong tokenAmount")
+
+        pool = self.Pool("pool", token)
+        # shares at the pool price, tokens rounded up in favour of the pool
+        sharesPurchased = sp.local("sharesPurchased", sp.fst(sp.ediv(
+            sp.split_tokens(sp.amount, pool.value.totalShares, sp.nat(1)),
+            pool.value.tezPool).open_some())).value
+
+        sp.verify(sharesPurchased >= minShares,
+                  message="Wrong sharesPurchased")
+
+        tokensRequired = sp.local("tokensRequired", sp.as_nat(
+            sharesPurchased * pool.value.tokenPool +
+            pool.value.totalShares - 1) / pool.value.totalShares).value
+        key = sp.pair(token, sp.sender)
+        share = sp.local("share", self.data.shares.get(key, 0)).value
+        self.data.shares[key] = share + sharesPurchased
+        pool.value.tezPool += sp.amount
+        pool.value.tokenPool += tokensRequired
+        pool.value.totalShares += sharesPurchased
+        self.data.pools[token] = pool.value
+        self.Vote(self.data, key, candidate, share, sharesPurchased)
+
+        self.TransferTokens(token, sp.sender, sp.to_address(sp.self),
+                            tokensRequired)
+
+    @sp.entry_point
+    def DivestLiquidity(self, params):
+        token = params.token
+        sharesBurned = params.sharesBurned
+        minTez = params.minTez
+        minTokens = params.minTokens
+        sp.verify(sharesBurned > 0, message="Wrong sharesBurned")
+        key = sp.pair(token, sp.sender)
+        share = sp.local("share", self.data.shares.get(key, 0)).value
+        sp.verify(sharesBurned <= share, message="Sender shares are too low")
+        sp.if share == sharesBurned:
+            del self.data.shares[key]
+        sp.else:
+            self.data.shares[key] = abs(share - sharesBurned)
+        pool = self.Pool("pool", token)
+        tezPerShare = sp.split_tokens(pool.value.tezPool, sp.nat(1),
+                                      pool.value.totalShares)
+        tokensPerShare = sp.nat(pool.value.tokenPool /
+                                pool.value.totalShares)
+        tezDivested = sp.split_tokens(tezPerShare, sharesBurned, sp.nat(1))
+        tokensDivested = tokensPerShare * sharesBurned
+
+        sp.verify(tezDivested >= minTez, message="Wrong minTez")
+        sp.verify(tokensDivested >= minTokens, message="Wrong minTokens")
+
+        pool.value.totalShares = abs(pool.value.totalShares - sharesBurned)
+        pool.value.tezPool -= tezDivested
+        pool.value.tokenPool = abs(pool.value.tokenPool - tokensDivested)
+        self.data.pools[token] = pool.value
+
+        sp.if self.data.candidates.contains(key):
+            self.RemoveVotes(self.data, self.data.candidates[key],
+                             sharesBurned)
+            sp.if share == sharesBurned:
+                del self.data.candidates[key]
+
+        self.TransferTokens(token, sp.to_address(sp.self), sp.sender,
+                            tokensDivested)
+
+        sp.send(sp.sender, tezDivested)
+
+    @sp.entry_point
+    def ElectDelegate(self, params):
+        self.Elect(self.data, params.candidate)
+
+    @sp.entry_point
+    def GetReserves(self, params):
+        pool = self.Pool("pool", params.token)
+        self.SendReserves(pool.value.tezPool, pool.value.tokenPool,
+                          pool.value.totalShares, self.data.feeRate,
+                          params.contr)
+
+    # Quotes are the exact output of the swap; they fail where it would.
+    @sp.entry_point
+    def GetTezToTokenQuote(self, params):
+        token = params.token
+        tezIn = params.tezIn
+        contr = params.contr
+        pool = self.Pool("pool", token)
+        sp.transfer(self.TezToTokenOut(pool.value, tezIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenToTezQuote(self, params):
+        token = params.token
+        tokensIn = params.tokensIn
+        contr = params.contr
+        pool = self.Pool("pool", token)
+        sp.transfer(self.TokenToTezOut(pool.value, tokensIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+# Tests
+    @sp.add_test(name="MultiDex")
+    def test():
+        scenario = sp.test_scenario()
+        scenario.table_of_contents()
+
+        admin = sp.test_account("Admin")
+        alice = sp.test_account("Alice")
+        fake_token = sp.test_account("Token")
+
+        scenario.h2("MultiDex contract")
+        exchange = MultiDex(500, admin.public_key_hash)
+        scenario += exchange
+
+        scenario.h3("No pool for the token yet")
+        scenario += exchange.TezToTokenSwap(token=fake_token.address,
+                                            minTokensOut=1).run(sender=alice, amount=sp.tez(1), valid=False)
+        scenario += exchange.DivestLiquidity(token=fake_token.address,
+                                             sharesBurned=1, minTez=sp.mutez(1),
+                                             minTokens=1).run(sender=alice, valid=False)
+
+        scenario.h3("Too few tokens to initialize")
+        scenario += exchange.InitializeExchange(token=fake_token.address,
+                                                token_amount=10,
+                                                candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(1), valid=False)
+
+        Token = sp.import_script_from_url("file:contracts/Token.py").Token
+        token_a = Token(admin.address, 10000)
+        scenario += token_a
+        token_b = Token(admin.address, 10000)
+        scenario += token_b
+
+        scenario.h3("One pool per token")
+        scenario += token_a.Approve(spender=exchange.address,
+                                    value=10000).run(sender=admin)
+        scenario += token_b.Approve(spender=exchange.address,
+                                    value=10000).run(sender=admin)
+        scenario += exchange.InitializeExchange(token=token_a.address,
+                                                token_amount=1000,
+                                                candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += exchange.InitializeExchange(token=token_b.address,
+                                                token_amount=1000,
+                                                candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += exchange.InitializeExchange(token=token_b.address,
+                                                token_amount=1000,
+                                                candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10), valid=False)
+        scenario.verify(token_a.data.ledger[exchange.address] == 1000)
+        scenario.p("Votes are weighted by shares, 1000 for each new pool")
+        scenario.verify(exchange.data.votes[admin.public_key_hash] == 2000)
+
+        scenario.h3("Token to token inside the contract")
+        scenario += exchange.TokenToTokenSwap(token=token_a.address,
+                                              tokenOutAddress=token_b.address,
+                                              tokensIn=100,
+                                              minTokensOut=1).run(sender=admin)
+        scenario.verify(exchange.data.pools[token_a.address].tokenPool == 1100)
+        scenario.p("The tez sold by one pool were bought by the other")
+        scenario.verify(exchange.data.pools[token_a.address].tezPool +
+                        exchange.data.pools[token_b.address].tezPool == sp.tez(20))
+        scenario += exchange.TokenToTokenSwap(token=token_a.address,
+                                              tokenOutAddress=token_a.address,
+                                              tokensIn=100,
+                                              minTokensOut=1).run(sender=admin, valid=False)
+
+        scenario.h3("Liquidity")
+        scenario += exchange.InvestLiquidity(token=token_a.address,
+                                             minShares=1,
+                                             candidate=alice.public_key_hash).run(sender=admin, amount=sp.tez(1))
+        scenario.verify(exchange.data.shares[sp.pair(token_a.address, admin.address)] == 1109)
+        scenario.verify(exchange.data.candidates[sp.pair(token_a.address, admin.address)] ==
+                        alice.public_key_hash)
+        scenario.p("The vote for pool a moves with its shares; pool b still votes for Admin")
+        scenario.verify(exchange.data.votes[admin.public_key_hash] == 1000)
+        scenario.verify(exchange.data.votes[alice.public_key_hash] == 1109)
+        scenario += exchange.DivestLiquidity(token=token_b.address,
+                                             sharesBurned=1000, minTez=sp.mutez(1),
+                                             minTokens=1).run(sender=admin)
+        scenario.verify(~exchange.data.shares.contains(sp.pair(token_b.address, admin.address)))
+        scenario.verify(exchange.data.pools[token_b.address].totalShares == 0)
+        scenario.verify(~exchange.data.candidates.contains(sp.pair(token_b.address, admin.address)))
+        scenario.verify(~exchange.data.votes.contains(admin.public_key_hash))
+        scenario.verify(exchange.data.votes[alice.public_key_hash] == 1109)
+
+        scenario.h3("Delegate election")
+        scenario += exchange.ElectDelegate(candidate=admin.public_key_hash).run(sender=admin, now=sp.timestamp(0), valid=False)
+        scenario += exchange.ElectDelegate(candidate=alice.public_key_hash).run(sender=alice, now=sp.timestamp(0))
+        scenario.verify(exchange.data.delegated == sp.some(alice.public_key_hash))
+        scenario.verify(exchange.data.nextElection == sp.timestamp(MultiDex.EPOCH))
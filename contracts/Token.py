@@ -7,64 +7,145 @@ class Token(sp.Contract):
         self.init(
             owner=owner,
             totalSupply=sp.as_nat(totalSupply),
-            ledger=sp.big_map({
-                owner: sp.record(balance=sp.as_nat(totalSupply), allowances={})
-
-            },
-                tkey=sp.TAddress,
-                tvalue=sp.TRecord(
-                    balance=sp.TNat,
-                    allowances=sp.TMap(
-                        sp.TAddress,
-                        sp.TNat
-                    )
-            )
-            )
+            # sp.TAddress, sp.TNat
+            ledger=sp.big_map({owner: sp.as_nat(totalSupply)},
+                              tkey=sp.TAddress,
+                              tvalue=sp.TNat),
+            # (owner, spender), sp.TNat
+            allowances=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                  tvalue=sp.TNat),
+            # Burn cuts every allowance of the owner by value / ownerSpenders.
+            # The cut is accumulated in burnCut and settled lazily: burnCuts
+            # keeps the burnCut already applied to each owner allowance.
+            burnCut=sp.nat(0),
+            # (owner, spender), sp.TNat
+            burnCuts=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                tvalue=sp.TNat),
+            ownerSpenders=sp.nat(0),
+            # (owner, operator): operators move any amount of the owner's
+            # tokens, without an allowance to check or update
+            operators=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                 tvalue=sp.TUnit)
         )
 
-    def IsAllowed(self, account_from: sp.TAddress, value: sp.TNat) -> sp.TBool:
-        allowed = False
-        sp.if sp.sender != account_from:
-            src = self.data.ledger[account_from]
-            allowance_amount = src.allowances[sp.sender]
-            allowed = allowance_amount >= value
+    def Allowance(self, owner: sp.TAddress, spender: sp.TAddress) -> sp.TNat:
+        allowance = sp.pair(owner, spender)
+        pending = abs(self.data.burnCut -
+                      self.data.burnCuts.get(allowance, self.data.burnCut))
+        return abs(sp.max(self.data.allowances.get(allowance, 0), pending) - pending)
+
+    def SetAllowance(self, owner: sp.TAddress, spender: sp.TAddress, value: sp.TNat):
+        allowance = sp.pair(owner, spender)
+        sp.if value == 0:
+            self.RemoveAllowance(owner, spender)
+        sp.else:
+            sp.if owner == self.data.owner:
+                sp.if ~self.data.allowances.contains(allowance):
+                    self.data.ownerSpenders += 1
+                self.data.burnCuts[allowance] = self.data.burnCut
+            self.data.allowances[allowance] = value
+
+    def RemoveAllowance(self, owner: sp.TAddress, spender: sp.TAddress):
+        allowance = sp.pair(owner, spender)
+        sp.if self.data.allowances.contains(allowance):
+            sp.if owner == self.data.owner:
+                self.data.ownerSpenders = sp.as_nat(self.data.ownerSpenders - 1)
+                del self.data.burnCuts[allowance]
+            del self.data.allowances[allowance]
+
+    # Empty balances and allowances are deleted rather than stored as 0.
+    def SetBalance(self, account: sp.TAddress, value: sp.TNat):
+        sp.if value == 0:
+            del self.data.ledger[account]
         sp.else:
-            allowed = True
-        return allowed
+            self.data.ledger[account] = value
+
+    # The owner and its operators move tokens without an allowance. The
+    # operators are only looked up when someone else sends, and the
+    # allowance only when that sender is not one of them. Tokens sent back
+    # to their source spend no allowance: spent excludes them.
+    def Debit(self, account_from: sp.TAddress, value: sp.TNat, spent: sp.TNat):
+        sp.if (sp.sender != account_from) & (spent > 0):
+            sp.if ~self.data.operators.contains(sp.pair(account_from,
+                                                        sp.sender)):
+                allowance = sp.local("allowance", self.Allowance(
+                    account_from, sp.sender)).value
+                sp.verify(allowance >= spent,
+                          message="Sender not allowed to spend token from source")
+                self.SetAllowance(account_from, sp.sender,
+                                  sp.as_nat(allowance - spent))
+        balance = sp.local("balance", self.data.ledger.get(account_from, 0)).value
+        sp.verify(value <= balance, message="Source balance is too low")
+        self.SetBalance(account_from, abs(balance - value))
+
+    def Credit(self, destination: sp.TAddress, value: sp.TNat):
+        sp.if value > 0:
+            self.data.ledger[destination] = self.data.ledger.get(destination, 0) + value
 
     @sp.entry_point
     def Transfer(self, params):
         account_from = params.account_from
         destination = params.destination
         value = params.value
-        sp.if account_from != destination:
-            sp.verify(self.IsAllowed(account_from=account_from,
-                                     value=value),
-                      message="Sender not allowed to spend token from source")
-        src = self.data.ledger[account_from]
-        sp.verify(value <= src.balance, message="Source balance is too low")
-        src.balance = abs(src.balance - value)
-        self.data.ledger[account_from] = src
-        dst = sp.record(balance=sp.nat(0), allowances=sp.map(
-            tkey=sp.TAddress, tvalue=sp.TNat))
-        self.data.ledger[destination] = self.data.ledger.get(destination, dst)
-        self.data.ledger[destination].balance += value
-        sp.if src.allowances.contains(sp.sender):
-            allow_value = sp.local(
-                "allow_value", src.allowances[sp.sender]).value - value
-            src.allowances[sp.sender] = sp.as_nat(allow_value)
-        self.data.ledger[account_from] = src
+        spent = sp.local("spent", value)
+        sp.if account_from == destination:
+            spent.value = 0
+        self.Debit(account_from, value, spent.value)
+        self.Credit(destination, value)
+
+    # Each source is debited once for everything it sends in the batch,
+    # before any destination is credited.
+    @sp.entry_point
+    def TransferBatch(self, params):
+        sp.set_type(params.transfers, sp.TList(sp.TRecord(
+            account_from=sp.TAddress,
+            txs=sp.TList(sp.TRecord(destination=sp.TAddress,
+                                    value=sp.TNat)))))
+        debits = sp.local("debits", sp.map(
+            tkey=sp.TAddress, tvalue=sp.TRecord(total=sp.TNat, spent=sp.TNat)))
+        sp.for transfer in params.transfers:
+            sp.if ~debits.value.contains(transfer.account_from):
+                debits.value[transfer.account_from] = sp.record(total=sp.nat(0),
+                                                                spent=sp.nat(0))
+            debit = debits.value[transfer.account_from]
+            sp.for tx in transfer.txs:
+                debit.total += tx.value
+                sp.if tx.destination != transfer.account_from:
+                    debit.spent += tx.value
+        sp.for source in debits.value.items():
+            self.Debit(source.key, source.value.total, source.value.spent)
+        sp.for transfer in params.transfers:
+            sp.for tx in transfer.txs:
+                self.Credit(tx.destination, tx.value)
+
+    # Pays a contract and notifies it in the same operation: the sender's
+    # own tokens move, so no allowance is read or written, and the tez sent
+    # along are forwarded to the callback.
+    @sp.entry_point
+    def TransferAndCall(self, params):
+        destination = params.destination
+        value = params.value
+        sp.set_type(params.data, sp.TBytes)
+        self.Debit(sp.sender, value, sp.nat(0))
+        self.Credit(destination, value)
+        callback = sp.contract(sp.TRecord(account_from=sp.TAddress,
+                                          value=sp.TNat,
+                                          data=sp.TBytes),
+                               address=destination,
+                               entry_point="OnTokenTransfer").open_some()
+        sp.transfer(sp.record(account_from=sp.sender,
+                              value=value,
+                              data=params.data),
+                    sp.amount,
+                    callback)
 
     @sp.entry_point
     def Mint(self, params):
         value = params.value
         sp.verify(sp.sender == self.data.owner,
                   message="You must be the owner of the contract to mint tokens")
-        def_val = sp.record(balance=sp.nat(0), allowances=sp.map(
-            tkey=sp.TAddress, tvalue=sp.TNat))
         self.data.ledger[self.data.owner] = self.data.ledger.get(
-            self.data.owner, def_val)
-        self.data.ledger[self.data.owner].balance += value
+            self.data.owner, 0) + value
         self.data.totalSupply = self.data.totalSupply + value
 
     @sp.entry_point
@@ -72,48 +153,80 @@ class Token(sp.Contract):
         value = params.value
         sp.verify(sp.sender == self.data.owner,
                   message="You must be the owner of the contract to burn tokens")
-        owner_account = sp.record(balance=sp.nat(
-            0), allowances=sp.map(tkey=sp.TAddress, tvalue=sp.TNat))
-        sp.if self.data.ledger.contains(self.data.owner):
-            owner_account = self.data.ledger[self.data.owner]
-        sp.verify(value <= owner_account.balance,
+        balance = sp.local("balance",
+                           self.data.ledger.get(self.data.owner, 0)).value
+        sp.verify(value <= balance,
                   message="Owner balance is too low")
-        owner_account.balance = sp.as_nat(owner_account.balance - value)
+        self.SetBalance(self.data.owner, sp.as_nat(balance - value))
 
-        # subtract allowed amounts by value/len(allowances)
-        sp.for key in owner_account.allowances.keys():
-            owner_account.allowances[key] = sp.as_nat(
-                owner_account.allowances[key] - value/sp.len(owner_account.allowances))
+        # subtract allowed amounts by value/ownerSpenders, see Allowance
+        sp.if self.data.ownerSpenders > 0:
+            self.data.burnCut += value / self.data.ownerSpenders
 
-        self.data.ledger[self.data.owner] = owner_account
         self.data.totalSupply = sp.as_nat(self.data.totalSupply - value)
 
     @sp.entry_point
     def Approve(self, params):
         spender = params.spender
-        value = params.value
-        sp.if value > self.data.ledger[sp.sender].balance:
-            value = self.data.ledger[sp.sender].balance
+        value = sp.local("value", params.value)
+        balance = sp.local("balance", self.data.ledger.get(sp.sender, 0)).value
+        sp.if value.value > balance:
+            value.value = balance
         sp.if sp.sender != spender:
-            src = self.data.ledger[sp.sender]
-            src.allowances[spender] = value
-            self.data.ledger[sp.sender] = src
+            self.SetAllowance(sp.sender, spender, value.value)
+
+    @sp.entry_point
+    def UpdateOperators(self, params):
+        # FA2 style: only the owner adds or removes its operators
+        sp.set_type(params.updates, sp.TList(sp.TVariant(
+            add_operator=sp.TRecord(owner=sp.TAddress, operator=sp.TAddress),
+            remove_operator=sp.TRecord(owner=sp.TAddress,
+                                       operator=sp.TAddress))))
+        sp.for update in params.updates:
+            sp.if update.is_variant("add_operator"):
+                add = update.open_variant("add_operator")
+                sp.verify(add.owner == sp.sender, message="Not the owner")
+                self.data.operators[sp.pair(add.owner, add.operator)] = sp.unit
+            sp.else:
+                remove = update.open_variant("remove_operator")
+                sp.verify(remove.owner == sp.sender, message="Not the owner")
+                del self.data.operators[sp.pair(remove.owner, remove.operator)]
+
+    @sp.entry_point
+    def Cleanup(self, params):
+        # anyone may drop keys that are stored but worth nothing
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        sp.set_type(params.allowances, sp.TList(sp.TPair(sp.TAddress,
+                                                         sp.TAddress)))
+        sp.for account in params.accounts:
+            sp.if self.data.ledger.get(account, 0) == 0:
+                del self.data.ledger[account]
+        sp.for allowance in params.allowances:
+            sp.if self.Allowance(sp.fst(allowance), sp.snd(allowance)) == 0:
+                self.RemoveAllowance(sp.fst(allowance), sp.snd(allowance))
 
     @sp.entry_point
     def GetAllowance(self, params):
         owner = params.owner
         spender = params.spender
         contr = params.contr
-        src = self.data.ledger[owner]
-        dest_allowance = src.allowances[spender]
-        sp.transfer(dest_allowance, sp.tez(0), contr)
+        sp.transfer(self.Allowance(owner, spender), sp.tez(0), contr)
 
     @sp.entry_point
     def GetBalance(self, params):
         account_from = params.account_from
         contr = params.contr
-        src = self.data.ledger[account_from]
-        sp.transfer(src.balance, sp.tez(0), contr)
+        sp.transfer(self.data.ledger.get(account_from, 0), sp.tez(0), contr)
+
+    @sp.entry_point
+    def GetBalances(self, params):
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        contr = params.contr
+        balances = sp.local("balances", sp.map(tkey=sp.TAddress,
+                                               tvalue=sp.TNat))
+        sp.for account in params.accounts:
+            balances.value[account] = self.data.ledger.get(account, 0)
+        sp.transfer(balances.value, sp.tez(0), contr)
 
     @sp.entry_point
     def GetTotalSupply(self, params):
@@ -170,6 +283,7 @@ class Token(sp.Contract):
         scenario.p("Transfer to Alice 5 from Admin by Bob")
         scenario += token.Transfer(account_from=admin.address,
                                    destination=alice.address, value=5).run(sender=bob)
+        scenario.verify(token.data.allowances[sp.pair(admin.address, bob.address)] == 5)
 
         scenario.p("Approve Alice to spend 10 from Bob")
         scenario += token.Approve(spender=alice.address,
@@ -179,8 +293,71 @@ class Token(sp.Contract):
         scenario += token.Transfer(account_from=bob.address,
                                    destination=admin.address, value=5).run(sender=alice)
 
+        scenario.h3("Batch transfer")
+
+        scenario.p("Transfer 2 to Alice and 3 to Bob from Admin in one batch")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=admin.address,
+                      txs=[sp.record(destination=alice.address, value=2),
+                           sp.record(destination=bob.address, value=3)])
+        ]).run(sender=admin)
+        scenario.verify(token.data.ledger[bob.address] == 3)
+
+        scenario.p("Batch above the allowance of Alice on Bob fails")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=bob.address,
+                      txs=[sp.record(destination=admin.address, value=3),
+                           sp.record(destination=alice.address, value=3)])
+        ]).run(sender=alice, valid=False)
+
+        scenario.p("Tokens sent back to their source spend no allowance: Alice has none left on Bob")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=bob.address,
+                      txs=[sp.record(destination=bob.address, value=3)])
+        ]).run(sender=alice)
+        scenario.verify(token.data.ledger[bob.address] == 3)
+        scenario.verify(~token.data.allowances.contains(sp.pair(bob.address, alice.address)))
+
         scenario.h3("Burn")
         scenario.p("Burn 5")
         scenario += token.Burn(value=5).run(sender=admin)
+        scenario.verify(token.data.burnCut == 5)
+
+        scenario.p("Burning 5 cut the remaining allowance of Bob on Admin to 0")
+        scenario += token.Transfer(account_from=admin.address,
+                                   destination=alice.address, value=1).run(sender=bob, valid=False)
+
+        scenario.h3("Cleanup")
+        scenario.p("Anyone can drop the allowance of Bob on Admin, now worth 0")
+        scenario += token.Cleanup(accounts=[],
+                                  allowances=[sp.pair(admin.address, bob.address)]).run(sender=alice)
+        scenario.verify(~token.data.allowances.contains(sp.pair(admin.address, bob.address)))
+        scenario.verify(token.data.ownerSpenders == 0)
+
+        scenario.h3("Operators")
+        scenario.p("Alice makes Bob her operator: no allowance is needed")
+        scenario += token.UpdateOperators(updates=[
+            sp.variant("add_operator", sp.record(owner=alice.address,
+                                                 operator=bob.address))
+        ]).run(sender=alice)
+        scenario += token.Transfer(account_from=alice.address,
+                                   destination=bob.address, value=1).run(sender=bob)
+        scenario.verify(~token.data.allowances.contains(sp.pair(alice.address, bob.address)))
+        scenario.p("Only Alice can change her operators")
+        scenario += token.UpdateOperators(updates=[
+            sp.variant("remove_operator", sp.record(owner=alice.address,
+                                                    operator=bob.address))
+        ]).run(sender=bob, valid=False)
+        scenario += token.UpdateOperators(updates=[
+            sp.variant("remove_operator", sp.record(owner=alice.address,
+                                                    operator=bob.address))
+        ]).run(sender=alice)
+        scenario += token.Transfer(account_from=alice.address,
+                                   destination=bob.address, value=1).run(sender=bob, valid=False)
+
+        scenario.h3("Transfer and call")
+        scenario.p("Alice cannot pay more than her balance")
+        scenario += token.TransferAndCall(destination=bob.address, value=1000,
+                                          data=sp.bytes("0x")).run(sender=alice, valid=False)
 
         scenario.simulation(token)
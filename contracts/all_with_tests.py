@@ -6,64 +6,145 @@ class Token(sp.Contract):
         self.init(
             owner=owner,
             totalSupply=sp.as_nat(totalSupply),
-            ledger=sp.big_map({
-                owner: sp.record(balance=sp.as_nat(totalSupply), allowances={})
-
-            },
-                tkey=sp.TAddress,
-                tvalue=sp.TRecord(
-                    balance=sp.TNat,
-                    allowances=sp.TMap(
-                        sp.TAddress,
-                        sp.TNat
-                    )
-            )
-            )
+            # sp.TAddress, sp.TNat
+            ledger=sp.big_map({owner: sp.as_nat(totalSupply)},
+                              tkey=sp.TAddress,
+                              tvalue=sp.TNat),
+            # (owner, spender), sp.TNat
+            allowances=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                  tvalue=sp.TNat),
+            # Burn cuts every allowance of the owner by value / ownerSpenders.
+            # The cut is accumulated in burnCut and settled lazily: burnCuts
+            # keeps the burnCut already applied to each owner allowance.
+            burnCut=sp.nat(0),
+            # (owner, spender), sp.TNat
+            burnCuts=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                tvalue=sp.TNat),
+            ownerSpenders=sp.nat(0),
+            # (owner, operator): operators move any amount of the owner's
+            # tokens, without an allowance to check or update
+            operators=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                 tvalue=sp.TUnit)
         )
 
-    def IsAllowed(self, account_from: sp.TAddress, value: sp.TNat) -> sp.TBool:
-        allowed = False
-        sp.if sp.sender != account_from:
-            src = self.data.ledger[account_from]
-            allowance_amount = src.allowances[sp.sender]
-            allowed = allowance_amount >= value
+    def Allowance(self, owner: sp.TAddress, spender: sp.TAddress) -> sp.TNat:
+        allowance = sp.pair(owner, spender)
+        pending = abs(self.data.burnCut -
+                      self.data.burnCuts.get(allowance, self.data.burnCut))
+        return abs(sp.max(self.data.allowances.get(allowance, 0), pending) - pending)
+
+    def SetAllowance(self, owner: sp.TAddress, spender: sp.TAddress, value: sp.TNat):
+        allowance = sp.pair(owner, spender)
+        sp.if value == 0:
+            self.RemoveAllowance(owner, spender)
         sp.else:
-            allowed = True
-        return allowed
+            sp.if owner == self.data.owner:
+                sp.if ~self.data.allowances.contains(allowance):
+                    self.data.ownerSpenders += 1
+                self.data.burnCuts[allowance] = self.data.burnCut
+            self.data.allowances[allowance] = value
+
+    def RemoveAllowance(self, owner: sp.TAddress, spender: sp.TAddress):
+        allowance = sp.pair(owner, spender)
+        sp.if self.data.allowances.contains(allowance):
+            sp.if owner == self.data.owner:
+                self.data.ownerSpenders = sp.as_nat(self.data.ownerSpenders - 1)
+                del self.data.burnCuts[allowance]
+            del self.data.allowances[allowance]
+
+    # Empty balances and allowances are deleted rather than stored as 0.
+    def SetBalance(self, account: sp.TAddress, value: sp.TNat):
+        sp.if value == 0:
+            del self.data.ledger[account]
+        sp.else:
+            self.data.ledger[account] = value
+
+    # The owner and its operators move tokens without an allowance. The
+    # operators are only looked up when someone else sends, and the
+    # allowance only when that sender is not one of them. Tokens sent back
+    # to their source spend no allowance: spent excludes them.
+    def Debit(self, account_from: sp.TAddress, value: sp.TNat, spent: sp.TNat):
+        sp.if (sp.sender != account_from) & (spent > 0):
+            sp.if ~self.data.operators.contains(sp.pair(account_from,
+                                                        sp.sender)):
+                allowance = sp.local("allowance", self.Allowance(
+                    account_from, sp.sender)).value
+                sp.verify(allowance >= spent,
+                          message="Sender not allowed to spend token from source")
+                self.SetAllowance(account_from, sp.sender,
+                                  sp.as_nat(allowance - spent))
+        balance = sp.local("balance", self.data.ledger.get(account_from, 0)).value
+        sp.verify(value <= balance, message="Source balance is too low")
+        self.SetBalance(account_from, abs(balance - value))
+
+    def Credit(self, destination: sp.TAddress, value: sp.TNat):
+        sp.if value > 0:
+            self.data.ledger[destination] = self.data.ledger.get(destination, 0) + value
 
     @sp.entry_point
     def Transfer(self, params):
         account_from = params.account_from
         destination = params.destination
         value = params.value
-        sp.if account_from != destination:
-            sp.verify(self.IsAllowed(account_from=account_from,
-                                     value=value),
-                      message="Sender not allowed to spend token from source")
-        src = self.data.ledger[account_from]
-        sp.verify(value <= src.balance, message="Source balance is too low")
-        src.balance = abs(src.balance - value)
-        self.data.ledger[account_from] = src
-        dst = sp.record(balance=sp.nat(0), allowances=sp.map(
-            tkey=sp.TAddress, tvalue=sp.TNat))
-        self.data.ledger[destination] = self.data.ledger.get(destination, dst)
-        self.data.ledger[destination].balance += value
-        sp.if src.allowances.contains(sp.sender):
-            allow_value = sp.local(
-                "allow_value", src.allowances[sp.sender]).value - value
-            src.allowances[sp.sender] = sp.as_nat(allow_value)
-        self.data.ledger[account_from] = src
+        spent = sp.local("spent", value)
+        sp.if account_from == destination:
+            spent.value = 0
+        self.Debit(account_from, value, spent.value)
+        self.Credit(destination, value)
+
+    # Each source is debited once for everything it sends in the batch,
+    # before any destination is credited.
+    @sp.entry_point
+    def TransferBatch(self, params):
+        sp.set_type(params.transfers, sp.TList(sp.TRecord(
+            account_from=sp.TAddress,
+            txs=sp.TList(sp.TRecord(destination=sp.TAddress,
+                                    value=sp.TNat)))))
+        debits = sp.local("debits", sp.map(
+            tkey=sp.TAddress, tvalue=sp.TRecord(total=sp.TNat, spent=sp.TNat)))
+        sp.for transfer in params.transfers:
+            sp.if ~debits.value.contains(transfer.account_from):
+                debits.value[transfer.account_from] = sp.record(total=sp.nat(0),
+                                                                spent=sp.nat(0))
+            debit = debits.value[transfer.account_from]
+            sp.for tx in transfer.txs:
+                debit.total += tx.value
+                sp.if tx.destination != transfer.account_from:
+                    debit.spent += tx.value
+        sp.for source in debits.value.items():
+            self.Debit(source.key, source.value.total, source.value.spent)
+        sp.for transfer in params.transfers:
+            sp.for tx in transfer.txs:
+                self.Credit(tx.destination, tx.value)
+
+    # Pays a contract and notifies it in the same operation: the sender's
+    # own tokens move, so no allowance is read or written, and the tez sent
+    # along are forwarded to the callback.
+    @sp.entry_point
+    def TransferAndCall(self, params):
+        destination = params.destination
+        value = params.value
+        sp.set_type(params.data, sp.TBytes)
+        self.Debit(sp.sender, value, sp.nat(0))
+        self.Credit(destination, value)
+        callback = sp.contract(sp.TRecord(account_from=sp.TAddress,
+                                          value=sp.TNat,
+                                          data=sp.TBytes),
+                               address=destination,
+                               entry_point="OnTokenTransfer").open_some()
+        sp.transfer(sp.record(account_from=sp.sender,
+                              value=value,
+                              data=params.data),
+                    sp.amount,
+                    callback)
 
     @sp.entry_point
     def Mint(self, params):
         value = params.value
         sp.verify(sp.sender == self.data.owner,
                   message="You must be the owner of the contract to mint tokens")
-        def_val = sp.record(balance=sp.nat(0), allowances=sp.map(
-            tkey=sp.TAddress, tvalue=sp.TNat))
         self.data.ledger[self.data.owner] = self.data.ledger.get(
-            self.data.owner, def_val)
-        self.data.ledger[self.data.owner].balance += value
+            self.data.owner, 0) + value
         self.data.totalSupply = self.data.totalSupply + value
 
     @sp.entry_point
@@ -71,48 +152,80 @@ class Token(sp.Contract):
         value = params.value
         sp.verify(sp.sender == self.data.owner,
                   message="You must be the owner of the contract to burn tokens")
-        owner_account = sp.record(balance=sp.nat(
-            0), allowances=sp.map(tkey=sp.TAddress, tvalue=sp.TNat))
-        sp.if self.data.ledger.contains(self.data.owner):
-            owner_account = self.data.ledger[self.data.owner]
-        sp.verify(value <= owner_account.balance,
+        balance = sp.local("balance",
+                           self.data.ledger.get(self.data.owner, 0)).value
+        sp.verify(value <= balance,
                   message="Owner balance is too low")
-        owner_account.balance = sp.as_nat(owner_account.balance - value)
+        self.SetBalance(self.data.owner, sp.as_nat(balance - value))
 
-        # subtract allowed amounts by value/len(allowances)
-        sp.for key in owner_account.allowances.keys():
-            owner_account.allowances[key] = sp.as_nat(
-                owner_account.allowances[key] - value/sp.len(owner_account.allowances))
+        # subtract allowed amounts by value/ownerSpenders, see Allowance
+        sp.if self.data.ownerSpenders > 0:
+            self.data.burnCut += value / self.data.ownerSpenders
 
-        self.data.ledger[self.data.owner] = owner_account
         self.data.totalSupply = sp.as_nat(self.data.totalSupply - value)
 
     @sp.entry_point
     def Approve(self, params):
         spender = params.spender
-        value = params.value
-        sp.if value > self.data.ledger[sp.sender].balance:
-            value = self.data.ledger[sp.sender].balance
+        value = sp.local("value", params.value)
+        balance = sp.local("balance", self.data.ledger.get(sp.sender, 0)).value
+        sp.if value.value > balance:
+            value.value = balance
         sp.if sp.sender != spender:
-            src = self.data.ledger[sp.sender]
-            src.allowances[spender] = value
-            self.data.ledger[sp.sender] = src
+            self.SetAllowance(sp.sender, spender, value.value)
+
+    @sp.entry_point
+    def UpdateOperators(self, params):
+        # FA2 style: only the owner adds or removes its operators
+        sp.set_type(params.updates, sp.TList(sp.TVariant(
+            add_operator=sp.TRecord(owner=sp.TAddress, operator=sp.TAddress),
+            remove_operator=sp.TRecord(owner=sp.TAddress,
+                                       operator=sp.TAddress))))
+        sp.for update in params.updates:
+            sp.if update.is_variant("add_operator"):
+                add = update.open_variant("add_operator")
+                sp.verify(add.owner == sp.sender, message="Not the owner")
+                self.data.operators[sp.pair(add.owner, add.operator)] = sp.unit
+            sp.else:
+                remove = update.open_variant("remove_operator")
+                sp.verify(remove.owner == sp.sender, message="Not the owner")
+                del self.data.operators[sp.pair(remove.owner, remove.operator)]
+
+    @sp.entry_point
+    def Cleanup(self, params):
+        # anyone may drop keys that are stored but worth nothing
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        sp.set_type(params.allowances, sp.TList(sp.TPair(sp.TAddress,
+                                                         sp.TAddress)))
+        sp.for account in params.accounts:
+            sp.if self.data.ledger.get(account, 0) == 0:
+                del self.data.ledger[account]
+        sp.for allowance in params.allowances:
+            sp.if self.Allowance(sp.fst(allowance), sp.snd(allowance)) == 0:
+                self.RemoveAllowance(sp.fst(allowance), sp.snd(allowance))
 
     @sp.entry_point
     def GetAllowance(self, params):
         owner = params.owner
         spender = params.spender
         contr = params.contr
-        src = self.data.ledger[owner]
-        dest_allowance = src.allowances[spender]
-        sp.transfer(dest_allowance, sp.tez(0), contr)
+        sp.transfer(self.Allowance(owner, spender), sp.tez(0), contr)
 
     @sp.entry_point
     def GetBalance(self, params):
         account_from = params.account_from
         contr = params.contr
-        src = self.data.ledger[account_from]
-        sp.transfer(src.balance, sp.tez(0), contr)
+        sp.transfer(self.data.ledger.get(account_from, 0), sp.tez(0), contr)
+
+    @sp.entry_point
+    def GetBalances(self, params):
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        contr = params.contr
+        balances = sp.local("balances", sp.map(tkey=sp.TAddress,
+                                               tvalue=sp.TNat))
+        sp.for account in params.accounts:
+            balances.value[account] = self.data.ledger.get(account, 0)
+        sp.transfer(balances.value, sp.tez(0), contr)
 
     @sp.entry_point
     def GetTotalSupply(self, params):
@@ -121,9 +234,18 @@ class Token(sp.Contract):
 
 
 class Factory(sp.Contract):
-    def __init__(self):
+    def __init__(self, feeRate=500):
+        self.feeRate = feeRate
+        # Only the code of this Dex is used; LaunchExchange supplies the
+        # storage of every exchange it originates.
+        self.exchange = Dex(feeRate,
+                            sp.address("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"),
+                            sp.address("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"),
+                            sp.key_hash("tz1Ke2h7sDdakHJQh8WX4Z372du1KChsksyU"))
         self.init(
-            tokenList=sp.list(t=sp.TAddress),
+            tokenCount=sp.nat(0),
+            # sp.TNat, sp.TAddress
+            tokenList=sp.big_map(tkey=sp.TNat, tvalue=sp.TAddress),
             tokenToExchange=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
             exchangeToToken=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress)
         )
@@ -131,42 +253,164 @@ class Factory(sp.Contract):
     @sp.entry_point
     def LaunchExchange(self, params):
         token = params.token
-        exchange = params.exchange
-        sp.verify(~(self.data.tokenToExchange.contains(token) |
-                    self.data.exchangeToToken.contains(exchange)),
+        tokenAmount = params.tokenAmount
+        candidate = params.candidate
+        sp.verify(~self.data.tokenToExchange.contains(token),
                   message="Exchange launched")
-        self.data.tokenList.push(token)
+
+        # With tez attached the new exchange starts with the sender's
+        # liquidity, as if InitializeExchange had been called on it.
+        seeded = sp.amount > sp.mutez(0)
+        sp.if seeded:
+            sp.verify(((sp.amount > sp.mutez(1)) & (
+                sp.amount < sp.tez(500000000))), message="Wrong amount")
+            sp.verify(tokenAmount > sp.nat(10), message="Wrong tokenAmount")
+        sp.else:
+            sp.verify(tokenAmount == 0, message="Wrong tokenAmount")
+        shares = sp.local("shares",
+                          sp.big_map(tkey=sp.TAddress, tvalue=sp.TNat))
+        candidates = sp.local("candidates",
+                              sp.big_map(tkey=sp.TAddress,
+                                         tvalue=sp.TKeyHash))
+        votes = sp.local("votes",
+                         sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat))
+        totalShares = sp.local("totalShares", sp.nat(0))
+        nextElection = sp.local("nextElection", sp.timestamp(0))
+        # Only a seeded exchange delegates from the start, to the candidate
+        # its first votes went to; an unseeded one stores no delegate until
+        # its InitializeExchange.
+        baker = sp.local("baker", sp.none, t=sp.TOption(sp.TKeyHash))
+        sp.if seeded:
+            shares.value[sp.sender] = sp.nat(1000)
+            candidates.value[sp.sender] = candidate
+            votes.value[candidate] = sp.nat(1000)
+            totalShares.value = sp.nat(1000)
+            nextElection.value = sp.now.add_seconds(Dex.EPOCH)
+            baker.value = sp.some(candidate)
+
+        exchange = sp.local("exchange", sp.create_contract(
+            contract=self.exchange,
+            storage=sp.record(
+                pool=sp.record(tezPool=sp.amount,
+                               tokenPool=tokenAmount,
+                               feeRate=sp.nat(self.feeRate),
+                               tokenAddress=token),
+                totalShares=totalShares.value,
+                shares=shares.value,
+                exchanges=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
+                factoryAddress=sp.to_address(sp.self),
+                candidates=candidates.value,
+                votes=votes.value,
+                delegated=baker.value,
+                nextElection=nextElection.value),
+            amount=sp.amount,
+            baker=baker.value)).value
+
+        # The sender approves the Factory on the token beforehand; the
+        # tokens go straight to the new exchange.
+        sp.if seeded:
+            token_contract = sp.contract(
+                sp.TRecord(account_from=sp.TAddress,
+                           destination=sp.TAddress,
+                           value=sp.TNat),
+                address=token,
+                entry_point="Transfer"
+            ).open_some()
+            sp.transfer(sp.record(account_from=sp.sender,
+                                  destination=exchange,
+                                  value=tokenAmount),
+                        sp.mutez(0),
+                        token_contract)
+
+        self.data.tokenList[self.data.tokenCount] = token
+        self.data.tokenCount += 1
         self.data.tokenToExchange[token] = exchange
         self.data.exchangeToToken[exchange] = token
 
     @sp.entry_point
     def TokenToExchangeLookup(self, params):
         tokenOutAddress = params.tokenOutAddress
-        recepient = params.recepient
+        recipient = params.recipient
         minTokensOut = params.minTokensOut
         exchange = sp.contract(sp.TRecord(recipient=sp.TAddress,
                                           minTokensOut=sp.TNat),
                                address=self.data.tokenToExchange[tokenOutAddress],
                                entry_point="TokenToTokenIn").open_some()
-        sp.transfer(sp.record(recipient=recepient,
+        sp.transfer(sp.record(recipient=recipient,
                               minTokensOut=minTokensOut),
                     sp.amount,
                     exchange)
 
+    @sp.entry_point
+    def GetExchange(self, params):
+        token = params.token
+        contr = params.contr
+        sp.set_type(contr, sp.TContract(sp.TRecord(token=sp.TAddress,
+                                                   exchange=sp.TAddress)))
+        sp.transfer(sp.record(token=token,
+                              exchange=self.data.tokenToExchange[token]),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenList(self, params):
+        offset = params.offset
+        limit = params.limit
+        contr = params.contr
+        sp.set_type(contr, sp.TContract(sp.TList(sp.TAddress)))
+        sp.verify(limit <= 100, message="Wrong limit")
+        tokens = sp.local("tokens", sp.list(t=sp.TAddress))
+        index = sp.local("index", offset + limit)
+        sp.if index.value > self.data.tokenCount:
+            index.value = self.data.tokenCount
+        sp.while index.value > offset:
+            index.value = sp.as_nat(index.value - 1)
+            tokens.value.push(self.data.tokenList[index.value])
+        sp.transfer(tokens.value, sp.tez(0), contr)
+
 
 class Dex(sp.Contract):
+    # The delegate is re-elected at most once per epoch, about a cycle.
+    EPOCH = 4096 * 60
+
+    POOL = sp.TRecord(tezPool=sp.TMutez,
+                      tokenPool=sp.TNat,
+                      feeRate=sp.TNat,
+                      tokenAddress=sp.TAddress)
+
+    # What to do with the tokens Token.TransferAndCall sent along, packed
+    # in its data and unpacked by OnTokenTransfer.
+    ACTION = sp.TVariant(
+        TokenToTez=sp.TRecord(recipient=sp.TAddress,
+                              minTezOut=sp.TNat),
+        TokenToToken=sp.TRecord(recipient=sp.TAddress,
+                                minTokensOut=sp.TNat,
+                                tokenOutAddress=sp.TAddress),
+        InvestLiquidity=sp.TRecord(minShares=sp.TNat,
+                                   candidate=sp.TKeyHash))
+
     def __init__(self,
                  feeRate: sp.TNat,
                  tokenAddress: sp.TAddress,
                  factoryAddress: sp.TAddress,
                  delegated: sp.TKeyHash):
+        # The fields every swap reads and writes are grouped in pool.
+        self.init_type(sp.TRecord(
+            pool=self.POOL,
+            totalShares=sp.TNat,
+            shares=sp.TBigMap(sp.TAddress, sp.TNat),
+            exchanges=sp.TBigMap(sp.TAddress, sp.TAddress),
+            factoryAddress=sp.TAddress,
+            candidates=sp.TBigMap(sp.TAddress, sp.TKeyHash),
+            votes=sp.TBigMap(sp.TKeyHash, sp.TNat),
+            delegated=sp.TOption(sp.TKeyHash),
+            nextElection=sp.TTimestamp))
         self.init(
-            feeRate=sp.nat(feeRate),
-            tezPool=sp.mutez(0),
-            tokenPool=sp.nat(0),
-            invariant=sp.mutez(0),
+            pool=sp.record(tezPool=sp.mutez(0),
+                           tokenPool=sp.nat(0),
+                           feeRate=sp.nat(feeRate),
+                           tokenAddress=tokenAddress),
             totalShares=sp.nat(0),
-            tokenAddress=tokenAddress,
             factoryAddress=factoryAddress,
             # sp.TAddress, sp.TNat
             shares=sp.big_map(tkey=sp.TAddress, tvalue=sp.TNat),
@@ -174,83 +418,130 @@ class Dex(sp.Contract):
             candidates=sp.big_map(tkey=sp.TAddress, tvalue=sp.TKeyHash),
             # sp.TKeyHash, sp.TNat
             votes=sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat),
-            delegated=delegated,
-            address=tokenAddress
+            # token address, exchange address, as registered in the Factory
+            exchanges=sp.big_map(tkey=sp.TAddress, tvalue=sp.TAddress),
+            # the baker the exchange delegates to, if any
+            delegated=sp.some(delegated),
+            # ElectDelegate may run again from this time on
+            nextElection=sp.timestamp(0)
         )
-        self.data.address = sp.to_address(sp.self)
+
+    # Every token transfer the exchange makes is built by this one global
+    # lambda.
+    @sp.global_lambda
+    def TokenTransfer(params):
+        token_contract = sp.contract(
+            sp.TRecord(account_from=sp.TAddress,
+                       destination=sp.TAddress,
+                       value=sp.TNat),
+            address=params.token,
+            entry_point="Transfer"
+        ).open_some()
+        sp.result(sp.transfer_operation(
+            sp.record(account_from=params.account_from,
+                      destination=params.destination,
+                      value=params.value),
+            sp.mutez(0),
+            token_contract))
+
+    def TransferTokensOperation(self, token, account_from, destination, value):
+        return self.TokenTransfer(sp.record(token=token,
+                                            account_from=account_from,
+                                            destination=destination,
+                                            value=value))
 
     @sp.entry_point
     def InitializeExchange(self, params):
         token_amount = sp.as_nat(params.token_amount)
         candidate = params.candidate
 
-        sp.verify(self.data.invariant == sp.mutez(0), message="Wrong invariant")
         sp.verify(self.data.totalShares == 0, message="Wrong totalShares")
         sp.verify(((sp.amount > sp.mutez(1)) & (
             sp.amount < sp.tez(500000000))), message="Wrong amount")
         sp.verify(token_amount > sp.nat(10), message="Wrong tokenAmount")
 
-        self.data.tokenPool = token_amount
-        self.data.tezPool = sp.amount
-        self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        self.data.pool.tokenPool = token_amount
+        self.data.pool.tezPool = sp.amount
         self.data.shares[sp.sender] = sp.nat(1000)
         self.data.totalShares = sp.nat(1000)
 
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-
-        sp.transfer(sp.record(account_from=sp.sender,
-                              destination=self.data.address,
-                              value=token_amount),
-                    sp.mutez(0),
-                    token_contract)
+        self.TransferTokens(sp.sender, sp.to_address(sp.self), token_amount)
 
         self.data.candidates[sp.sender] = candidate
         self.data.votes[candidate] = sp.as_nat(1000)
-        self.data.delegated = candidate
+        self.data.delegated = sp.some(candidate)
+        self.data.nextElection = sp.now.add_seconds(self.EPOCH)
 
         sp.set_delegate(sp.some(candidate))
 
+    def ReceiveTokens(self, buyer, tokensIn):
+        # buyer is None when the tokens are already here, sent by
+        # Token.TransferAndCall before OnTokenTransfer
+        if buyer is not None:
+            self.TransferTokens(buyer, sp.to_address(sp.self), tokensIn)
+
+    def TransferTokens(self,
+                       account_from: sp.TAddress,
+                       destination: sp.TAddress,
+                       value: sp.TNat):
+        sp.operations().push(self.TransferTokensOperation(
+            self.data.pool.tokenAddress, account_from, destination, value))
+
+    # Both swap directions share one fee-adjusted constant product step,
+    # compiled once into a global lambda that returns the updated pool. The
+    # product is derived from the pools:
+    # out = poolOut * inWithFee / (poolIn + inWithFee), rounded down.
+    @sp.global_lambda
+    def Swap(params):
+        sp.verify(params.amountIn > 0, message="Wrong amountIn")
+        sp.verify(params.minOut > 0, message="Wrong minOut")
+        pool = sp.local("pool", params.pool)
+        tezPool = sp.fst(sp.ediv(pool.value.tezPool, sp.mutez(1)).open_some())
+        inWithFee = abs(params.amountIn - params.amountIn / pool.value.feeRate)
+        out = sp.local("out", sp.nat(0))
+        sp.if params.tezToToken:
+            out.value = sp.fst(sp.ediv(inWithFee * pool.value.tokenPool,
+                                       tezPool + inWithFee).open_some())
+            pool.value.tezPool += sp.split_tokens(sp.mutez(1),
+                                                  params.amountIn, sp.nat(1))
+            pool.value.tokenPool = abs(pool.value.tokenPool - out.value)
+        sp.else:
+            out.value = sp.fst(sp.ediv(inWithFee * tezPool,
+                                       pool.value.tokenPool + inWithFee
+                                       ).open_some())
+            pool.value.tokenPool += params.amountIn
+            pool.value.tezPool -= sp.split_tokens(sp.mutez(1),
+                                                  out.value, sp.nat(1))
+        sp.verify(out.value >= params.minOut, message="Wrong minOut")
+        sp.result(sp.record(pool=pool.value, out=out.value))
+
+    def ToNat(self, amount: sp.TMutez) -> sp.TNat:
+        return sp.fst(sp.ediv(amount, sp.mutez(1)).open_some())
+
+    def ToMutez(self, amount: sp.TNat) -> sp.TMutez:
+        return sp.split_tokens(sp.mutez(1), amount, sp.nat(1))
+
+    def SwapPool(self, pool, tezToToken, amountIn, minOut):
+        return self.Swap(sp.record(pool=pool,
+                                   tezToToken=tezToToken,
+                                   amountIn=amountIn,
+                                   minOut=minOut))
+
+    def TezToTokenOut(self, pool, tezIn, minTokensOut):
+        return self.SwapPool(pool, True, self.ToNat(tezIn), minTokensOut).out
+
+    def TokenToTezOut(self, pool, tokensIn, minTezOut):
+        return self.ToMutez(
+            self.SwapPool(pool, False, tokensIn, minTezOut).out)
+
     def TezToToken(self,
                    recipient: sp.TAddress,
-                   tezIn: sp.TNat,
+                   tezIn: sp.TMutez,
                    minTokensOut: sp.TNat):
-        this = self.data.address
-
-        sp.verify(tezIn > sp.mutez(0), message="Wrong tezIn")
-        sp.verify(minTokensOut > 0, message="Wrong minTokensOut")
-
-        fee = sp.fst(sp.ediv(tezIn, self.data.feeRate).open_some())  # TODO: ????
-        newTezPool = sp.local("newTezPool", self.data.tezPool).value + tezIn
-        tempTezPool = abs(newTezPool - fee)
-        newTokenPool = sp.fst(sp.ediv(sp.local(
-            "newTokenPool", self.data.invariant).value, tempTezPool).open_some())
-        tokensOut = abs(
-            sp.local("tokensOut", self.data.tokenPool).value - newTokenPool)
-
-        sp.verify(tokensOut >= minTokensOut, message="Wrong minTokensOut")
-        sp.verify(tokensOut <= self.data.tokenPool, message="Wrong tokenPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.split_tokens(newTezPool, newTokenPool, sp.nat(1))
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-        sp.transfer(sp.record(account_from=this,
-                              destination=recipient,
-                              value=tokensOut),
-                    sp.mutez(0),
-                    token_contract)
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, True, self.ToNat(tezIn), minTokensOut)).value
+        self.data.pool = swapped.pool
+        self.TransferTokens(sp.to_address(sp.self), recipient, swapped.out)
 
     @sp.entry_point
     def TezToTokenPayment(self, params):
@@ -272,42 +563,11 @@ class Dex(sp.Contract):
                    recipient: sp.TAddress,
                    tokensIn: sp.TNat,
                    minTezOut: sp.TNat):
-        this = self.data.address
-
-        sp.verify(tokensIn > 0, message="Wrong tokensIn")
-        sp.verify(minTezOut > 0, message="Wrong minTezOut")
-
-        fee = tokensIn / self.data.feeRate  # TODO: ????
-        newTokenPool = sp.local(
-            "newTokenPool", self.data.tokenPool).value + tokensIn
-        tempTokenPool = abs(newTokenPool - fee)
-        newTezPool = sp.fst(sp.ediv(sp.local(
-            "newTezPool", self.data.invariant).value, tempTokenPool).open_some())
-        tezOut = abs(
-            sp.local("tezOut", self.data.tokenPool).value - newTezPool)
-
-        sp.verify(tezOut >= minTezOut, message="Wrong minTezOut")
-        sp.verify(sp.mutez(tezOut) <= self.data.tezPool, message="Wrong tezPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.mutez(newTezPool * newTokenPool)
-
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
-
-
-        sp.transfer(sp.record(account_from=buyer,
-                              destination=this,
-                              value=tokensIn),
-                    sp.mutez(0),
-                    token_contract)
-        sp.send(recipient, sp.mutez(tezOut),)
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, False, tokensIn, minTezOut)).value
+        self.data.pool = swapped.pool
+        self.ReceiveTokens(buyer, tokensIn)
+        sp.send(recipient, self.ToMutez(swapped.out))
 
     @sp.entry_point
     def TokenToTezPayment(self, params):
@@ -328,57 +588,122 @@ class Dex(sp.Contract):
                         tokensIn=tokensIn,
                         minTezOut=minTezOut)
 
+    @sp.entry_point
+    def SwapBatch(self, params):
+        sp.set_type(params.swaps, sp.TList(sp.TRecord(tezToToken=sp.TBool,
+                                                      amount=sp.TNat,
+                                                      recipient=sp.TAddress,
+                                                      minOut=sp.TNat)))
+        pool = sp.local("pool", self.data.pool)
+        tezIn = sp.local("tezIn", sp.mutez(0))
+        tokensIn = sp.local("tokensIn", sp.nat(0))
+        # outputs are netted per recipient and paid out after the loop
+        tokensOut = sp.local("tokensOut", sp.map(tkey=sp.TAddress,
+                                                 tvalue=sp.TNat))
+        tezOut = sp.local("tezOut", sp.map(tkey=sp.TAddress,
+                                           tvalue=sp.TMutez))
+
+        sp.for swap in params.swaps:
+            swapped = sp.local("swapped", self.SwapPool(
+                pool.value, swap.tezToToken, swap.amount, swap.minOut)).value
+            pool.value = swapped.pool
+            sp.if swap.tezToToken:
+                tezIn.value += self.ToMutez(swap.amount)
+                tokensOut.value[swap.recipient] = tokensOut.value.get(
+                    swap.recipient, 0) + swapped.out
+            sp.else:
+                tokensIn.value += swap.amount
+                tezOut.value[swap.recipient] = tezOut.value.get(
+                    swap.recipient, sp.mutez(0)) + self.ToMutez(swapped.out)
+
+        sp.verify(tezIn.value == sp.amount, message="Wrong amount")
+        self.data.pool = pool.value
+
+        # tokens owed to the sender pay for its tokens in first
+        owed = sp.local("owed", tokensOut.value.get(sp.sender, 0)).value
+        sp.if owed > tokensIn.value:
+            tokensOut.value[sp.sender] = abs(owed - tokensIn.value)
+            tokensIn.value = 0
+        sp.else:
+            del tokensOut.value[sp.sender]
+            tokensIn.value = abs(tokensIn.value - owed)
+
+        sp.if tokensIn.value > 0:
+            self.TransferTokens(sp.sender, sp.to_address(sp.self), tokensIn.value)
+        sp.for payout in tokensOut.value.items():
+            self.TransferTokens(sp.to_address(sp.self), payout.key, payout.value)
+        sp.for payout in tezOut.value.items():
+            sp.send(payout.key, payout.value)
+
     def TokenToTokenOut(self,
                         buyer: sp.TAddress,
                         recipient: sp.TAddress,
                         tokensIn: sp.TNat,
                         minTokensOut: sp.TNat,
                         tokenOutAddress: sp.TAddress):
-        this = self.data.address
-        sp.verify(tokensIn > 0, message="Wrong tokensIn")
-        sp.verify(minTokensOut > 0, message="Wrong minTokensOut")
-
-        fee = tokensIn / self.data.feeRate  # TODO: ????
-        newTokenPool = sp.local(
-            "newTokenPool", self.data.tokenPool).value + tokensIn
-        tempTokenPool = abs(newTokenPool - fee)
-        newTezPool = sp.fst(sp.ediv(sp.local(
-            "newTezPool", self.data.invariant).value, tempTokenPool).open_some())
-        tezOut = abs(sp.local("tezOut", self.data.tezPool).value - newTezPool)
-
-        sp.verify(sp.mutez(tezOut) <= self.data.tezPool, message="Wrong tezPool")
-
-        self.data.tezPool = newTezPool
-        self.data.tokenPool = newTokenPool
-        self.data.invariant = sp.mutez(newTezPool * newTokenPool)
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
+        sp.verify(minTokensOut > 0, message="Wrong minOut")
+        # any positive amount of tez is enough, the second leg checks the
+        # tokens actually bought against minTokensOut
+        swapped = sp.local("swapped", self.SwapPool(
+            self.data.pool, False, tokensIn, sp.nat(1))).value
+        self.data.pool = swapped.pool
+        tezOut = sp.local("tezOut", self.ToMutez(swapped.out)).value
+        self.ReceiveTokens(buyer, tokensIn)
+
+        # pay the target exchange directly once its address is cached,
+        # otherwise let the Factory look it up
+        sp.if self.data.exchanges.contains(tokenOutAddress):
+            exchange_contract = sp.contract(
+                sp.TRecord(recipient=sp.TAddress,
+                           minTokensOut=sp.TNat),
+                address=self.data.exchanges[tokenOutAddress],
+                entry_point="TezToTokenPayment"
+            ).open_some()
+            sp.transfer(sp.record(recipient=recipient,
+                                  minTokensOut=minTokensOut),
+                        tezOut,
+                        exchange_contract)
+        sp.else:
+            factory_contract = sp.contract(
+                sp.TRecord(tokenOutAddress=sp.TAddress,
+                           recipient=sp.TAddress,
+                           minTokensOut=sp.TNat),
+                address=self.data.factoryAddress,
+                entry_point="TokenToExchangeLookup"
+            ).open_some()
+            sp.transfer(sp.record(tokenOutAddress=tokenOutAddress,
+                                  recipient=recipient,
+                                  minTokensOut=minTokensOut),
+                        tezOut,
+                        factory_contract)
 
+    @sp.entry_point
+    def RegisterExchange(self, params):
+        token = params.token
         factory_contract = sp.contract(
-            sp.TRecord(tokenOutAddress=sp.TAddress,
-                       recipient=sp.TAddress,
-                       minTokensOut=sp.TNat),
+            sp.TRecord(token=sp.TAddress,
+                       contr=sp.TContract(sp.TRecord(token=sp.TAddress,
+                                                     exchange=sp.TAddress))),
             address=self.data.factoryAddress,
-            entry_point="TokenToExchangeLookup"
+            entry_point="GetExchange"
         ).open_some()
-
-        sp.transfer(sp.record(account_from=buyer,
-                              destination=this,
-                              value=tokensIn),
+        callback = sp.contract(
+            sp.TRecord(token=sp.TAddress,
+                       exchange=sp.TAddress),
+            address=sp.to_address(sp.self),
+            entry_point="CacheExchange"
+        ).open_some()
+        sp.transfer(sp.record(token=token,
+                              contr=callback),
                     sp.mutez(0),
-                    token_contract)
-
-        sp.transfer(sp.record(tokenOutAddress=tokenOutAddress,
-                              destination=recipient,
-                              value=minTokensOut),
-                    sp.mutez(tezOut),
                     factory_contract)
 
+    @sp.entry_point
+    def CacheExchange(self, params):
+        sp.verify(sp.sender == self.data.factoryAddress,
+                  message="Wrong sender")
+        self.data.exchanges[params.token] = params.exchange
+
     @sp.entry_point
     def TokenToTokenPayment(self, params):
         recipient = sp.local("recipient", params.recipient).value
@@ -411,65 +736,83 @@ class Dex(sp.Contract):
         recipient = sp.local("recipient", params.recipient).value
         minTokensOut = sp.local("minTokensOut", params.minTokensOut).value
         sp.verify(sp.sender == self.data.factoryAddress,
-                  message="Wrong minTezOut")
+                  message="Wrong sender")
         return self.TezToToken(recipient=recipient,
                                tezIn=sp.amount,
                                minTokensOut=minTokensOut)
 
-    @sp.entry_point
-    def InvestLiquidity(self, params):
-        minShares = params.minShares
-        candidate = params.candidate
-
+    def Invest(self,
+               investor: sp.TAddress,
+               minShares: sp.TNat,
+               candidate: sp.TKeyHash,
+               tokensIn=None):
         sp.verify(sp.amount > sp.mutez(0), message="Wrong amount")
         sp.verify(minShares > sp.nat(0), message="Wrong tokenAmount")
 
-        tezPerShare = sp.split_tokens(self.data.tezPool, sp.nat(1), self.data.totalShares)
-
-        sp.verify(sp.amount >= tezPerShare,
-                  message="Wrong tezPerShare")
-
-        sharesPurchased = sp.fst(sp.ediv(sp.amount, tezPerShare).open_some())
+        # shares at the pool price, tokens rounded up in favour of the pool
+        sharesPurchased = sp.local("sharesPurchased", sp.fst(sp.ediv(
+            sp.split_tokens(sp.amount, self.data.totalShares, sp.nat(1)),
+            self.data.pool.tezPool).open_some())).value
 
         sp.verify(sharesPurchased >= minShares,
                   message="Wrong sharesPurchased")
 
-        tokensPerShare = self.data.tokenPool / self.data.totalShares
-        tokensRequired = sharesPurchased * tokensPerShare
-        share = sp.local("share", self.data.shares.get(sp.sender, 0)).value
-        self.data.shares[sp.sender] = share + sharesPurchased
-        self.data.tezPool += sp.amount
-        self.data.tokenPool += tokensRequired
-        self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        tokensRequired = sp.local("tokensRequired", sp.as_nat(
+            sharesPurchased * self.data.pool.tokenPool +
+            self.data.totalShares - 1) / self.data.totalShares).value
+        share = sp.local("share", self.data.shares.get(investor, 0)).value
+        self.data.shares[investor] = share + sharesPurchased
+        self.data.pool.tezPool += sp.amount
+        self.data.pool.tokenPool += tokensRequired
         self.data.totalShares += sharesPurchased
-        sp.if self.data.candidates.contains(sp.sender):
-            prevVotes = self.data.votes.get(self.data.candidates[sp.sender], 0)
-            self.data.votes[self.data.candidates[sp.sender]] = abs(
-                prevVotes - share)
-
-        self.data.candidates[sp.sender] = candidate
-        prevVotes = self.data.votes.get(candidate, 0)
-        newVotes = prevVotes + share + sharesPurchased
-        self.data.votes[candidate] = newVotes
-
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
+        self.Vote(self.data, investor, candidate, share, sharesPurchased)
+
+        if tokensIn is None:
+            self.TransferTokens(investor, sp.to_address(sp.self),
+                                tokensRequired)
+        else:
+            # tokensIn were sent with the call, the change goes back
+            sp.verify(tokensRequired <= tokensIn,
+                      message="Wrong tokensRequired")
+            sp.if tokensIn > tokensRequired:
+                self.TransferTokens(sp.to_address(sp.self), investor,
+                                    abs(tokensIn - tokensRequired))
 
-        sp.transfer(sp.record(account_from=sp.sender,
-                              destination=self.data.address,
-                              value=tokensRequired),
-                    sp.mutez(0),
-                    token_contract)
+    @sp.entry_point
+    def InvestLiquidity(self, params):
+        self.Invest(investor=sp.sender,
+                    minShares=params.minShares,
+                    candidate=params.candidate)
 
-        mainCandidateVotes = self.data.votes.get(self.data.delegated, 0)
-        sp.if mainCandidateVotes <= newVotes:
-            self.data.delegated = candidate
-            sp.set_delegate(sp.some(candidate))
+    # Token.TransferAndCall: the tokens were transferred to this contract in
+    # the same operation, data says what to do with them.
+    @sp.entry_point
+    def OnTokenTransfer(self, params):
+        sp.verify(sp.sender == self.data.pool.tokenAddress,
+                  message="Wrong sender")
+        action = sp.local("action", sp.unpack(
+            params.data, t=self.ACTION).open_some(message="Wrong data")).value
+        sp.if action.is_variant("TokenToTez"):
+            swap = action.open_variant("TokenToTez")
+            sp.verify(sp.amount == sp.mutez(0), message="Wrong amount")
+            self.TokenToTez(buyer=None,
+                            recipient=swap.recipient,
+                            tokensIn=params.value,
+                            minTezOut=swap.minTezOut)
+        sp.if action.is_variant("TokenToToken"):
+            swap = action.open_variant("TokenToToken")
+            sp.verify(sp.amount == sp.mutez(0), message="Wrong amount")
+            self.TokenToTokenOut(buyer=None,
+                                 recipient=swap.recipient,
+                                 tokensIn=params.value,
+                                 minTokensOut=swap.minTokensOut,
+                                 tokenOutAddress=swap.tokenOutAddress)
+        sp.if action.is_variant("InvestLiquidity"):
+            invest = action.open_variant("InvestLiquidity")
+            self.Invest(investor=params.account_from,
+                        minShares=invest.minShares,
+                        candidate=invest.candidate,
+                        tokensIn=params.value)
 
     @sp.entry_point
     def DivestLiquidity(self, params):
@@ -478,10 +821,13 @@ class Dex(sp.Contract):
         minTokens = params.minTokens
         sp.verify(sharesBurned > 0, message="Wrong sharesBurned")
         share = sp.local("share", self.data.shares.get(sp.sender, 0)).value
-        sp.verify(sharesBurned > share, message="Sender shares are too low")
-        self.data.shares[sp.sender] = abs(share - sharesBurned)
-        tezPerShare = sp.split_tokens(self.data.tezPool, sp.nat(1), self.data.totalShares)
-        tokensPerShare = sp.nat(self.data.tokenPool / self.data.totalShares)
+        sp.verify(sharesBurned <= share, message="Sender shares are too low")
+        sp.if share == sharesBurned:
+            del self.data.shares[sp.sender]
+        sp.else:
+            self.data.shares[sp.sender] = abs(share - sharesBurned)
+        tezPerShare = sp.split_tokens(self.data.pool.tezPool, sp.nat(1), self.data.totalShares)
+        tokensPerShare = sp.nat(self.data.pool.tokenPool / self.data.totalShares)
         tezDivested = sp.split_tokens(tezPerShare, sharesBurned, sp.nat(1))
         tokensDivested = tokensPerShare * sharesBurned
 
@@ -489,33 +835,419 @@ class Dex(sp.Contract):
         sp.verify(tokensDivested >= minTokens, message="Wrong minTokens")
 
         self.data.totalShares -= sharesBurned
-        self.data.tezPool -= tezDivested
-        self.data.tokenPool -= tokensDivested
-        sp.if self.data.totalShares == 0:
-            self.data.invariant = sp.mutez(0)
-        sp.else:
-            self.data.invariant = sp.split_tokens(self.data.tezPool, self.data.tokenPool, sp.nat(1))
+        self.data.pool.tezPool -= tezDivested
+        self.data.pool.tokenPool -= tokensDivested
 
         sp.if self.data.candidates.contains(sp.sender):
-            prevVotes = self.data.votes.get(self.data.candidates[sp.sender], 0)
-            self.data.votes[self.data.candidates[sp.sender]] = abs(
-                prevVotes - sharesBurned)
+            self.RemoveVotes(self.data, self.data.candidates[sp.sender],
+                             sharesBurned)
+            sp.if share == sharesBurned:
+                del self.data.candidates[sp.sender]
 
-        token_contract = sp.contract(
-            sp.TRecord(account_from=sp.TAddress,
-                       destination=sp.TAddress,
-                       value=sp.TNat),
-            address=self.data.tokenAddress,
-            entry_point="Transfer"
-        ).open_some()
+        self.TransferTokens(sp.to_address(sp.self), sp.sender, tokensDivested)
 
-        sp.transfer(sp.record(account_from=self.data.address,
-                              destination=sp.sender,
-                              value=tokensDivested),
-                    sp.mutez(0),
-                    token_contract)
+        sp.send(sp.sender, tezDivested)
+
+    # Liquidity operations only move votes; the delegate follows them in
+    # ElectDelegate, once per epoch.
+    def Vote(self,
+             data,
+             voter: sp.TAddress,
+             candidate: sp.TKeyHash,
+             share: sp.TNat,
+             sharesPurchased: sp.TNat):
+        sp.if data.candidates.get(voter, candidate) == candidate:
+            data.votes[candidate] = data.votes.get(
+                candidate, 0) + sharesPurchased
+            sp.if ~data.candidates.contains(voter):
+                data.candidates[voter] = candidate
+        sp.else:
+            self.RemoveVotes(data, data.candidates[voter], share)
+            data.votes[candidate] = data.votes.get(
+                candidate, 0) + share + sharesPurchased
+            data.candidates[voter] = candidate
+
+    def RemoveVotes(self, data, candidate: sp.TKeyHash, value: sp.TNat):
+        # candidates left without votes are deleted, not stored as 0
+        votes = sp.local("votes", data.votes.get(candidate, 0)).value
+        sp.if votes > value:
+            data.votes[candidate] = abs(votes - value)
+        sp.else:
+            del data.votes[candidate]
+
+    @sp.entry_point
+    def Cleanup(self, params):
+        # anyone may drop the entries of former holders and candidates
+        sp.set_type(params.accounts, sp.TList(sp.TAddress))
+        sp.set_type(params.candidates, sp.TList(sp.TKeyHash))
+        sp.for account in params.accounts:
+            sp.if self.data.shares.get(account, 0) == 0:
+                del self.data.shares[account]
+                del self.data.candidates[account]
+        sp.for candidate in params.candidates:
+            sp.if self.data.votes.get(candidate, 0) == 0:
+                del self.data.votes[candidate]
+
+    @sp.entry_point
+    def ElectDelegate(self, params):
+        self.Elect(self.data, params.candidate)
+
+    def Elect(self, data, candidate: sp.TKeyHash):
+        sp.verify(sp.now >= data.nextElection, message="Epoch not over")
+        # an undelegated exchange takes any candidate with votes
+        current = sp.local("current", sp.nat(0))
+        sp.if data.delegated.is_some():
+            current.value = data.votes.get(data.delegated.open_some(), 0)
+        sp.verify(data.votes.get(candidate, 0) > current.value,
+                  message="Not enough votes")
+        data.delegated = sp.some(candidate)
+        data.nextElection = sp.now.add_seconds(self.EPOCH)
+        sp.set_delegate(sp.some(candidate))
+
+    def SendReserves(self, tezPool, tokenPool, totalShares, feeRate, contr):
+        sp.transfer(sp.record(tezPool=tezPool,
+                              tokenPool=tokenPool,
+                              totalShares=totalShares,
+                              feeRate=feeRate),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetReserves(self, params):
+        self.SendReserves(self.data.pool.tezPool, self.data.pool.tokenPool,
+                          self.data.totalShares, self.data.pool.feeRate,
+                          params.contr)
+
+    # Quotes are the exact output of the swap; they fail where it would.
+    @sp.entry_point
+    def GetTezToTokenQuote(self, params):
+        tezIn = params.tezIn
+        contr = params.contr
+        sp.transfer(self.TezToTokenOut(self.data.pool, tezIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenToTezQuote(self, params):
+        tokensIn = params.tokensIn
+        contr = params.contr
+        sp.transfer(self.TokenToTezOut(self.data.pool, tokensIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+
+class MultiDex(sp.Contract):
+    # The swap math, token transfers, the share-weighted votes and the
+    # delegate election are those of Dex, compiled into this contract. A
+    # provider votes once per pool, keyed by (token address, owner).
+    EPOCH = Dex.EPOCH
+    Swap = Dex.Swap
+    TokenTransfer = Dex.TokenTransfer
+    TransferTokensOperation = Dex.TransferTokensOperation
+    ToNat = Dex.ToNat
+    ToMutez = Dex.ToMutez
+    TezToTokenOut = Dex.TezToTokenOut
+    TokenToTezOut = Dex.TokenToTezOut
+    Vote = Dex.Vote
+    RemoveVotes = Dex.RemoveVotes
+    Elect = Dex.Elect
+    SendReserves = Dex.SendReserves
+
+    def __init__(self,
+                 feeRate: sp.TNat,
+                 delegated: sp.TKeyHash):
+        # One contract holds the pools of every token, keyed by the token
+        # address, so token-to-token swaps settle without leaving it.
+        self.init_type(sp.TRecord(
+            pools=sp.TBigMap(sp.TAddress,
+                             sp.TRecord(tezPool=sp.TMutez,
+                                        tokenPool=sp.TNat,
+                                        totalShares=sp.TNat).layout(
+                                 ("tezPool", ("tokenPool", "totalShares")))),
+            feeRate=sp.TNat,
+            shares=sp.TBigMap(sp.TPair(sp.TAddress, sp.TAddress), sp.TNat),
+            candidates=sp.TBigMap(sp.TPair(sp.TAddress, sp.TAddress),
+                                  sp.TKeyHash),
+            votes=sp.TBigMap(sp.TKeyHash, sp.TNat),
+            delegated=sp.TOption(sp.TKeyHash),
+            nextElection=sp.TTimestamp).layout(
+                ("pools", ("feeRate", ("shares",
+                                       (("candidates", "votes"),
+                                        ("delegated", "nextElection")))))))
+        self.init(
+            # token address, pool
+            pools=sp.big_map(tkey=sp.TAddress),
+            feeRate=sp.nat(feeRate),
+            # (token address, owner), sp.TNat
+            shares=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                              tvalue=sp.TNat),
+            # (token address, owner), sp.TKeyHash
+            candidates=sp.big_map(tkey=sp.TPair(sp.TAddress, sp.TAddress),
+                                  tvalue=sp.TKeyHash),
+            # sp.TKeyHash, sp.TNat
+            votes=sp.big_map(tkey=sp.TKeyHash, tvalue=sp.TNat),
+            delegated=sp.some(delegated),
+            # ElectDelegate may run again from this time on
+            nextElection=sp.timestamp(0)
+        )
+
+    @sp.entry_point
+    def InitializeExchange(self, params):
+        token = params.token
+        token_amount = sp.as_nat(params.token_amount)
+        candidate = params.candidate
+
+        sp.verify(self.data.pools.get(
+            token, sp.record(tezPool=sp.mutez(0),
+                             tokenPool=sp.nat(0),
+                             totalShares=sp.nat(0))).totalShares == 0,
+            message="Wrong totalShares")
+        sp.verify(((sp.amount > sp.mutez(1)) & (
+            sp.amount < sp.tez(500000000))), message="Wrong amount")
+        sp.verify(token_amount > sp.nat(10), message="Wrong tokenAmount")
+
+        self.data.pools[token] = sp.record(tezPool=sp.amount,
+                                           tokenPool=token_amount,
+                                           totalShares=sp.nat(1000))
+        self.data.shares[sp.pair(token, sp.sender)] = sp.nat(1000)
+
+        self.TransferTokens(token, sp.sender, sp.to_address(sp.self),
+                            token_amount)
+
+        self.Vote(self.data, sp.pair(token, sp.sender), candidate, 0, 1000)
+
+    def TransferTokens(self,
+                       token: sp.TAddress,
+                       account_from: sp.TAddress,
+                       destination: sp.TAddress,
+                       value: sp.TNat):
+        sp.operations().push(self.TransferTokensOperation(
+            token, account_from, destination, value))
+
+    def Pool(self, name, token):
+        sp.verify(self.data.pools.contains(token), message="Wrong token")
+        return sp.local(name, self.data.pools[token])
+
+    def SwapPool(self, pool, tezToToken, amountIn, minOut):
+        # Dex.Swap on the reserves of one pool, with the fee of all of them
+        return self.Swap(sp.record(pool=sp.record(tezPool=pool.tezPool,
+                                                  tokenPool=pool.tokenPool,
+                                                  feeRate=self.data.feeRate),
+                                   tezToToken=tezToToken,
+                                   amountIn=amountIn,
+                                   minOut=minOut))
+
+    def Swapped(self, pool, tezToToken, amountIn, minOut, name="swapped"):
+        """Swap on ``pool`` in place; the amount bought."""
+        swapped = sp.local(name, self.SwapPool(
+            pool.value, tezToToken, amountIn, minOut)).value
+        pool.value.tezPool = swapped.pool.tezPool
+        pool.value.tokenPool = swapped.pool.tokenPool
+        return swapped.out
+
+    def TezToToken(self,
+                   token: sp.TAddress,
+                   recipient: sp.TAddress,
+                   tezIn: sp.TMutez,
+                   minTokensOut: sp.TNat):
+        pool = self.Pool("pool", token)
+        tokensOut = self.Swapped(pool, True, self.ToNat(tezIn), minTokensOut)
+        self.data.pools[token] = pool.value
+        self.TransferTokens(token, sp.to_address(sp.self), recipient,
+                            tokensOut)
+
+    @sp.entry_point
+    def TezToTokenPayment(self, params):
+        self.TezToToken(token=params.token,
+                        recipient=params.recipient,
+                        tezIn=sp.amount,
+                        minTokensOut=params.minTokensOut)
+
+    @sp.entry_point
+    def TezToTokenSwap(self, params):
+        self.TezToToken(token=params.token,
+                        recipient=sp.sender,
+                        tezIn=sp.amount,
+                        minTokensOut=params.minTokensOut)
+
+    def TokenToTez(self,
+                   token: sp.TAddress,
+                   buyer: sp.TAddress,
+                   recipient: sp.TAddress,
+                   tokensIn: sp.TNat,
+                   minTezOut: sp.TNat):
+        pool = self.Pool("pool", token)
+        tezOut = self.ToMutez(self.Swapped(pool, False, tokensIn, minTezOut))
+        self.data.pools[token] = pool.value
+        self.TransferTokens(token, buyer, sp.to_address(sp.self), tokensIn)
+        sp.send(recipient, tezOut)
+
+    @sp.entry_point
+    def TokenToTezPayment(self, params):
+        self.TokenToTez(token=params.token,
+                        buyer=sp.sender,
+                        recipient=params.recipient,
+                        tokensIn=params.tokensIn,
+                        minTezOut=params.minTezOut)
+
+    @sp.entry_point
+    def TokenToTezSwap(self, params):
+        self.TokenToTez(token=params.token,
+                        buyer=sp.sender,
+                        recipient=sp.sender,
+                        tokensIn=params.tokensIn,
+                        minTezOut=params.minTezOut)
+
+    def TokenToTokenOut(self,
+                        token: sp.TAddress,
+                        buyer: sp.TAddress,
+                        recipient: sp.TAddress,
+                        tokensIn: sp.TNat,
+                        minTokensOut: sp.TNat,
+                        tokenOutAddress: sp.TAddress):
+        sp.verify(minTokensOut > 0, message="Wrong minOut")
+        sp.verify(token != tokenOutAddress, message="Wrong tokenOutAddress")
+        # The tez bought on the first pool are sold on the second one in
+        # the same call: only the tokens move between contracts.
+        poolIn = self.Pool("poolIn", token)
+        mutezOut = self.Swapped(poolIn, False, tokensIn, sp.nat(1),
+                                name="swappedIn")
+        self.data.pools[token] = poolIn.value
+
+        poolOut = self.Pool("poolOut", tokenOutAddress)
+        tokensOut = self.Swapped(poolOut, True, mutezOut, minTokensOut,
+                                 name="swappedOut")
+        self.data.pools[tokenOutAddress] = poolOut.value
+
+        self.TransferTokens(token, buyer, sp.to_address(sp.self), tokensIn)
+        self.TransferTokens(tokenOutAddress, sp.to_address(sp.self),
+                            recipient, tokensOut)
+
+    @sp.entry_point
+    def TokenToTokenPayment(self, params):
+        self.TokenToTokenOut(
+            token=params.token,
+            buyer=sp.sender,
+            recipient=params.recipient,
+            tokensIn=params.tokensIn,
+            minTokensOut=params.minTokensOut,
+            tokenOutAddress=params.tokenOutAddress)
+
+    @sp.entry_point
+    def TokenToTokenSwap(self, params):
+        self.TokenToTokenOut(
+            token=params.token,
+            buyer=sp.sender,
+            recipient=sp.sender,
+            tokensIn=params.tokensIn,
+            minTokensOut=params.minTokensOut,
+            tokenOutAddress=params.tokenOutAddress)
+
+    @sp.entry_point
+    def InvestLiquidity(self, params):
+        token = params.token
+        minShares = params.minShares
+        candidate = params.candidate
+
+        sp.verify(sp.amount > sp.mutez(0), message="Wrong amount")
+        sp.verify(minShares > sp.nat(0), message="Wrong tokenAmount")
+
+        pool = self.Pool("pool", token)
+        # shares at the pool price, tokens rounded up in favour of the pool
+        sharesPurchased = sp.local("sharesPurchased", sp.fst(sp.ediv(
+            sp.split_tokens(sp.amount, pool.value.totalShares, sp.nat(1)),
+            pool.value.tezPool).open_some())).value
+
+        sp.verify(sharesPurchased >= minShares,
+                  message="Wrong sharesPurchased")
+
+        tokensRequired = sp.local("tokensRequired", sp.as_nat(
+            sharesPurchased * pool.value.tokenPool +
+            pool.value.totalShares - 1) / pool.value.totalShares).value
+        key = sp.pair(token, sp.sender)
+        share = sp.local("share", self.data.shares.get(key, 0)).value
+        self.data.shares[key] = share + sharesPurchased
+        pool.value.tezPool += sp.amount
+        pool.value.tokenPool += tokensRequired
+        pool.value.totalShares += sharesPurchased
+        self.data.pools[token] = pool.value
+        self.Vote(self.data, key, candidate, share, sharesPurchased)
+
+        self.TransferTokens(token, sp.sender, sp.to_address(sp.self),
+                            tokensRequired)
+
+    @sp.entry_point
+    def DivestLiquidity(self, params):
+        token = params.token
+        sharesBurned = params.sharesBurned
+        minTez = params.minTez
+        minTokens = params.minTokens
+        sp.verify(sharesBurned > 0, message="Wrong sharesBurned")
+        key = sp.pair(token, sp.sender)
+        share = sp.local("share", self.data.shares.get(key, 0)).value
+        sp.verify(sharesBurned <= share, message="Sender shares are too low")
+        sp.if share == sharesBurned:
+            del self.data.shares[key]
+        sp.else:
+            self.data.shares[key] = abs(share - sharesBurned)
+        pool = self.Pool("pool", token)
+        tezPerShare = sp.split_tokens(pool.value.tezPool, sp.nat(1),
+                                      pool.value.totalShares)
+        tokensPerShare = sp.nat(pool.value.tokenPool /
+                                pool.value.totalShares)
+        tezDivested = sp.split_tokens(tezPerShare, sharesBurned, sp.nat(1))
+        tokensDivested = tokensPerShare * sharesBurned
+
+        sp.verify(tezDivested >= minTez, message="Wrong minTez")
+        sp.verify(tokensDivested >= minTokens, message="Wrong minTokens")
+
+        pool.value.totalShares = abs(pool.value.totalShares - sharesBurned)
+        pool.value.tezPool -= tezDivested
+        pool.value.tokenPool = abs(pool.value.tokenPool - tokensDivested)
+        self.data.pools[token] = pool.value
+
+        sp.if self.data.candidates.contains(key):
+            self.RemoveVotes(self.data, self.data.candidates[key],
+                             sharesBurned)
+            sp.if share == sharesBurned:
+                del self.data.candidates[key]
+
+        self.TransferTokens(token, sp.to_address(sp.self), sp.sender,
+                            tokensDivested)
 
         sp.send(sp.sender, tezDivested)
+
+    @sp.entry_point
+    def ElectDelegate(self, params):
+        self.Elect(self.data, params.candidate)
+
+    @sp.entry_point
+    def GetReserves(self, params):
+        pool = self.Pool("pool", params.token)
+        self.SendReserves(pool.value.tezPool, pool.value.tokenPool,
+                          pool.value.totalShares, self.data.feeRate,
+                          params.contr)
+
+    # Quotes are the exact output of the swap; they fail where it would.
+    @sp.entry_point
+    def GetTezToTokenQuote(self, params):
+        token = params.token
+        tezIn = params.tezIn
+        contr = params.contr
+        pool = self.Pool("pool", token)
+        sp.transfer(self.TezToTokenOut(pool.value, tezIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
+
+    @sp.entry_point
+    def GetTokenToTezQuote(self, params):
+        token = params.token
+        tokensIn = params.tokensIn
+        contr = params.contr
+        pool = self.Pool("pool", token)
+        sp.transfer(self.TokenToTezOut(pool.value, tokensIn, sp.nat(1)),
+                    sp.tez(0),
+                    contr)
 # Tests
     @sp.add_test(name="QuipuSwap")
     def test():
@@ -566,6 +1298,7 @@ class Dex(sp.Contract):
         scenario.p("Transfer to Alice 5 from Admin by Bob")
         scenario += token.Transfer(account_from=admin.address,
                                    destination=alice.address, value=5).run(sender=bob)
+        scenario.verify(token.data.allowances[sp.pair(admin.address, bob.address)] == 5)
 
         scenario.p("Approve Alice to spend 10 from Bob")
         scenario += token.Approve(spender=alice.address,
@@ -575,28 +1308,506 @@ class Dex(sp.Contract):
         scenario += token.Transfer(account_from=bob.address,
                                    destination=admin.address, value=5).run(sender=alice)
 
+        scenario.h3("Batch transfer")
+
+        scenario.p("Transfer 2 to Alice and 3 to Bob from Admin in one batch")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=admin.address,
+                      txs=[sp.record(destination=alice.address, value=2),
+                           sp.record(destination=bob.address, value=3)])
+        ]).run(sender=admin)
+        scenario.verify(token.data.ledger[bob.address] == 3)
+
+        scenario.p("Batch above the allowance of Alice on Bob fails")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=bob.address,
+                      txs=[sp.record(destination=admin.address, value=3),
+                           sp.record(destination=alice.address, value=3)])
+        ]).run(sender=alice, valid=False)
+
+        scenario.p("Tokens sent back to their source spend no allowance: Alice has none left on Bob")
+        scenario += token.TransferBatch(transfers=[
+            sp.record(account_from=bob.address,
+                      txs=[sp.record(destination=bob.address, value=3)])
+        ]).run(sender=alice)
+        scenario.verify(token.data.ledger[bob.address] == 3)
+        scenario.verify(~token.data.allowances.contains(sp.pair(bob.address, alice.address)))
+
         scenario.h3("Burn")
         scenario.p("Burn 5")
         scenario += token.Burn(value=5).run(sender=admin)
+        scenario.verify(token.data.burnCut == 5)
+
+        scenario.p("Burning 5 cut the remaining allowance of Bob on Admin to 0")
+        scenario += token.Transfer(account_from=admin.address,
+                                   destination=alice.address, value=1).run(sender=bob, valid=False)
 
         scenario.simulation(token)
 
+        class Viewer(sp.Contract):
+            def __init__(self, t):
+                self.init(last=sp.none)
+                self.init_type(sp.TRecord(last=sp.TOption(t)))
+
+            @sp.entry_point
+            def target(self, params):
+                self.data.last = sp.some(params)
+
         # show its representation
         scenario.h2("Factory contract")
         factory = Factory()
         scenario += factory
 
-        scenario.h3("Launch Exchange with random addr")
+        scenario.h3("Launch Exchange without liquidity")
 
         scenario += factory.LaunchExchange(token=fake_token.address,
-                                           exchange=fake_exchange.address).run(sender=admin)
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
 
         scenario.h3("Launch another time")
         scenario += factory.LaunchExchange(token=fake_token.address,
-                                           exchange=fake_exchange.address).run(sender=admin, valid=False)
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin, valid=False)
+        scenario.verify(factory.data.tokenCount == 1)
+        scenario.verify(factory.data.tokenList[0] == fake_token.address)
+
+        scenario.h3("Launch Exchange with liquidity")
+        scenario.p("Admin lets the Factory move 100 tokens into the new Dex")
+        scenario += token.Approve(spender=factory.address,
+                                  value=100).run(sender=admin)
+        scenario += factory.LaunchExchange(token=token.address,
+                                           tokenAmount=100,
+                                           candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario.verify(factory.data.tokenCount == 2)
+        scenario.verify(factory.data.tokenList[1] == token.address)
+
+        scenario.h3("List tokens a page at a time")
+        scenario += factory.LaunchExchange(token=fake_exchange.address,
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
+        scenario += factory.LaunchExchange(token=fake_factory.address,
+                                           tokenAmount=0,
+                                           candidate=admin.public_key_hash).run(sender=admin)
+        scenario.verify(factory.data.tokenCount == 4)
+        tokens = Viewer(sp.TList(sp.TAddress))
+        scenario += tokens
+        scenario += factory.GetTokenList(offset=0, limit=3,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify_equal(tokens.data.last,
+                              sp.some([fake_token.address, token.address,
+                                       fake_exchange.address]))
+        scenario.p("The last page is cut at tokenCount")
+        scenario += factory.GetTokenList(offset=3, limit=3,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify_equal(tokens.data.last, sp.some([fake_factory.address]))
+        scenario.p("A page past the end is empty")
+        scenario += factory.GetTokenList(offset=10, limit=100,
+                                         contr=tokens.typed).run(sender=alice)
+        scenario.verify(sp.len(tokens.data.last.open_some()) == 0)
+        scenario.p("Pages hold at most 100 tokens")
+        scenario += factory.GetTokenList(offset=0, limit=101,
+                                         contr=tokens.typed).run(sender=alice, valid=False)
 
         # show its representation
         scenario.h2("Dex contract")
         exchange = Dex(500, fake_token.address,
                        fake_factory.address, admin.public_key_hash)
         scenario += exchange
+
+        scenario.h3("Only the token calls OnTokenTransfer")
+        scenario += exchange.OnTokenTransfer(account_from=alice.address,
+                                             value=10,
+                                             data=sp.bytes("0x")).run(sender=alice, valid=False)
+
+        def action(name, value):
+            return sp.pack(sp.set_type_expr(sp.variant(name, value),
+                                            Dex.ACTION))
+
+        token_x = Token(admin.address, 10000)
+        scenario += token_x
+        token_y = Token(admin.address, 10000)
+        scenario += token_y
+        exchange_x = Dex(500, token_x.address,
+                         fake_factory.address, admin.public_key_hash)
+        scenario += exchange_x
+        exchange_y = Dex(500, token_y.address,
+                         fake_factory.address, admin.public_key_hash)
+        scenario += exchange_y
+        scenario += token_x.Approve(spender=exchange_x.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_x.InitializeExchange(token_amount=1000,
+                                                  candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += token_y.Approve(spender=exchange_y.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_y.InitializeExchange(token_amount=1000,
+                                                  candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += token_x.Transfer(account_from=admin.address,
+                                     destination=alice.address, value=1000).run(sender=admin)
+
+        scenario.h3("Sell tokens for tez with TransferAndCall")
+        scenario += token_x.TransferAndCall(destination=exchange_x.address,
+                                            value=100,
+                                            data=action("TokenToTez", sp.record(recipient=alice.address,
+                                                                                minTezOut=1))).run(sender=alice)
+        scenario.verify(token_x.data.ledger[alice.address] == 900)
+        scenario.verify(token_x.data.ledger[exchange_x.address] == 1100)
+        scenario.verify(exchange_x.data.pool.tokenPool == 1100)
+        scenario.verify(exchange_x.data.pool.tezPool == sp.mutez(9090910))
+        scenario.verify(exchange_x.balance == sp.mutez(9090910))
+
+        scenario.h3("Sell tokens for other tokens with TransferAndCall")
+        scenario.p("The Factory tells the exchange of X where the exchange of Y is")
+        scenario += exchange_x.CacheExchange(token=token_y.address,
+                                             exchange=exchange_y.address).run(sender=fake_factory)
+        scenario += token_x.TransferAndCall(destination=exchange_x.address,
+                                            value=100,
+                                            data=action("TokenToToken", sp.record(recipient=bob.address,
+                                                                                  minTokensOut=1,
+                                                                                  tokenOutAddress=token_y.address))).run(sender=alice)
+        scenario.verify(token_x.data.ledger[alice.address] == 800)
+        scenario.verify(exchange_x.data.pool.tokenPool == 1200)
+        scenario.verify(exchange_x.data.pool.tezPool == sp.mutez(8333335))
+        scenario.verify(exchange_y.data.pool.tezPool == sp.mutez(10757575))
+        scenario.verify(exchange_y.data.pool.tokenPool == 930)
+        scenario.verify(token_y.data.ledger[bob.address] == 70)
+
+        scenario.h3("Invest with TransferAndCall")
+        scenario.p("300 tokens are sent for 1 tez of liquidity, the 157 not needed come back")
+        scenario += token_x.TransferAndCall(destination=exchange_x.address,
+                                            value=300,
+                                            data=action("InvestLiquidity", sp.record(minShares=1,
+                                                                                     candidate=alice.public_key_hash))).run(sender=alice, amount=sp.tez(1))
+        scenario.verify(exchange_x.data.shares[alice.address] == 119)
+        scenario.verify(exchange_x.data.totalShares == 1119)
+        scenario.verify(exchange_x.data.pool.tokenPool == 1343)
+        scenario.verify(exchange_x.data.pool.tezPool == sp.mutez(9333335))
+        scenario.verify(exchange_x.data.votes[alice.public_key_hash] == 119)
+        scenario.verify(token_x.data.ledger[alice.address] == 657)
+        scenario.verify(token_x.data.ledger[exchange_x.address] == 1343)
+
+        scenario.h3("Batch of swaps")
+        scenario.p("Two purchases for Bob and a sale for Alice: Bob is paid once, 78 + 34 tokens")
+        scenario += token_y.Approve(spender=exchange_y.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_y.SwapBatch(swaps=[
+            sp.record(tezToToken=True, amount=1000000,
+                      recipient=bob.address, minOut=1),
+            sp.record(tezToToken=True, amount=500000,
+                      recipient=bob.address, minOut=1),
+            sp.record(tezToToken=False, amount=50,
+                      recipient=alice.address, minOut=1)
+        ]).run(sender=admin, amount=sp.mutez(1500000))
+        scenario.verify(token_y.data.ledger[bob.address] == 182)
+        scenario.verify(token_y.data.ledger[admin.address] == 8950)
+        scenario.verify(exchange_y.data.pool.tokenPool == 868)
+        scenario.verify(exchange_y.data.pool.tezPool == sp.mutez(11551494))
+        scenario.verify(exchange_y.balance == sp.mutez(11551494))
+
+        scenario.p("The tez sent must pay for the tez legs exactly")
+        scenario += exchange_y.SwapBatch(swaps=[
+            sp.record(tezToToken=True, amount=1000000,
+                      recipient=bob.address, minOut=1),
+            sp.record(tezToToken=True, amount=500000,
+                      recipient=bob.address, minOut=1)
+        ]).run(sender=admin, amount=sp.mutez(1000000), valid=False)
+
+        scenario.p("One leg below its minimum reverts the whole batch")
+        scenario += exchange_y.SwapBatch(swaps=[
+            sp.record(tezToToken=True, amount=1000000,
+                      recipient=bob.address, minOut=1),
+            sp.record(tezToToken=False, amount=50,
+                      recipient=alice.address, minOut=10000000)
+        ]).run(sender=admin, amount=sp.tez(1), valid=False)
+        scenario.verify(exchange_y.data.pool.tokenPool == 868)
+        scenario.verify(exchange_y.data.pool.tezPool == sp.mutez(11551494))
+        scenario.verify(token_y.data.ledger[bob.address] == 182)
+
+        scenario.p("The sender's own payout pays for its tokens in: Admin buys 90 tokens, sells 30 to pay Bob 35106 mutez and gets the 60 left, with no allowance")
+        exchange_b = Dex(500, token_y.address,
+                         fake_factory.address, admin.public_key_hash)
+        scenario += exchange_b
+        scenario += token_y.Approve(spender=exchange_b.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_b.InitializeExchange(token_amount=1000,
+                                                  candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(1))
+        scenario.verify(token_y.data.ledger[admin.address] == 7950)
+        scenario += exchange_b.SwapBatch(swaps=[
+            sp.record(tezToToken=True, amount=100000,
+                      recipient=admin.address, minOut=1),
+            sp.record(tezToToken=False, amount=30,
+                      recipient=bob.address, minOut=1)
+        ]).run(sender=admin, amount=sp.mutez(100000))
+        scenario.verify(token_y.data.ledger[admin.address] == 8010)
+        scenario.verify(token_y.data.ledger[exchange_b.address] == 940)
+        scenario.verify(exchange_b.data.pool.tokenPool == 940)
+        scenario.verify(exchange_b.data.pool.tezPool == sp.mutez(1064894))
+        scenario.verify(exchange_b.balance == sp.mutez(1064894))
+
+        scenario.h3("Cache the exchange of another token")
+        scenario.p("RegisterExchange asks the Factory, which answers with CacheExchange")
+        exchange_z = Dex(500, token.address,
+                         factory.address, admin.public_key_hash)
+        scenario += exchange_z
+        scenario += exchange_z.RegisterExchange(token=fake_token.address).run(sender=alice)
+        scenario.verify(exchange_z.data.exchanges[fake_token.address] ==
+                        factory.data.tokenToExchange[fake_token.address])
+        scenario.p("A token the Factory never listed cannot be registered")
+        scenario += exchange_z.RegisterExchange(token=token_y.address).run(sender=alice, valid=False)
+        scenario.verify(~exchange_z.data.exchanges.contains(token_y.address))
+        scenario.p("Only the Factory writes the cache")
+        scenario += exchange_x.CacheExchange(token=token_y.address,
+                                             exchange=fake_exchange.address).run(sender=alice, valid=False)
+        scenario.verify(exchange_x.data.exchanges[token_y.address] == exchange_y.address)
+
+        scenario.h3("Token to token through the cached exchange")
+        scenario.p("The tez go straight to the exchange of Y, not through the Factory")
+        scenario += token_x.Approve(spender=exchange_x.address,
+                                    value=100).run(sender=alice)
+        scenario += exchange_x.TokenToTokenSwap(tokensIn=100,
+                                                minTokensOut=1,
+                                                tokenOutAddress=token_y.address).run(sender=alice)
+        scenario.verify(exchange_x.data.pool.tokenPool == 1443)
+        scenario.verify(exchange_x.data.pool.tezPool == sp.mutez(8686535))
+        scenario.verify(exchange_y.data.pool.tezPool == sp.mutez(12198294))
+        scenario.verify(exchange_y.data.pool.tokenPool == 823)
+        scenario.verify(token_y.data.ledger[alice.address] == 45)
+        scenario.p("Without a cached exchange the swap needs a Factory to route it")
+        scenario += token_x.Approve(spender=exchange_x.address,
+                                    value=100).run(sender=alice)
+        scenario += exchange_x.TokenToTokenSwap(tokensIn=100,
+                                                minTokensOut=1,
+                                                tokenOutAddress=token.address).run(sender=alice, valid=False)
+
+        scenario.h3("Elect the delegate")
+        scenario.p("Bob invests 10 tez for 1288 shares, voting for himself")
+        scenario += token_x.Transfer(account_from=admin.address,
+                                     destination=bob.address, value=2000).run(sender=admin)
+        scenario += token_x.Approve(spender=exchange_x.address,
+                                    value=2000).run(sender=bob)
+        scenario += exchange_x.InvestLiquidity(minShares=1,
+                                               candidate=bob.public_key_hash).run(sender=bob, amount=sp.tez(10))
+        scenario.verify(exchange_x.data.votes[bob.public_key_hash] == 1288)
+        scenario.verify(exchange_x.data.votes[admin.public_key_hash] == 1000)
+        scenario.verify(exchange_x.data.nextElection == sp.timestamp(Dex.EPOCH))
+
+        scenario.p("Not before the epoch is over")
+        scenario += exchange_x.ElectDelegate(candidate=bob.public_key_hash).run(sender=bob, now=sp.timestamp(Dex.EPOCH - 1), valid=False)
+        scenario.p("Only a candidate with strictly more votes than the delegate")
+        scenario += exchange_x.ElectDelegate(candidate=alice.public_key_hash).run(sender=alice, now=sp.timestamp(Dex.EPOCH), valid=False)
+        scenario += exchange_x.ElectDelegate(candidate=admin.public_key_hash).run(sender=admin, now=sp.timestamp(Dex.EPOCH), valid=False)
+        scenario.verify(exchange_x.data.delegated == sp.some(admin.public_key_hash))
+        scenario += exchange_x.ElectDelegate(candidate=bob.public_key_hash).run(sender=alice, now=sp.timestamp(Dex.EPOCH))
+        scenario.verify(exchange_x.data.delegated == sp.some(bob.public_key_hash))
+        scenario.verify(exchange_x.data.nextElection == sp.timestamp(2 * Dex.EPOCH))
+        scenario.p("Admin gets ahead again, but has to wait for the next epoch")
+        scenario += token_x.Approve(spender=exchange_x.address,
+                                    value=2000).run(sender=admin)
+        scenario += exchange_x.InvestLiquidity(minShares=1,
+                                               candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario.verify(exchange_x.data.votes[admin.public_key_hash] == 2288)
+        scenario += exchange_x.ElectDelegate(candidate=admin.public_key_hash).run(sender=admin, now=sp.timestamp(2 * Dex.EPOCH - 1), valid=False)
+        scenario += exchange_x.ElectDelegate(candidate=admin.public_key_hash).run(sender=admin, now=sp.timestamp(2 * Dex.EPOCH))
+        scenario.verify(exchange_x.data.delegated == sp.some(admin.public_key_hash))
+
+        scenario.h3("Liquidity and governance round trip")
+        scenario.p("A pool is opened, joined, left, cleaned up and re-delegated")
+        start = 3 * Dex.EPOCH
+        token_l = Token(admin.address, 10000)
+        scenario += token_l
+        exchange_l = Dex(500, token_l.address, fake_factory.address,
+                         admin.public_key_hash)
+        scenario += exchange_l
+        scenario += token_l.Approve(spender=exchange_l.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_l.InitializeExchange(token_amount=1000,
+                                                  candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10), now=sp.timestamp(start))
+        scenario.verify(exchange_l.data.nextElection == sp.timestamp(start + Dex.EPOCH))
+        scenario.verify(token_l.data.ledger[exchange_l.address] == 1000)
+        scenario += token_l.Transfer(account_from=admin.address,
+                                     destination=bob.address, value=1000).run(sender=admin)
+        scenario += token_l.Approve(spender=exchange_l.address,
+                                    value=1000).run(sender=bob)
+        scenario += exchange_l.InvestLiquidity(minShares=1,
+                                               candidate=bob.public_key_hash).run(sender=bob, amount=sp.tez(10))
+        scenario += exchange_l.DivestLiquidity(sharesBurned=1000,
+                                               minTez=sp.tez(10),
+                                               minTokens=1000).run(sender=admin)
+        scenario.verify(exchange_l.data.pool.tezPool == sp.tez(10))
+        scenario.verify(exchange_l.data.pool.tokenPool == 1000)
+        scenario.verify(exchange_l.data.totalShares == 1000)
+        scenario.verify(exchange_l.balance == sp.tez(10))
+        scenario.verify(token_l.data.ledger[exchange_l.address] == 1000)
+        scenario.verify(~exchange_l.data.shares.contains(admin.address))
+        scenario.verify(~exchange_l.data.votes.contains(admin.public_key_hash))
+        scenario += exchange_l.Cleanup(accounts=[admin.address, bob.address],
+                                       candidates=[admin.public_key_hash, bob.public_key_hash]).run(sender=alice)
+        scenario.verify(exchange_l.data.shares[bob.address] == 1000)
+        scenario.verify(exchange_l.data.votes[bob.public_key_hash] == 1000)
+        scenario += exchange_l.ElectDelegate(candidate=bob.public_key_hash).run(sender=bob, now=sp.timestamp(start + Dex.EPOCH - 1), valid=False)
+        scenario += exchange_l.ElectDelegate(candidate=bob.public_key_hash).run(sender=bob, now=sp.timestamp(start + Dex.EPOCH))
+        scenario.verify(exchange_l.data.delegated == sp.some(bob.public_key_hash))
+        scenario.verify(exchange_l.data.nextElection == sp.timestamp(start + 2 * Dex.EPOCH))
+
+        token_f = Token(admin.address, 100000)
+        scenario += token_f
+
+        scenario.h3("Divest only the shares you hold")
+        scenario.p("DivestLiquidity once checked sharesBurned > share, so Bob could burn shares he never had")
+        exchange_f1 = Dex(500, token_f.address, fake_factory.address,
+                          admin.public_key_hash)
+        scenario += exchange_f1
+        scenario += token_f.Approve(spender=exchange_f1.address,
+                                    value=1000).run(sender=admin)
+        scenario += exchange_f1.InitializeExchange(token_amount=1000,
+                                                   candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(1))
+        scenario += exchange_f1.DivestLiquidity(sharesBurned=1,
+                                                minTez=sp.mutez(1),
+                                                minTokens=1).run(sender=bob, valid=False)
+        scenario += exchange_f1.DivestLiquidity(sharesBurned=1001,
+                                                minTez=sp.mutez(1),
+                                                minTokens=1).run(sender=admin, valid=False)
+        scenario.verify(exchange_f1.data.totalShares == 1000)
+        scenario.verify(exchange_f1.balance == sp.tez(1))
+        scenario.verify(token_f.data.ledger[exchange_f1.address] == 1000)
+
+        scenario.h3("The constant product never shrinks on a swap")
+        scenario.p("2 mutez for 29001 tokens, then 2 more mutez: 14500 tokens out, the product goes from 58002 to 58004")
+        exchange_f2 = Dex(500, token_f.address, fake_factory.address,
+                          admin.public_key_hash)
+        scenario += exchange_f2
+        scenario += token_f.Approve(spender=exchange_f2.address,
+                                    value=29001).run(sender=admin)
+        scenario += exchange_f2.InitializeExchange(token_amount=29001,
+                                                   candidate=admin.public_key_hash).run(sender=admin, amount=sp.mutez(2))
+        scenario += exchange_f2.TezToTokenSwap(minTokensOut=1).run(sender=alice, amount=sp.mutez(2))
+        scenario.verify(token_f.data.ledger[alice.address] == 14500)
+        scenario.verify(exchange_f2.data.pool.tezPool == sp.mutez(4))
+        scenario.verify(exchange_f2.data.pool.tokenPool == 14501)
+
+        scenario.h3("Shares are priced on the whole pool")
+        scenario.p("In a 400 mutez / 1 token / 1000 shares pool a share is worth 0.4 mutez: 501 mutez buy 1252 shares for 2 tokens")
+        exchange_f3 = Dex(500, token_f.address, fake_factory.address,
+                          admin.public_key_hash)
+        scenario += exchange_f3
+        scenario += token_f.Approve(spender=exchange_f3.address,
+                                    value=11).run(sender=admin)
+        scenario += exchange_f3.InitializeExchange(token_amount=11,
+                                                   candidate=admin.public_key_hash).run(sender=admin, amount=sp.mutez(2))
+        scenario += exchange_f3.TezToTokenSwap(minTokensOut=1).run(sender=alice, amount=sp.mutez(398))
+        scenario.verify(exchange_f3.data.pool.tezPool == sp.mutez(400))
+        scenario.verify(exchange_f3.data.pool.tokenPool == 1)
+        scenario += token_f.Transfer(account_from=admin.address,
+                                     destination=bob.address, value=10).run(sender=admin)
+        scenario += token_f.Approve(spender=exchange_f3.address,
+                                    value=10).run(sender=bob)
+        scenario += exchange_f3.InvestLiquidity(minShares=1,
+                                                candidate=bob.public_key_hash).run(sender=bob, amount=sp.mutez(501))
+        scenario.verify(exchange_f3.data.shares[bob.address] == 1252)
+        scenario.verify(exchange_f3.data.totalShares == 2252)
+        scenario.verify(exchange_f3.data.pool.tezPool == sp.mutez(901))
+        scenario.verify(exchange_f3.data.pool.tokenPool == 3)
+        scenario.verify(token_f.data.ledger[bob.address] == 8)
+
+        scenario.h3("Reserves and quotes")
+
+        reserves = Viewer(sp.TRecord(tezPool=sp.TMutez,
+                                     tokenPool=sp.TNat,
+                                     totalShares=sp.TNat,
+                                     feeRate=sp.TNat))
+        scenario += reserves
+        scenario += exchange_f1.GetReserves(contr=reserves.typed).run(sender=alice)
+        scenario.verify(reserves.data.last.open_some().tezPool == sp.tez(1))
+        scenario.verify(reserves.data.last.open_some().tokenPool == 1000)
+        scenario.verify(reserves.data.last.open_some().totalShares == 1000)
+        scenario.verify(reserves.data.last.open_some().feeRate == 500)
+
+        scenario.p("A quote is what the swap would pay out")
+        tokens_quote = Viewer(sp.TNat)
+        scenario += tokens_quote
+        scenario += exchange_f1.GetTezToTokenQuote(tezIn=sp.tez(1),
+                                                   contr=tokens_quote.typed).run(sender=alice)
+        scenario.verify(tokens_quote.data.last.open_some() == 499)
+        tez_quote = Viewer(sp.TMutez)
+        scenario += tez_quote
+        scenario += exchange_f1.GetTokenToTezQuote(tokensIn=100,
+                                                   contr=tez_quote.typed).run(sender=alice)
+        scenario.verify(tez_quote.data.last.open_some() == sp.mutez(90909))
+        scenario.p("and fails where the swap would")
+        scenario += exchange_f1.GetTezToTokenQuote(tezIn=sp.mutez(0),
+                                                   contr=tokens_quote.typed).run(sender=alice, valid=False)
+
+        scenario.h3("Balances in one call")
+        balances = Viewer(sp.TMap(sp.TAddress, sp.TNat))
+        scenario += balances
+        scenario += token_f.GetBalances(accounts=[exchange_f2.address, bob.address, fake_exchange.address],
+                                        contr=balances.typed).run(sender=alice)
+        scenario.verify(sp.len(balances.data.last.open_some()) == 3)
+        scenario.verify(balances.data.last.open_some()[exchange_f2.address] == 14501)
+        scenario.verify(balances.data.last.open_some()[bob.address] == 8)
+        scenario.p("Unknown accounts are reported with a zero balance")
+        scenario.verify(balances.data.last.open_some()[fake_exchange.address] == 0)
+
+        scenario.h2("MultiDex contract")
+        multi = MultiDex(500, admin.public_key_hash)
+        scenario += multi
+        token_a = Token(admin.address, 10000)
+        scenario += token_a
+        token_b = Token(admin.address, 10000)
+        scenario += token_b
+
+        scenario.h3("One pool per token")
+        scenario += token_a.Approve(spender=multi.address,
+                                    value=10000).run(sender=admin)
+        scenario += token_b.Approve(spender=multi.address,
+                                    value=10000).run(sender=admin)
+        scenario += multi.InitializeExchange(token=token_a.address,
+                                             token_amount=1000,
+                                             candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += multi.InitializeExchange(token=token_b.address,
+                                             token_amount=1000,
+                                             candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10))
+        scenario += multi.InitializeExchange(token=token_b.address,
+                                             token_amount=1000,
+                                             candidate=admin.public_key_hash).run(sender=admin, amount=sp.tez(10), valid=False)
+        scenario.verify(token_a.data.ledger[multi.address] == 1000)
+        scenario.p("Votes are weighted by shares, 1000 for each new pool")
+        scenario.verify(multi.data.votes[admin.public_key_hash] == 2000)
+
+        scenario.h3("Token to token inside the contract")
+        scenario += multi.TokenToTokenSwap(token=token_a.address,
+                                           tokenOutAddress=token_b.address,
+                                           tokensIn=100,
+                                           minTokensOut=1).run(sender=admin)
+        scenario.verify(multi.data.pools[token_a.address].tokenPool == 1100)
+        scenario.p("The tez sold by one pool were bought by the other")
+        scenario.verify(multi.data.pools[token_a.address].tezPool +
+                        multi.data.pools[token_b.address].tezPool == sp.tez(20))
+        scenario += multi.TokenToTokenSwap(token=token_a.address,
+                                           tokenOutAddress=token_a.address,
+                                           tokensIn=100,
+                                           minTokensOut=1).run(sender=admin, valid=False)
+
+        scenario.h3("Liquidity")
+        scenario += multi.InvestLiquidity(token=token_a.address,
+                                          minShares=1,
+                                          candidate=alice.public_key_hash).run(sender=admin, amount=sp.tez(1))
+        scenario.verify(multi.data.shares[sp.pair(token_a.address, admin.address)] == 1109)
+        scenario.verify(multi.data.candidates[sp.pair(token_a.address, admin.address)] ==
+                        alice.public_key_hash)
+        scenario.p("The vote for pool a moves with its shares; pool b still votes for Admin")
+        scenario.verify(multi.data.votes[admin.public_key_hash] == 1000)
+        scenario.verify(multi.data.votes[alice.public_key_hash] == 1109)
+        scenario += multi.DivestLiquidity(token=token_b.address,
+                                          sharesBurned=1000, minTez=sp.mutez(1),
+                                          minTokens=1).run(sender=admin)
+        scenario.verify(~multi.data.shares.contains(sp.pair(token_b.address, admin.address)))
+        scenario.verify(multi.data.pools[token_b.address].totalShares == 0)
+        scenario.verify(~multi.data.candidates.contains(sp.pair(token_b.address, admin.address)))
+        scenario.verify(~multi.data.votes.contains(admin.public_key_hash))
+        scenario.verify(multi.data.votes[alice.public_key_hash] == 1109)
+
+        scenario.h3("Delegate election")
+        scenario += multi.ElectDelegate(candidate=admin.public_key_hash).run(sender=admin, now=sp.timestamp(0), valid=False)
+        scenario += multi.ElectDelegate(candidate=alice.public_key_hash).run(sender=alice, now=sp.timestamp(0))
+        scenario.verify(multi.data.delegated == sp.some(alice.public_key_hash))
+        scenario.verify(multi.data.nextElection == sp.timestamp(MultiDex.EPOCH))
@@ -0,0 +1,22 @@
+import pytest
+
+from tools import amm
+
+np = pytest.importorskip("numpy")
+
+
+def test_vectorized_invest_is_exact_past_int64():
+    pool = amm.Pool(2 ** 30, 2 ** 62, 2 ** 30, 500)
+    exact, _ = amm.invest_liquidity(pool, 2 ** 31)
+    arrays = amm.vectorize(*pool, 2 ** 31)
+    vectorized, _ = amm.invest_liquidity(amm.Pool(*arrays[:4]), arrays[4])
+    assert exact.ok
+    assert exact.tokens_required == 2 ** 63
+    assert vectorized.shares == exact.shares
+    assert vectorized.tokens_required == exact.tokens_required
+
+
+def test_vectorize_keeps_int64_below_the_cube_bound():
+    largest = 2 ** 21 - 1
+    assert all(a.dtype == np.int64 for a in amm.vectorize([1, largest]))
+    assert all(a.dtype == object for a in amm.vectorize([1, largest + 1]))
@@ -0,0 +1,284 @@
+"""Off-chain mirror of the Dex integer arithmetic.
+
+Every function reproduces the corresponding Dex code path step by step,
+including its floor divisions and every ``sp.verify``.  Pool fields and amounts may be Python ints or NumPy arrays;
+arrays broadcast, so a ``(pools, 1)`` state against ``(1, trades)`` amounts
+quotes every trade size against every pool in one call.
+
+Each call returns ``(result, pool)``.  ``result.ok`` is False (elementwise)
+where the contract would fail; there the returned pool equals the input pool
+and the outputs are 0.
+
+    python -m tools.amm --conformance    # replay random trades in SmartPy
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import tempfile
+
+try:
+    import numpy as np
+except ImportError:  # scalar quotes only
+    np = None
+
+Pool = collections.namedtuple(
+    "Pool", "tez_pool token_pool total_shares fee_rate")
+Swap = collections.namedtuple("Swap", "out ok")
+Invest = collections.namedtuple("Invest", "shares tokens_required ok")
+Divest = collections.namedtuple("Divest", "share tez_out tokens_out ok")
+
+_INT64 = 1 << 63
+
+
+def initial_pool(tez_amount, token_amount, fee_rate):
+    """State right after ``InitializeExchange``."""
+    return Pool(tez_pool=tez_amount, token_pool=token_amount,
+                total_shares=1000, fee_rate=fee_rate)
+
+
+def vectorize(*values):
+    """Turn ints and sequences into broadcastable, overflow-free arrays.
+
+    int64 is used while every product the contract forms fits into it;
+    otherwise the arrays hold Python ints and stay exact.  The largest
+    product is ``shares * token_pool`` in ``invest_liquidity``, where
+    ``shares`` is itself up to ``amount * total_shares``: a cube of the
+    largest input.
+    """
+    arrays = [np.asarray(value, dtype=object) for value in values]
+    largest = max((abs(int(a.max())) for a in arrays if a.size), default=0)
+    if largest ** 3 < _INT64:
+        arrays = [a.astype(np.int64) for a in arrays]
+    return arrays
+
+
+def _where(cond, a, b):
+    if np is not None and isinstance(cond, np.ndarray):
+        return np.where(cond, a, b)
+    return a if cond else b
+
+
+def _div(a, b):
+    # ediv(...).open_some() fails on 0; callers fold `b > 0` into `ok`.
+    return a // _where(b > 0, b, 1)
+
+
+def _ceil_div(a, b):
+    # floor((a + b - 1) / b): amounts owed to the pool are rounded up
+    return _div(a + b - 1, b)
+
+
+def _all(*conds):
+    ok = conds[0]
+    for cond in conds[1:]:
+        ok = ok & cond
+    if np is not None and isinstance(ok, np.ndarray):
+        return ok.astype(bool)
+    return bool(ok)
+
+
+def _commit(ok, old, new, outputs):
+    pool = Pool(*(_where(ok, n, o) for o, n in zip(old, new)))
+    return [_where(ok, out, 0) for out in outputs], pool
+
+
+def swap_out(pool, amount_in, pool_in, pool_out, min_out):
+    """``Dex.Swap``: the fee-adjusted constant product output."""
+    in_with_fee = amount_in - _div(amount_in, pool.fee_rate)
+    out = _div(in_with_fee * pool_out, pool_in + in_with_fee)
+    ok = _all(amount_in > 0, min_out > 0, pool.fee_rate > 0,
+              pool_in + in_with_fee > 0, out >= min_out)
+    return out, ok
+
+
+def tez_to_token(pool, tez_in, min_tokens_out=1):
+    """``Dex.TezToToken``: sell ``tez_in`` mutez for tokens."""
+    tokens_out, ok = swap_out(pool, tez_in, pool.tez_pool, pool.token_pool,
+                              min_tokens_out)
+    new = pool._replace(tez_pool=pool.tez_pool + tez_in,
+                        token_pool=pool.token_pool - tokens_out)
+    (tokens_out,), pool = _commit(ok, pool, new, [tokens_out])
+    return Swap(out=tokens_out, ok=ok), pool
+
+
+def token_to_tez(pool, tokens_in, min_tez_out=1):
+    """``Dex.TokenToTez``: sell ``tokens_in`` tokens for mutez."""
+    tez_out, ok = swap_out(pool, tokens_in, pool.token_pool, pool.tez_pool,
+                           min_tez_out)
+    new = pool._replace(tez_pool=pool.tez_pool - tez_out,
+                        token_pool=pool.token_pool + tokens_in)
+    (tez_out,), pool = _commit(ok, pool, new, [tez_out])
+    return Swap(out=tez_out, ok=ok), pool
+
+
+def token_to_token_out(pool, tokens_in, min_tokens_out=1):
+    """``Dex.TokenToTokenOut``: the mutez forwarded to the second exchange."""
+    swap, new = token_to_tez(pool, tokens_in)
+    ok = _all(swap.ok, min_tokens_out > 0)
+    (tez_out,), pool = _commit(ok, pool, new, [swap.out])
+    return Swap(out=tez_out, ok=ok), pool
+
+
+def token_to_token(pool_in, pool_out, tokens_in, min_tokens_out=1):
+    """Both legs of ``TokenToTokenSwap``; returns both updated pools."""
+    tez, new_in = token_to_token_out(pool_in, tokens_in, min_tokens_out)
+    tokens, new_out = tez_to_token(pool_out, tez.out, min_tokens_out)
+    ok = _all(tez.ok, tokens.ok)
+    (out,), new_in = _commit(ok, pool_in, new_in, [tokens.out])
+    _, new_out = _commit(ok, pool_out, new_out, [])
+    return Swap(out=out, ok=ok), new_in, new_out
+
+
+def invest_liquidity(pool, amount, min_shares=1):
+    """``Dex.InvestLiquidity`` for ``amount`` mutez."""
+    shares = _div(amount * pool.total_shares, pool.tez_pool)
+    tokens_required = _ceil_div(shares * pool.token_pool, pool.total_shares)
+    ok = _all(amount > 0, min_shares > 0, pool.total_shares > 0,
+              pool.tez_pool > 0, shares >= min_shares)
+    new = pool._replace(tez_pool=pool.tez_pool + amount,
+                        token_pool=pool.token_pool + tokens_required,
+                        total_shares=pool.total_shares + shares)
+    (shares, tokens_required), pool = _commit(ok, pool, new,
+                                              [shares, tokens_required])
+    return Invest(shares=shares, tokens_required=tokens_required, ok=ok), pool
+
+
+def divest_liquidity(pool, share, shares_burned, min_tez=1, min_tokens=1):
+    """``Dex.DivestLiquidity`` by a holder of ``share`` shares."""
+    tez_per_share = _div(pool.tez_pool, pool.total_shares)
+    tokens_per_share = _div(pool.token_pool, pool.total_shares)
+    tez_out = tez_per_share * shares_burned
+    tokens_out = tokens_per_share * shares_burned
+    total_shares = pool.total_shares - shares_burned
+    tez_pool = pool.tez_pool - tez_out
+    token_pool = pool.token_pool - tokens_out
+    ok = _all(shares_burned > 0, shares_burned <= share,
+              pool.total_shares > 0, tez_out >= min_tez,
+              tokens_out >= min_tokens, total_shares >= 0, tez_pool >= 0,
+              token_pool >= 0)
+    new = pool._replace(tez_pool=tez_pool, token_pool=token_pool,
+                        total_shares=total_shares)
+    new_share = abs(share - shares_burned)
+    (tez_out, tokens_out), pool = _commit(ok, pool, new,
+                                          [tez_out, tokens_out])
+    return Divest(share=_where(ok, new_share, share), tez_out=tez_out,
+                  tokens_out=tokens_out, ok=ok), pool
+
+
+# Conformance: replay a random trade sequence through the SmartPy scenario,
+# asserting after every step that the contract storage equals the mirror.
+
+_SCENARIO = '''
+@sp.add_test(name="AMM conformance")
+def test():
+    scenario = sp.test_scenario()
+    admin = sp.test_account("Admin")
+    users = [sp.test_account("User%%d" %% i) for i in range(%(users)d)]
+    token = Token(admin.address, %(supply)d)
+    scenario += token
+    exchange = Dex(%(fee_rate)d, token.address, admin.address,
+                   admin.public_key_hash)
+    scenario += exchange
+    for user in [admin] + users:
+        scenario += token.Transfer(account_from=admin.address,
+                                   destination=user.address,
+                                   value=%(balance)d).run(sender=admin)
+        scenario += token.Approve(spender=exchange.address,
+                                  value=%(balance)d).run(sender=user)
+%(steps)s
+'''
+
+_CHECK = '''    scenario.verify(exchange.data.pool.tezPool == sp.mutez(%d))
+    scenario.verify(exchange.data.pool.tokenPool == %d)
+    scenario.verify(exchange.data.totalShares == %d)'''
+
+
+def conformance_script(seed=0, steps=50, users=3, fee_rate=500):
+    """A SmartPy script whose scenario fails wherever Dex and this mirror
+    disagree."""
+    from tools.smartpy import contract_source
+
+    rng = random.Random(seed)
+    balance = 10 ** 12
+    tez_amount = rng.randint(10 ** 6, 10 ** 9)
+    token_amount = rng.randint(10 ** 6, 10 ** 9)
+    pool = initial_pool(tez_amount, token_amount, fee_rate)
+    shares = {0: 1000}
+    lines = ["    scenario += exchange.InitializeExchange("
+             "candidate=admin.public_key_hash, token_amount=%d)"
+             ".run(sender=admin, amount=sp.mutez(%d))"
+             % (token_amount, tez_amount)]
+    lines.append(_CHECK % pool[:3])
+    names = ["admin"] + ["users[%d]" % i for i in range(users)]
+    for _ in range(steps):
+        who = rng.randrange(users + 1)
+        sender = names[who]
+        kind = rng.choice(["tez", "token", "invest", "divest"])
+        if kind == "tez":
+            amount = rng.randint(1, max(pool.tez_pool, 1))
+            result, pool = tez_to_token(pool, amount)
+            call = ("TezToTokenSwap(minTokensOut=1).run(sender=%s, "
+                    "amount=sp.mutez(%d)" % (sender, amount))
+        elif kind == "token":
+            amount = rng.randint(1, max(pool.token_pool, 1))
+            result, pool = token_to_tez(pool, amount)
+            call = ("TokenToTezSwap(tokensIn=%d, minTezOut=1).run(sender=%s"
+                    % (amount, sender))
+        elif kind == "invest":
+            amount = rng.randint(1, max(pool.tez_pool, 1))
+            result, pool = invest_liquidity(pool, amount)
+            if result.ok:
+                shares[who] = shares.get(who, 0) + result.shares
+            call = ("InvestLiquidity(minShares=1, "
+                    "candidate=admin.public_key_hash)"
+                    ".run(sender=%s, amount=sp.mutez(%d)" % (sender, amount))
+        else:
+            share = shares.get(who, 0)
+            amount = rng.randint(1, share + 2)
+            result, pool = divest_liquidity(pool, share, amount)
+            shares[who] = result.share
+            call = ("DivestLiquidity(sharesBurned=%d, minTez=sp.mutez(1), "
+                    "minTokens=1).run(sender=%s" % (amount, sender))
+        lines.append("    scenario += exchange.%s%s)"
+                     % (call, "" if result.ok else ", valid=False"))
+        lines.append(_CHECK % pool[:3])
+
+    return "\n\n".join(["import smartpy as sp",
+                        contract_source("Token"), contract_source("Dex"),
+                        _SCENARIO % dict(users=users,
+                                         supply=balance * (users + 2),
+                                         fee_rate=fee_rate, balance=balance,
+                                         steps="\n".join(lines))])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dex arithmetic mirror")
+    parser.add_argument("--conformance", action="store_true",
+                        help="check the mirror against the SmartPy scenario")
+    parser.add_argument("--seeds", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=50)
+    args = parser.parse_args(argv)
+    if not args.conformance:
+        parser.print_help()
+        return 0
+
+    from tools import build
+
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="quipuswap-amm-") as out_dir:
+        for seed in range(args.seeds):
+            script = os.path.join(out_dir, "conformance_%d.py" % seed)
+            with open(script, "w") as f:
+                f.write(conformance_script(seed=seed, steps=args.steps))
+            returncode, output = build.test(script)
+            print("seed %d: %s" % (seed, "MISMATCH" if returncode else "ok"))
+            if returncode:
+                failed += 1
+                print(output)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,645 @@
+"""Gas, storage and code size benchmarks for every contract.
+
+Every case originates fresh contracts in a mockup context, replays its setup
+(holders, allowances, listed pairs, pool liquidity) and then measures exactly
+one operation.  Results are written as JSON and compared against
+``benchmarks/baseline.json``; any metric above its baseline, or missing from
+it, fails the run, and so does gas growing along a ``FLAT`` series.  Until a
+baseline has been recorded only the ``FLAT`` series are checked.
+
+    python -m tools.bench                      # run and compare
+    python -m tools.bench --only 'Token\\.'    # subset by regular expression
+    python -m tools.bench --update-baseline    # accept the current numbers
+    python -m tools.bench --compare old.json   # difference with another run
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import sys
+
+from tools import build
+from tools import michelson as m
+from tools.mockup import Mockup, binary_size
+from tools.smartpy import ROOT
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+RESULTS = os.path.join(ROOT, "benchmarks", "results.json")
+
+HOLDERS = (1, 10, 100)
+ALLOWANCES = (1, 10, 100)
+# Burn must stay flat however many spenders the owner approved
+BURN_ALLOWANCES = (1, 10, 100, 1000)
+# series whose gas must not grow with their parameter
+FLAT = {"Token.Burn[allowances=%d]": BURN_ALLOWANCES}
+LISTINGS = (1, 10, 100)
+# tez-to-token plus token-to-tez leg pairs per SwapBatch call
+BATCH_LEGS = (1, 10)
+# destinations per TransferBatch call
+BATCH_SIZES = (1, 10, 100)
+# (mutez, tokens) put into the pool by InitializeExchange
+POOLS = ((10 ** 6, 10 ** 6), (10 ** 10, 10 ** 12))
+SUPPLY = 10 ** 15
+FEE_RATE = 500
+
+_OWNER = m.fake_address("bench:owner")
+_TOKEN = m.fake_address("bench:token")
+_FACTORY = m.fake_address("bench:factory")
+
+CONTRACTS = {
+    "Token": 'Token(sp.address("%s"), %d)' % (_OWNER, SUPPLY),
+    "Dex": 'Dex(%d, sp.address("%s"), sp.address("%s"), sp.key_hash("%s"))'
+           % (FEE_RATE, _TOKEN, _FACTORY, _OWNER),
+    "Factory": "Factory()",
+    "MultiDex": 'MultiDex(%d, sp.key_hash("%s"))' % (FEE_RATE, _OWNER),
+}
+
+Case = collections.namedtuple("Case", "name setup measure")
+
+
+def tez(mutez):
+    return "%d.%06d" % divmod(mutez, 10 ** 6)
+
+
+class Env:
+    """Compiled contracts plus a mockup context to originate them into."""
+
+    def __init__(self, compiled, mockup):
+        self.compiled = compiled
+        self.mockup = mockup
+
+    def addr(self, alias):
+        return m.address(self.mockup.address(alias))
+
+    def originate(self, name, alias, **placeholders):
+        code, storage_path = self.compiled[name]
+        with open(storage_path) as f:
+            storage = f.read().strip()
+        for placeholder, alias_to in placeholders.items():
+            storage = storage.replace(m.string(placeholder),
+                                      self.addr(alias_to))
+        return self.mockup.originate(alias, code, storage)
+
+    def token(self, alias="token"):
+        return self.originate("Token", alias, **{_OWNER: "bootstrap1"})
+
+    def factory(self, alias="factory"):
+        return self.originate("Factory", alias)
+
+    def dex(self, alias="dex", token="token", factory="bootstrap5"):
+        return self.originate("Dex", alias, **{_TOKEN: token,
+                                               _FACTORY: factory,
+                                               _OWNER: "bootstrap1"})
+
+    def multi_dex(self, alias="multi_dex"):
+        return self.originate("MultiDex", alias, **{_OWNER: "bootstrap1"})
+
+    def call(self, alias, entry_point, amount=0, sender="bootstrap1", **arg):
+        return self.mockup.call(alias, entry_point, m.record(**arg),
+                                amount=tez(amount), sender=sender)
+
+    def launch(self, tez_amount=0, tokens=0, dex="dex", token="token"):
+        """Have the Factory originate ``dex`` for ``token``, seeded with
+        ``tokens`` and ``tez_amount`` when given."""
+        if tokens:
+            self.call(token, "Approve", spender=self.addr("factory"),
+                      value=m.nat(tokens))
+        receipt = self.call("factory", "LaunchExchange", amount=tez_amount,
+                            token=self.addr(token),
+                            candidate=self.addr("bootstrap1"),
+                            tokenAmount=m.nat(tokens))
+        self.mockup.remember(dex, receipt)
+        return receipt
+
+    def pool(self, tez_amount, tokens, dex="dex", token="token"):
+        self.call(token, "Approve", spender=self.addr(dex), value=m.nat(SUPPLY))
+        self.call(dex, "InitializeExchange", amount=tez_amount,
+                  candidate=self.addr("bootstrap1"), token_amount=m.nat(tokens))
+
+
+def token_cases():
+    def holders(count):
+        def setup(env):
+            env.token()
+            for i in range(count):
+                env.call("token", "Transfer",
+                         account_from=env.addr("bootstrap1"),
+                         destination=m.address(m.fake_address(("holder", i))),
+                         value=m.nat(1))
+        return setup
+
+    def allowances(count):
+        def setup(env):
+            env.token()
+            for i in range(count - 1):
+                env.call("token", "Approve",
+                         spender=m.address(m.fake_address(("spender", i))),
+                         value=m.nat(10))
+            env.call("token", "Approve",
+                     spender=env.addr("bootstrap2"), value=m.nat(10 ** 6))
+        return setup
+
+    for count in HOLDERS:
+        label = "[holders=%d]" % count
+        yield Case("Token.Transfer" + label, holders(count),
+                   lambda env: env.call(
+                       "token", "Transfer",
+                       account_from=env.addr("bootstrap1"),
+                       destination=m.address(m.fake_address("fresh")),
+                       value=m.nat(1)))
+
+        def emptied(env, count=count):
+            holders(count)(env)
+            env.call("token", "Transfer", account_from=env.addr("bootstrap1"),
+                     destination=env.addr("bootstrap2"), value=m.nat(1))
+        # the sender sends its whole balance and its ledger entry is deleted:
+        # compare storage_size with Token.Transfer[holders=...]
+        yield Case("Token.Transfer%s[all]" % label, emptied,
+                   lambda env: env.call(
+                       "token", "Transfer", sender="bootstrap2",
+                       account_from=env.addr("bootstrap2"),
+                       destination=m.address(m.fake_address("fresh")),
+                       value=m.nat(1)))
+
+        yield Case("Token.Mint" + label, holders(count),
+                   lambda env: env.call("token", "Mint", value=m.nat(1)))
+
+        def balance(env):
+            env.mockup.sink("sink", "nat")
+            return env.call("token", "GetBalance",
+                            account_from=env.addr("bootstrap1"),
+                            contr=env.addr("sink"))
+        yield Case("Token.GetBalance" + label, holders(count), balance)
+
+        def balances(env, count=count):
+            env.mockup.sink("sink", "(map address nat)")
+            return env.call("token", "GetBalances", contr=env.addr("sink"),
+                            accounts=m.seq([
+                                m.address(m.fake_address(("holder", i)))
+                                for i in range(count)]))
+        yield Case("Token.GetBalances" + label, holders(count), balances)
+
+    for size in BATCH_SIZES:
+        yield Case("Token.TransferBatch[transfers=%d]" % size, holders(1),
+                   lambda env, size=size: env.call(
+                       "token", "TransferBatch", transfers=m.seq([m.record(
+                           account_from=env.addr("bootstrap1"),
+                           txs=m.seq([m.record(
+                               destination=m.address(
+                                   m.fake_address(("payee", i))),
+                               value=m.nat(1)) for i in range(size)]))])))
+
+    def burnt(count):
+        # a burn large enough to cut every allowance to 0
+        def setup(env):
+            allowances(count)(env)
+            env.call("token", "Burn", value=m.nat(10 ** 6 * count))
+        return setup
+
+    def spenders(env, count):
+        return [m.address(m.fake_address(("spender", i)))
+                for i in range(count - 1)] + [env.addr("bootstrap2")]
+
+    for count in BURN_ALLOWANCES:
+        yield Case("Token.Burn[allowances=%d]" % count, allowances(count),
+                   lambda env: env.call("token", "Burn", value=m.nat(1)))
+        yield Case("Token.Cleanup[allowances=%d]" % count, burnt(count),
+                   lambda env, count=count: env.call(
+                       "token", "Cleanup", accounts=m.seq([]),
+                       allowances=m.seq([
+                           m.pair(env.addr("bootstrap1"), spender)
+                           for spender in spenders(env, count)])))
+
+    for count in ALLOWANCES:
+        label = "[allowances=%d]" % count
+        yield Case("Token.TransferFrom" + label, allowances(count),
+                   lambda env: env.call(
+                       "token", "Transfer", sender="bootstrap2",
+                       account_from=env.addr("bootstrap1"),
+                       destination=env.addr("bootstrap3"), value=m.nat(1)))
+
+        def operator(env, count=count):
+            allowances(count)(env)
+            add_operator(env, "bootstrap3")
+        # an operator transfer only looks its key up
+        yield Case("Token.TransferFrom%s[operator]" % label, operator,
+                   lambda env: env.call(
+                       "token", "Transfer", sender="bootstrap3",
+                       account_from=env.addr("bootstrap1"),
+                       destination=env.addr("bootstrap2"), value=m.nat(1)))
+        yield Case("Token.Approve" + label, allowances(count),
+                   lambda env: env.call(
+                       "token", "Approve",
+                       spender=m.address(m.fake_address("fresh")),
+                       value=m.nat(1)))
+
+        def allowance(env):
+            env.mockup.sink("sink", "nat")
+            return env.call("token", "GetAllowance",
+                            owner=env.addr("bootstrap1"),
+                            spender=env.addr("bootstrap2"),
+                            contr=env.addr("sink"))
+        yield Case("Token.GetAllowance" + label, allowances(count), allowance)
+
+
+# the Dex.OnTokenTransfer action variant, packed in TransferAndCall data
+ACTIONS = ("InvestLiquidity", "TokenToTez", "TokenToToken")
+ACTION_TYPE = ("(or (pair key_hash nat)"
+               " (or (pair nat address) (pair nat (pair address address))))")
+
+
+def transfer_and_call(env, value, action, amount=0, token="token",
+                      dex="dex", **arg):
+    """Sell ``value`` tokens to ``dex`` in one Token.TransferAndCall."""
+    data = env.mockup.pack(m.variant(action, m.record(**arg), ACTIONS),
+                           ACTION_TYPE)
+    return env.call(token, "TransferAndCall", amount=amount,
+                    destination=env.addr(dex), value=m.nat(value), data=data)
+
+
+def add_operator(env, operator, token="token", owner="bootstrap1"):
+    return env.call(token, "UpdateOperators", sender=owner,
+                    updates=m.seq([m.variant(
+                        "add_operator",
+                        m.record(owner=env.addr(owner),
+                                 operator=env.addr(operator)),
+                        ("add_operator", "remove_operator"))]))
+
+
+def swap_legs(env, i, tez_in, tokens_in):
+    """One tez-to-token and one token-to-tez leg paying bootstrap2..4."""
+    recipient = env.addr("bootstrap%d" % (2 + i % 3))
+    return [m.record(amount=m.nat(tez_in), minOut=m.nat(1),
+                     recipient=recipient, tezToToken="True"),
+            m.record(amount=m.nat(tokens_in), minOut=m.nat(1),
+                     recipient=recipient, tezToToken="False")]
+
+
+def dex_cases():
+    def pool(tez_amount, tokens, listed=False, cached=False):
+        def setup(env):
+            env.token()
+            if listed:
+                env.factory()
+                env.launch(tez_amount, tokens)
+                env.token("token_out")
+                env.launch(tez_amount, tokens, dex="dex_out",
+                           token="token_out")
+            else:
+                env.dex()
+                env.pool(tez_amount, tokens)
+            if cached:
+                env.call("dex", "RegisterExchange",
+                         token=env.addr("token_out"))
+        return setup
+
+    def initialize(env):
+        env.token()
+        env.dex()
+        env.call("token", "Approve", spender=env.addr("dex"),
+                 value=m.nat(SUPPLY))
+
+    def view(entry_point, result_type, **arg):
+        def measure(env):
+            env.mockup.sink("sink", result_type)
+            return env.call("dex", entry_point, contr=env.addr("sink"), **arg)
+        return measure
+
+    for tez_amount, tokens in POOLS:
+        label = "[pool=%s/%d]" % (tez(tez_amount), tokens)
+        tez_in = max(tez_amount // 100, 2)
+        tokens_in = max(tokens // 100, 2)
+        yield Case("Dex.InitializeExchange" + label, initialize,
+                   lambda env, tez_amount=tez_amount, tokens=tokens:
+                   env.call("dex", "InitializeExchange", amount=tez_amount,
+                            candidate=env.addr("bootstrap1"),
+                            token_amount=m.nat(tokens)))
+        setup = pool(tez_amount, tokens)
+        yield Case("Dex.TezToTokenSwap" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "dex", "TezToTokenSwap", amount=tez_in,
+                       minTokensOut=m.nat(1)))
+        yield Case("Dex.TezToTokenPayment" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "dex", "TezToTokenPayment", amount=tez_in,
+                       minTokensOut=m.nat(1),
+                       recipient=env.addr("bootstrap2")))
+        # the second leg of a token-to-token swap routed by the Factory
+        yield Case("Dex.TokenToTokenIn" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "dex", "TokenToTokenIn", amount=tez_in,
+                       sender="bootstrap5", minTokensOut=m.nat(1),
+                       recipient=env.addr("bootstrap2")))
+        yield Case("Dex.TokenToTezSwap" + label, setup,
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "dex", "TokenToTezSwap",
+                       minTezOut=m.nat(1), tokensIn=m.nat(tokens_in)))
+        yield Case("Dex.TokenToTezPayment" + label, setup,
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "dex", "TokenToTezPayment",
+                       minTezOut=m.nat(1), recipient=env.addr("bootstrap2"),
+                       tokensIn=m.nat(tokens_in)))
+        def operator(env, setup=setup):
+            setup(env)
+            add_operator(env, "dex")
+        yield Case("Dex.TokenToTezSwap%s[operator]" % label, operator,
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "dex", "TokenToTezSwap",
+                       minTezOut=m.nat(1), tokensIn=m.nat(tokens_in)))
+        # approve-and-swap collapsed into one operation, no allowance write
+        yield Case("Dex.TokenToTezSwap%s[transferAndCall]" % label, setup,
+                   lambda env, tokens_in=tokens_in: transfer_and_call(
+                       env, tokens_in, "TokenToTez", minTezOut=m.nat(1),
+                       recipient=env.addr("bootstrap1")))
+        yield Case("Dex.InvestLiquidity%s[transferAndCall]" % label, setup,
+                   lambda env, tez_in=tez_in, tokens_in=tokens_in:
+                   transfer_and_call(
+                       # twice what is required: the change is sent back
+                       env, 2 * tokens_in, "InvestLiquidity", amount=tez_in,
+                       candidate=env.addr("bootstrap1"), minShares=m.nat(1)))
+        yield Case("Dex.InvestLiquidity" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "dex", "InvestLiquidity", amount=tez_in,
+                       candidate=env.addr("bootstrap1"),
+                       minShares=m.nat(1)))
+        yield Case("Dex.DivestLiquidity" + label, setup,
+                   lambda env: env.call(
+                       "dex", "DivestLiquidity", minTez=m.nat(1),
+                       minTokens=m.nat(1), sharesBurned=m.nat(1)))
+        # the last holder leaves: shares, candidates and votes are freed
+        yield Case("Dex.DivestLiquidity%s[all]" % label, setup,
+                   lambda env: env.call(
+                       "dex", "DivestLiquidity", minTez=m.nat(1),
+                       minTokens=m.nat(1), sharesBurned=m.nat(1000)))
+        for legs in BATCH_LEGS:
+            yield Case("Dex.SwapBatch%s[legs=%d]" % (label, legs), setup,
+                       lambda env, legs=legs, tez_in=tez_in,
+                       tokens_in=tokens_in: env.call(
+                           "dex", "SwapBatch", amount=tez_in * legs,
+                           swaps=m.seq([leg
+                                        for i in range(legs)
+                                        for leg in swap_legs(env, i, tez_in,
+                                                             tokens_in)])))
+        yield Case("Dex.GetReserves" + label, setup,
+                   view("GetReserves", "(pair (pair nat mutez) (pair nat nat))"))
+        yield Case("Dex.GetTezToTokenQuote" + label, setup,
+                   view("GetTezToTokenQuote", "nat", tezIn=m.nat(tez_in)))
+        yield Case("Dex.GetTokenToTezQuote" + label, setup,
+                   view("GetTokenToTezQuote", "mutez",
+                        tokensIn=m.nat(tokens_in)))
+        for cached in (False, True):
+            yield Case("Dex.TokenToTokenSwap%s[cached=%s]" % (label, cached),
+                       pool(tez_amount, tokens, listed=True, cached=cached),
+                       lambda env, tokens_in=tokens_in: env.call(
+                           "dex", "TokenToTokenSwap", minTokensOut=m.nat(1),
+                           tokenOutAddress=env.addr("token_out"),
+                           tokensIn=m.nat(tokens_in)))
+        yield Case("Dex.TokenToTokenPayment%s[cached=True]" % label,
+                   pool(tez_amount, tokens, listed=True, cached=True),
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "dex", "TokenToTokenPayment", minTokensOut=m.nat(1),
+                       recipient=env.addr("bootstrap2"),
+                       tokenOutAddress=env.addr("token_out"),
+                       tokensIn=m.nat(tokens_in)))
+        yield Case("Dex.TokenToTokenSwap%s[transferAndCall]" % label,
+                   pool(tez_amount, tokens, listed=True, cached=True),
+                   lambda env, tokens_in=tokens_in: transfer_and_call(
+                       env, tokens_in, "TokenToToken", minTokensOut=m.nat(1),
+                       recipient=env.addr("bootstrap1"),
+                       tokenOutAddress=env.addr("token_out")))
+
+
+def multi_dex_cases():
+    def pools(tez_amount, tokens):
+        def setup(env):
+            env.multi_dex()
+            for token in ("token", "token_out"):
+                env.token(token)
+                env.call(token, "Approve", spender=env.addr("multi_dex"),
+                         value=m.nat(SUPPLY))
+                env.call("multi_dex", "InitializeExchange",
+                         amount=tez_amount, token=env.addr(token),
+                         candidate=env.addr("bootstrap1"),
+                         token_amount=m.nat(tokens))
+        return setup
+
+    for tez_amount, tokens in POOLS:
+        label = "[pool=%s/%d]" % (tez(tez_amount), tokens)
+        tez_in = max(tez_amount // 100, 2)
+        tokens_in = max(tokens // 100, 2)
+        setup = pools(tez_amount, tokens)
+        yield Case("MultiDex.TezToTokenSwap" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "multi_dex", "TezToTokenSwap", amount=tez_in,
+                       token=env.addr("token"), minTokensOut=m.nat(1)))
+        yield Case("MultiDex.TokenToTezSwap" + label, setup,
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "multi_dex", "TokenToTezSwap",
+                       token=env.addr("token"), minTezOut=m.nat(1),
+                       tokensIn=m.nat(tokens_in)))
+        # compare with Dex.TokenToTokenSwap[...][cached=True]
+        yield Case("MultiDex.TokenToTokenSwap" + label, setup,
+                   lambda env, tokens_in=tokens_in: env.call(
+                       "multi_dex", "TokenToTokenSwap",
+                       token=env.addr("token"), minTokensOut=m.nat(1),
+                       tokenOutAddress=env.addr("token_out"),
+                       tokensIn=m.nat(tokens_in)))
+        yield Case("MultiDex.InvestLiquidity" + label, setup,
+                   lambda env, tez_in=tez_in: env.call(
+                       "multi_dex", "InvestLiquidity", amount=tez_in,
+                       token=env.addr("token"),
+                       candidate=env.addr("bootstrap1"),
+                       minShares=m.nat(1)))
+        yield Case("MultiDex.DivestLiquidity" + label, setup,
+                   lambda env: env.call(
+                       "multi_dex", "DivestLiquidity",
+                       token=env.addr("token"), minTez=m.nat(1),
+                       minTokens=m.nat(1), sharesBurned=m.nat(1)))
+
+
+def factory_cases():
+    def listings(count):
+        def setup(env):
+            env.factory()
+            for i in range(count):
+                env.call("factory", "LaunchExchange",
+                         token=m.address(m.fake_address(("token", i))),
+                         candidate=env.addr("bootstrap1"),
+                         tokenAmount=m.nat(0))
+        return setup
+
+    def seeded(env):
+        listings(1)(env)
+        env.token()
+
+    for count in LISTINGS:
+        label = "[listings=%d]" % count
+        yield Case("Factory.LaunchExchange" + label, listings(count),
+                   lambda env: env.call(
+                       "factory", "LaunchExchange",
+                       token=m.address(m.fake_address("fresh token")),
+                       candidate=env.addr("bootstrap1"),
+                       tokenAmount=m.nat(0)))
+
+        def token_list(env):
+            env.mockup.sink("sink", "(list address)")
+            return env.call("factory", "GetTokenList", contr=env.addr("sink"),
+                            limit=m.nat(100), offset=m.nat(0))
+        yield Case("Factory.GetTokenList" + label, listings(count), token_list)
+
+    # origination, registration and InitializeExchange in one operation
+    for tez_amount, tokens in POOLS:
+        yield Case("Factory.LaunchExchange[pool=%s/%d]"
+                   % (tez(tez_amount), tokens), seeded,
+                   lambda env, tez_amount=tez_amount, tokens=tokens:
+                   env.launch(tez_amount, tokens))
+
+
+def all_cases():
+    for cases in (token_cases, dex_cases, multi_dex_cases, factory_cases):
+        for case in cases():
+            yield case
+
+
+def compile_all():
+    """Compiled contracts, reused from the build cache when unchanged."""
+    return {name: build.contract(name, class_call)
+            for name, class_call in CONTRACTS.items()}
+
+
+def code_sizes(compiled):
+    sizes = {}
+    for name, (code, _) in compiled.items():
+        with open(code) as f:
+            sizes[name] = binary_size("script", f.read())
+    return sizes
+
+
+def run_case(compiled, case):
+    with Mockup() as mockup:
+        env = Env(compiled, mockup)
+        case.setup(env)
+        receipt = case.measure(env)
+    # storage_size is what the called contract stores afterwards, big_maps
+    # included: deleted keys show up there, never in the paid storage
+    return {"gas": receipt.gas, "storage_bytes": receipt.paid_storage,
+            "storage_size": receipt.storage_size}
+
+
+def flatten(results):
+    flat = {"%s.code_size" % name: size
+            for name, size in results["code_size"].items()}
+    for name, metrics in results["cases"].items():
+        for metric, value in metrics.items():
+            flat["%s.%s" % (name, metric)] = value
+    return flat
+
+
+def regressions(results, baseline, tolerance):
+    # a metric the baseline lacks is reported with None as its baseline
+    current, previous = flatten(results), flatten(baseline)
+    return [(key, previous.get(key), value)
+            for key, value in sorted(current.items())
+            if key not in previous or
+            value > previous[key] * (1 + tolerance)]
+
+
+def growth(results, tolerance):
+    """``(series, least gas, most gas)`` of every ``FLAT`` series whose gas
+    grows with its parameter."""
+    grown = []
+    for pattern, values in sorted(FLAT.items()):
+        gas = [results["cases"][pattern % value]["gas"] for value in values
+               if pattern % value in results["cases"]]
+        if len(gas) > 1 and max(gas) > min(gas) * (1 + tolerance):
+            grown.append((pattern.replace("%d", "*"), min(gas), max(gas)))
+    return grown
+
+
+def comparison(results, other):
+    """``(key, other, current)`` for every metric measured by both runs."""
+    current, before = flatten(results), flatten(other)
+    return [(key, before[key], value)
+            for key, value in sorted(current.items()) if key in before]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", default="",
+                        help="regular expression selecting case names")
+    parser.add_argument("--output", default=RESULTS)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="allowed relative increase, e.g. 0.01 for 1%%")
+    parser.add_argument("--code-size", action="store_true",
+                        help="only compile and report code sizes")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help="results of another run, e.g. of an older "
+                             "revision, to print the difference with "
+                             "instead of checking the baseline")
+    args = parser.parse_args(argv)
+
+    compiled = compile_all()
+    results = {"code_size": code_sizes(compiled), "cases": {}}
+    for name, size in sorted(results["code_size"].items()):
+        print("%-48s code %8d bytes" % (name, size))
+    if not args.code_size:
+        only = re.compile(args.only)
+        for case in all_cases():
+            if only.search(case.name):
+                metrics = run_case(compiled, case)
+                results["cases"][case.name] = metrics
+                print("%-48s gas %12.3f storage %6d bytes size %8d bytes"
+                      % (case.name, metrics["gas"], metrics["storage_bytes"],
+                         metrics["storage_size"]))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            other = json.load(f)
+        for key, before, after in comparison(results, other):
+            print("%-56s %12s -> %12s %+7.1f%%"
+                  % (key, before, after,
+                     100.0 * (after - before) / before if before else 0))
+        return 0
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.update_baseline:
+        baseline = baseline or {"code_size": {}, "cases": {}}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)),
+                    exist_ok=True)
+        for section in baseline:
+            baseline[section].update(results[section])
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    failed = []
+    if baseline is None:
+        # an empty baseline would fail every case as missing
+        print("NO BASELINE %s: record one with --update-baseline"
+              % args.baseline)
+    else:
+        failed = regressions(results, baseline, args.tolerance)
+    for key, before, after in failed:
+        if before is None:
+            print("MISSING %s: %s, not in the baseline" % (key, after))
+        else:
+            print("REGRESSION %s: %s -> %s" % (key, before, after))
+    grown = growth(results, args.tolerance)
+    for series, least, most in grown:
+        print("NOT FLAT %s: gas %s -> %s" % (series, least, most))
+    return 1 if failed or grown else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
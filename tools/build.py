@@ -0,0 +1,115 @@
+"""Content-addressed cache of SmartPy compilation and test outputs.
+
+A contract is compiled from its class block alone (``contract_source``), so
+the copies in ``contracts/all_with_tests.py`` and ``contracts/<Name>.py``
+share one entry.  The key is the hash of that source, of the scripts it
+imports (Factory embeds the Dex code), the constructor call and the SmartPy
+installation; anything unchanged is reused by tests, benchmarks and
+deployments alike.  The command prints the paths of the code and of the
+initial storage, ready for ``tezos-client originate``:
+
+    python -m tools.build Token 'Token(sp.address("tz1..."), 1000)'
+
+Entries live in ``.build/`` (or ``$QUIPUSWAP_BUILD``); ``--clean`` empties it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from tools.smartpy import (ROOT, SMARTPY, compile_contract, contract_source,
+                           file_imports, imports, outputs, test_script)
+
+BUILD = os.environ.get("QUIPUSWAP_BUILD", os.path.join(ROOT, ".build"))
+
+
+def _key(*parts):
+    digest = hashlib.sha256()
+    for part in (os.path.realpath(SMARTPY),) + parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def _publish(tmp, entry):
+    # Entries appear atomically, so concurrent builds never see half of one.
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        if not os.path.isdir(entry):
+            raise
+        shutil.rmtree(tmp)
+
+
+def _sources(paths):
+    # ``file:`` imports resolve from the repository root
+    for path in paths:
+        with open(os.path.join(ROOT, path)) as f:
+            yield f.read()
+
+
+def contract(name, class_call):
+    """``Compiled`` outputs of ``class_call``, compiled at most once."""
+    header, dependencies = imports(name)
+    script = header + contract_source(name)
+    entry = os.path.join(BUILD, "contract",
+                         _key(script, class_call, *_sources(dependencies)))
+    if not os.path.isdir(entry):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        try:
+            with open(os.path.join(tmp, name + ".py"), "w") as f:
+                f.write(script)
+            compile_contract(os.path.join(tmp, name + ".py"), class_call,
+                             os.path.join(tmp, "out"))
+        except BaseException:
+            shutil.rmtree(tmp)
+            raise
+        _publish(tmp, entry)
+    return outputs(os.path.join(entry, "out"))
+
+
+def test(script):
+    """``(returncode, output)`` of the scenarios of ``script``, cached on its
+    contents."""
+    with open(script) as f:
+        source = f.read()
+    entry = os.path.join(BUILD, "test",
+                         _key(source, *_sources(file_imports(source))))
+    if not os.path.isdir(entry):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry))
+        result = test_script(os.path.abspath(script), os.path.join(tmp, "out"))
+        if result.returncode:
+            # failures are not cached, the next run tries again
+            shutil.rmtree(tmp)
+            return result.returncode, result.stdout
+        with open(os.path.join(tmp, "result.json"), "w") as f:
+            json.dump({"returncode": 0, "output": result.stdout}, f)
+        _publish(tmp, entry)
+    with open(os.path.join(entry, "result.json")) as f:
+        result = json.load(f)
+    return result["returncode"], result["output"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("name", nargs="?", help="contract class, e.g. Dex")
+    parser.add_argument("class_call", nargs="?",
+                        help="constructor call, e.g. 'Factory()'")
+    parser.add_argument("--clean", action="store_true")
+    args = parser.parse_args(argv)
+    if args.clean:
+        shutil.rmtree(BUILD, ignore_errors=True)
+    if args.name:
+        compiled = contract(args.name, args.class_call or args.name + "()")
+        print(compiled.code)
+        print(compiled.storage)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
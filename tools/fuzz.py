@@ -0,0 +1,378 @@
+"""Stateful fuzzer for the Dex pool invariants.
+
+Random sequences of ``InitializeExchange``, swaps, ``InvestLiquidity`` and
+``DivestLiquidity`` from several accounts run against ``tools.amm`` (the
+Python mirror of the Dex arithmetic) and a stand-in Token ledger.  The
+random runs never touch the contracts: they find bugs in the mirror, and
+so in Dex only as far as the mirror matches it.  After every operation
+that the mirror accepts, the fuzzer checks:
+
+``conservation``
+    ``tezPool`` and ``tokenPool`` equal the tez and tokens the Dex holds,
+    apart from what a previous pool left behind when it was emptied;
+``invariant``
+    the constant product ``tezPool * tokenPool`` per share squared never
+    decreases;
+``shares``
+    the holders' shares add up to ``totalShares``.
+
+A failing sequence is minimized and saved to the corpus, which is replayed
+before every run so fixed bugs stay fixed:
+
+    python -m tools.fuzz                       # 200 sequences of 500 steps
+    python -m tools.fuzz --runs 0              # replay the corpus only
+
+Only ``--scenario`` runs the contracts.  It replays the corpus, not new
+random sequences: every entry becomes a SmartPy scenario on Token and Dex
+that checks their storage against the model after every operation.
+
+    python -m tools.fuzz --scenario            # the corpus, in SmartPy
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from tools import amm
+from tools.smartpy import ROOT
+
+CORPUS = os.path.join(ROOT, "fuzz", "corpus")
+
+DEX = "dex"
+FEE_RATE = 500
+BALANCE = 10 ** 12
+# InitializeExchange accepts 1 < amount < 500000000 tez
+MAX_TEZ = 500000000 * 10 ** 6
+
+
+class Violation(Exception):
+    def __init__(self, prop, message):
+        super().__init__("%s: %s" % (prop, message))
+        self.prop = prop
+
+
+class Model:
+    """Dex storage plus the tez and tokens it actually holds."""
+
+    def __init__(self, accounts, fee_rate=FEE_RATE):
+        self.pool = amm.Pool(tez_pool=0, token_pool=0, total_shares=0,
+                             fee_rate=fee_rate)
+        self.shares = {}
+        self.tokens = {account: BALANCE for account in range(accounts)}
+        self.tokens[DEX] = 0
+        self.tez = 0
+        # what the pool still held when it was emptied and initialized again
+        self.stranded = (0, 0)
+
+    def _transfer(self, account_from, destination, value):
+        # Token.Transfer fails, and the whole operation with it, on a low
+        # balance; the new balances are applied only once every leg passed.
+        if self.tokens.get(account_from, 0) < value:
+            return False
+        self.tokens[account_from] -= value
+        self.tokens[destination] = self.tokens.get(destination, 0) + value
+        return True
+
+    def apply(self, op):
+        """Run ``op``; False where the Dex would reject it."""
+        kind, who, *amounts = op
+        pool = self.pool
+        if kind == "init":
+            tez_amount, token_amount = amounts
+            if (pool.total_shares or
+                    not 1 < tez_amount < MAX_TEZ or token_amount <= 10 or
+                    not self._transfer(who, DEX, token_amount)):
+                return False
+            self.stranded = (self.stranded[0] + pool.tez_pool,
+                             self.stranded[1] + pool.token_pool)
+            self.tez += tez_amount
+            self.pool = amm.initial_pool(tez_amount, token_amount,
+                                         pool.fee_rate)
+            self.shares[who] = self.pool.total_shares
+            return True
+
+        (amount,) = amounts
+        if kind == "tez":
+            swap, new = amm.tez_to_token(pool, amount)
+            if not swap.ok or not self._transfer(DEX, who, swap.out):
+                return False
+            self.tez += amount
+        elif kind == "token":
+            swap, new = amm.token_to_tez(pool, amount)
+            if not swap.ok or not self._transfer(who, DEX, amount):
+                return False
+            self.tez -= swap.out
+        elif kind == "invest":
+            invest, new = amm.invest_liquidity(pool, amount)
+            if (not invest.ok or
+                    not self._transfer(who, DEX, invest.tokens_required)):
+                return False
+            self.tez += amount
+            self.shares[who] = self.shares.get(who, 0) + invest.shares
+        elif kind == "divest":
+            divest, new = amm.divest_liquidity(
+                pool, self.shares.get(who, 0), amount)
+            if not divest.ok or not self._transfer(DEX, who,
+                                                   divest.tokens_out):
+                return False
+            self.tez -= divest.tez_out
+            self.shares[who] = divest.share
+        else:
+            raise ValueError("unknown operation %r" % kind)
+        self.pool = new
+        return True
+
+    def check(self, before):
+        pool = self.pool
+        tez_held = pool.tez_pool + self.stranded[0]
+        tokens_held = pool.token_pool + self.stranded[1]
+        if (self.tez, self.tokens[DEX]) != (tez_held, tokens_held):
+            raise Violation("conservation",
+                            "pool %d mutez, %d tokens; held %d, %d" %
+                            (tez_held, tokens_held, self.tez,
+                             self.tokens[DEX]))
+        if before.total_shares and pool.total_shares:
+            # k / shares**2 is the squared value of one share
+            if (pool.tez_pool * pool.token_pool * before.total_shares ** 2 <
+                    before.tez_pool * before.token_pool *
+                    pool.total_shares ** 2):
+                raise Violation("invariant", "%s -> %s" % (before, pool))
+        if sum(self.shares.values()) != pool.total_shares:
+            raise Violation("shares", "holders %d, totalShares %d" %
+                            (sum(self.shares.values()), pool.total_shares))
+
+
+def replay(ops, accounts):
+    """Run ``ops``; the ``Violation`` they trigger, if any."""
+    model = Model(accounts)
+    for op in ops:
+        before = model.pool
+        if model.apply(op):
+            try:
+                model.check(before)
+            except Violation as violation:
+                return violation
+    return None
+
+
+# The contracts replay: each operation as a scenario call, valid exactly
+# where the model accepts it, then the storage the model expects.
+
+_SCENARIO = '''
+@sp.add_test(name="Fuzz corpus %(name)s")
+def test():
+    scenario = sp.test_scenario()
+    admin = sp.test_account("Admin")
+    users = [sp.test_account("User%%d" %% i) for i in range(%(accounts)d)]
+    token = Token(admin.address, %(supply)d)
+    scenario += token
+    exchange = Dex(%(fee_rate)d, token.address, admin.address,
+                   admin.public_key_hash)
+    scenario += exchange
+    for user in users:
+        scenario += token.Transfer(account_from=admin.address,
+                                   destination=user.address,
+                                   value=%(balance)d).run(sender=admin)
+        scenario += token.Approve(spender=exchange.address,
+                                  value=%(supply)d).run(sender=user)
+%(steps)s
+'''
+
+_CALLS = {
+    "init": "InitializeExchange(candidate=admin.public_key_hash, "
+            "token_amount={1}).run(sender=users[{who}], "
+            "amount=sp.mutez({0})",
+    "tez": "TezToTokenSwap(minTokensOut=1).run(sender=users[{who}], "
+           "amount=sp.mutez({0})",
+    "token": "TokenToTezSwap(tokensIn={0}, minTezOut=1)"
+             ".run(sender=users[{who}]",
+    "invest": "InvestLiquidity(minShares=1, candidate=admin.public_key_hash)"
+              ".run(sender=users[{who}], amount=sp.mutez({0})",
+    "divest": "DivestLiquidity(sharesBurned={0}, minTez=sp.mutez(1), "
+              "minTokens=1).run(sender=users[{who}]",
+}
+
+_CHECK = '''    scenario.verify(exchange.data.pool.tezPool == sp.mutez(%d))
+    scenario.verify(exchange.data.pool.tokenPool == %d)
+    scenario.verify(exchange.data.totalShares == %d)
+    scenario.verify(exchange.balance == sp.mutez(%d))
+    scenario.verify(token.data.ledger.get(exchange.address, 0) == %d)'''
+
+_SHARES = ('    scenario.verify(exchange.data.shares.get(users[%d].address, 0)'
+           ' == %d)')
+
+
+def scenario_script(name, accounts, ops):
+    """A SmartPy script replaying ``ops`` through Token and Dex; its
+    scenario fails wherever the contracts and the model disagree."""
+    from tools.smartpy import contract_source
+
+    model = Model(accounts)
+    lines = []
+    for kind, who, *amounts in ops:
+        ok = model.apply((kind, who, *amounts))
+        lines.append("    scenario += exchange.%s%s)"
+                     % (_CALLS[kind].format(*amounts, who=who),
+                        "" if ok else ", valid=False"))
+        lines.append(_CHECK % (model.pool.tez_pool, model.pool.token_pool,
+                               model.pool.total_shares, model.tez,
+                               model.tokens[DEX]))
+        lines.extend(_SHARES % (account, model.shares.get(account, 0))
+                     for account in range(accounts))
+    return "\n\n".join(["import smartpy as sp",
+                        contract_source("Token"), contract_source("Dex"),
+                        _SCENARIO % dict(name=name, accounts=accounts,
+                                         supply=BALANCE * accounts,
+                                         fee_rate=FEE_RATE, balance=BALANCE,
+                                         steps="\n".join(lines))])
+
+
+def replay_scenarios(corpus):
+    """Run every corpus entry as a SmartPy scenario; the number failing."""
+    from tools import build
+
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix="quipuswap-fuzz-") as out_dir:
+        for name, accounts, ops in load_corpus(corpus):
+            script = os.path.join(out_dir, name[:-len(".json")] + ".py")
+            with open(script, "w") as f:
+                f.write(scenario_script(name, accounts, ops))
+            returncode, output = build.test(script)
+            print("corpus %s: %s" % (name, "MISMATCH" if returncode else "ok"))
+            if returncode:
+                failed += 1
+                print(output)
+    return failed
+
+
+def _amount(rng, scale):
+    # edge values first: 0, 1, just above the fee threshold, pool sized
+    choice = rng.random()
+    if choice < 0.1:
+        return rng.randint(0, 3)
+    if choice < 0.2:
+        return rng.randint(FEE_RATE - 2, FEE_RATE + 2)
+    return rng.randint(1, max(2, scale * rng.choice((1, 2, 10)) //
+                                 rng.choice((1, 10, 1000))))
+
+
+def generate(rng, steps, accounts):
+    model = Model(accounts)
+    ops = []
+    for _ in range(steps):
+        who = rng.randrange(accounts)
+        pool = model.pool
+        kind = rng.choice(("tez", "token", "invest", "divest", "divest")
+                          if pool.total_shares else ("init",) * 3 + ("tez",))
+        if kind == "init":
+            op = (kind, who, _amount(rng, 10 ** 9), _amount(rng, 10 ** 9))
+        elif kind == "divest":
+            op = (kind, who, _amount(rng, model.shares.get(who, 0) + 1))
+        else:
+            op = (kind, who, _amount(rng, pool.token_pool if kind == "token"
+                                     else pool.tez_pool))
+        model.apply(op)
+        ops.append(op)
+    return ops
+
+
+def minimize(ops, accounts, prop):
+    """Delta debugging: drop chunks of ``ops`` while ``prop`` still fails."""
+    def fails(candidate):
+        violation = replay(candidate, accounts)
+        return violation is not None and violation.prop == prop
+
+    chunk = len(ops) // 2
+    while chunk:
+        start = 0
+        while start < len(ops):
+            candidate = ops[:start] + ops[start + chunk:]
+            if fails(candidate):
+                ops = candidate
+            else:
+                start += chunk
+        chunk //= 2
+    # then shrink every amount towards 1
+    for i, (kind, who, *amounts) in enumerate(ops):
+        for j in range(len(amounts)):
+            low, high = 1, amounts[j]
+            while low < high:
+                middle = (low + high) // 2
+                shrunk = list(amounts)
+                shrunk[j] = middle
+                candidate = ops[:i] + [(kind, who, *shrunk)] + ops[i + 1:]
+                if fails(candidate):
+                    high = middle
+                    amounts, ops = shrunk, candidate
+                else:
+                    low = middle + 1
+    return ops
+
+
+def save(corpus, accounts, violation, ops):
+    os.makedirs(corpus, exist_ok=True)
+    entry = {"property": violation.prop, "accounts": accounts,
+             "ops": [list(op) for op in ops]}
+    text = json.dumps(entry, indent=1) + "\n"
+    path = os.path.join(corpus, hashlib.sha1(text.encode()).hexdigest()[:12]
+                        + ".json")
+    with open(path, "w") as f:
+        f.write(text)
+    return path
+
+
+def load_corpus(corpus):
+    if not os.path.isdir(corpus):
+        return
+    for name in sorted(os.listdir(corpus)):
+        if name.endswith(".json"):
+            with open(os.path.join(corpus, name)) as f:
+                entry = json.load(f)
+            yield name, entry["accounts"], [tuple(op) for op in entry["ops"]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--accounts", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--scenario", action="store_true",
+                        help="replay the corpus through the SmartPy "
+                             "scenario of Token and Dex")
+    args = parser.parse_args(argv)
+    if args.scenario:
+        return 1 if replay_scenarios(args.corpus) else 0
+
+    failed = 0
+    for name, accounts, ops in load_corpus(args.corpus):
+        violation = replay(ops, accounts)
+        if violation:
+            failed += 1
+            print("corpus %s: %s" % (name, violation))
+
+    start, total = time.perf_counter(), 0
+    for run in range(args.runs):
+        rng = random.Random("%d:%d" % (args.seed, run))
+        ops = generate(rng, args.steps, args.accounts)
+        total += len(ops)
+        violation = replay(ops, args.accounts)
+        if violation:
+            failed += 1
+            ops = minimize(ops, args.accounts, violation.prop)
+            path = save(args.corpus, args.accounts, violation, ops)
+            print("run %d: %s\n  %d steps saved to %s"
+                  % (run, violation, len(ops), os.path.relpath(path)))
+    seconds = time.perf_counter() - start
+    print("%d operations in %.2fs (%d/s), %d failures"
+          % (total, seconds, total / max(seconds, 1e-9), failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
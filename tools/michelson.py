@@ -0,0 +1,97 @@
+"""Michelson literals laid out the way SmartPy compiles records and variants.
+
+SmartPy sorts record fields by name and folds them into a balanced tree of
+pairs, so ``record(value=1, account_from=a, destination=b)`` becomes
+``Pair a (Pair b 1)``.  Variants follow the same rule with ``Left``/``Right``.
+"""
+import hashlib
+
+_B58 = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+_TZ1 = b"\x06\xa1\x9f"
+
+
+def nat(value):
+    return str(int(value))
+
+
+def string(value):
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+address = string
+key_hash = string
+unit = "Unit"
+
+
+def pair(left, right):
+    return "(Pair %s %s)" % (left, right)
+
+
+def _tree(items):
+    if len(items) == 1:
+        return items[0]
+    middle = len(items) // 2
+    return pair(_tree(items[:middle]), _tree(items[middle:]))
+
+
+def record(**fields):
+    return _tree([fields[name] for name in sorted(fields)])
+
+
+def variant(name, value, names):
+    """Select case ``name`` out of the variant cases ``names``."""
+    names = sorted(names)
+    if len(names) == 1:
+        return value
+    middle = len(names) // 2
+    if name in names[:middle]:
+        return "(Left %s)" % variant(name, value, names[:middle])
+    return "(Right %s)" % variant(name, value, names[middle:])
+
+
+def some(value):
+    return "(Some %s)" % value
+
+
+none = "None"
+
+
+def seq(items):
+    return "{ %s }" % "; ".join(items)
+
+
+def elt_map(items):
+    """Map or big_map literal; ``items`` must already be in key order."""
+    return seq("Elt %s %s" % (key, value) for key, value in items)
+
+
+def address_order(value):
+    """Sort key matching Michelson's order on addresses: implicit accounts
+    come before originated contracts, then base58 order within each kind."""
+    return (value.startswith("KT1"), value)
+
+
+def b58check(payload):
+    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    data = payload + checksum
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, rem = divmod(number, 58)
+        encoded = _B58[rem] + encoded
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + encoded
+
+
+def b58decode(value):
+    """Payload and checksum bytes of a base58check string."""
+    number = 0
+    for char in value:
+        number = number * 58 + _B58.index(char)
+    data = number.to_bytes((number.bit_length() + 7) // 8, "big")
+    return b"\0" * (len(value) - len(value.lstrip("1"))) + data
+
+
+def fake_address(seed):
+    """A valid, deterministic tz1 address that nobody holds the key for."""
+    digest = hashlib.blake2b(str(seed).encode(), digest_size=20).digest()
+    return b58check(_TZ1 + digest)
@@ -0,0 +1,85 @@
+"""Convert a Token ledger from the nested-allowance layout to the split one.
+
+Before, ``ledger`` mapped an address to ``{balance, allowances}``; now
+``ledger`` maps an address to its balance and ``allowances`` maps
+``(owner, spender)`` to the allowed amount.  Contracts cannot change their
+storage type, so migrating means originating the new Token with the
+converted storage printed by this script:
+
+    python -m tools.migrate_token ledger.json > storage.tz
+    tezos-client originate contract token transferring 0 from admin \\
+        running Token_compiled.tz --init "$(cat storage.tz)" --burn-cap 10
+
+``ledger.json`` is either ``{"owner": ..., "totalSupply": ..., "ledger":
+{address: {"balance": n, "allowances": {spender: n}}}}`` or the ledger keys
+as returned by an indexer, ``[{"key": address, "value": {...}}, ...]``, in
+which case ``--owner`` is required and the supply is the sum of balances.
+"""
+import argparse
+import json
+import sys
+
+from tools import michelson as m
+
+
+def load(dump, owner=None):
+    """Return ``(owner, total_supply, balances, allowances)`` of a dump."""
+    if isinstance(dump, list):
+        ledger = {entry["key"]: entry["value"] for entry in dump}
+        total_supply = None
+    else:
+        owner = dump["owner"]
+        ledger = dump["ledger"]
+        total_supply = int(dump["totalSupply"])
+    if owner is None:
+        raise ValueError("the owner is required for an indexer dump")
+
+    balances, allowances = {}, {}
+    for holder, record in ledger.items():
+        if int(record["balance"]):
+            balances[holder] = int(record["balance"])
+        for spender, value in record.get("allowances", {}).items():
+            if int(value):
+                allowances[(holder, spender)] = int(value)
+    if total_supply is None:
+        total_supply = sum(balances.values())
+    return owner, total_supply, balances, allowances
+
+
+def storage(owner, total_supply, balances, allowances):
+    """The new Token storage as a Michelson expression."""
+    ledger = [(m.address(holder), m.nat(balance))
+              for holder, balance in sorted(balances.items(),
+                                            key=lambda item: m.address_order(
+                                                item[0]))]
+    approved = [(m.pair(m.address(holder), m.address(spender)), m.nat(value))
+                for (holder, spender), value in sorted(
+                    allowances.items(),
+                    key=lambda item: (m.address_order(item[0][0]),
+                                      m.address_order(item[0][1])))]
+    # Owner allowances start from burnCut = 0 so later burns reach them.
+    owner_allowances = [(key, m.nat(0)) for key, _ in approved
+                        if key.startswith("(Pair %s " % m.address(owner))]
+    return m.record(owner=m.address(owner),
+                    totalSupply=m.nat(total_supply),
+                    ledger=m.elt_map(ledger),
+                    allowances=m.elt_map(approved),
+                    burnCut=m.nat(0),
+                    burnCuts=m.elt_map(owner_allowances),
+                    ownerSpenders=m.nat(len(owner_allowances)),
+                    operators=m.elt_map([]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("dump", help="old ledger as JSON, '-' for stdin")
+    parser.add_argument("--owner", help="Token owner for indexer dumps")
+    args = parser.parse_args(argv)
+    with (sys.stdin if args.dump == "-" else open(args.dump)) as f:
+        dump = json.load(f)
+    print(storage(*load(dump, owner=args.owner)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
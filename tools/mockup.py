@@ -0,0 +1,112 @@
+"""Drive contracts through ``tezos-client --mode mockup``.
+
+Mockup mode applies real operations against a local context, so receipts
+carry the same consumed gas and paid storage figures as a node would report.
+"""
+import collections
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+TEZOS_CLIENT = os.environ.get("TEZOS_CLIENT", "tezos-client")
+BURN_CAP = "100"
+
+Receipt = collections.namedtuple("Receipt", "gas storage_size paid_storage text")
+
+_GAS = re.compile(r"^\s*Consumed gas: ([\d.]+)", re.M)
+_STORAGE_SIZE = re.compile(r"^\s*Storage size: (\d+) bytes", re.M)
+_PAID = re.compile(r"^\s*Paid storage size diff: (\d+) bytes", re.M)
+_KT1 = re.compile(r"New contract (KT1\w+) originated")
+_ORIGINATED = re.compile(r"Originated contracts:\s+(KT1\w+)")
+_PACKED = re.compile(r"Raw packed data: (0x[0-9a-f]*)")
+_HASH = re.compile(r"^Hash: (\w+)", re.M)
+
+# Accepts any callback value so that `Get*` entry points can be measured.
+SINK = "parameter %s; storage unit; code { CDR; NIL operation; PAIR };"
+
+
+def parse_receipt(text):
+    storage = [int(size) for size in _STORAGE_SIZE.findall(text)]
+    return Receipt(gas=sum(float(gas) for gas in _GAS.findall(text)),
+                   storage_size=storage[0] if storage else 0,
+                   paid_storage=sum(int(size) for size in _PAID.findall(text)),
+                   text=text)
+
+
+class Mockup:
+    """A throw-away mockup context seeded with the bootstrap accounts."""
+
+    def __init__(self):
+        self.base_dir = tempfile.mkdtemp(prefix="quipuswap-mockup-")
+        self.client("create", "mockup")
+        self._addresses = {}
+
+    def close(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def client(self, *args):
+        result = subprocess.run(
+            [TEZOS_CLIENT, "--mode", "mockup", "--base-dir", self.base_dir]
+            + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        if result.returncode:
+            raise RuntimeError("tezos-client %s failed:\n%s"
+                               % (" ".join(args[:2]), result.stdout))
+        return result.stdout
+
+    def address(self, alias):
+        if alias not in self._addresses:
+            out = self.client("show", "address", alias)
+            self._addresses[alias] = _HASH.search(out).group(1)
+        return self._addresses[alias]
+
+    def originate(self, alias, code, storage, amount=0, sender="bootstrap1"):
+        """Originate ``code`` (a path or inline script) under ``alias``."""
+        out = self.client("originate", "contract", alias,
+                          "transferring", str(amount), "from", sender,
+                          "running", code, "--init", storage,
+                          "--burn-cap", BURN_CAP, "--force")
+        self._addresses[alias] = _KT1.search(out).group(1)
+        return parse_receipt(out)
+
+    def sink(self, alias, param_type):
+        return self.originate(alias, SINK % param_type, "Unit")
+
+    def call(self, alias, entry_point, arg, amount=0, sender="bootstrap1"):
+        out = self.client("transfer", str(amount), "from", sender,
+                          "to", alias, "--entrypoint", entry_point,
+                          "--arg", arg, "--burn-cap", BURN_CAP)
+        return parse_receipt(out)
+
+    def remember(self, alias, receipt):
+        """Name ``alias`` the contract that the operation of ``receipt``
+        originated, e.g. a Dex launched by the Factory."""
+        address = _ORIGINATED.search(receipt.text).group(1)
+        self.client("remember", "contract", alias, address, "--force")
+        self._addresses[alias] = address
+
+    def pack(self, data, type_):
+        """``PACK`` of the Michelson ``data`` of ``type_``, as bytes."""
+        out = self.client("hash", "data", data, "of", "type", type_)
+        return _PACKED.search(out).group(1)
+
+    def storage(self, alias):
+        return self.client("get", "contract", "storage", "for", alias).strip()
+
+
+def binary_size(kind, expression):
+    """Size in bytes of a Michelson ``script`` or ``data`` once serialized."""
+    out = subprocess.run([TEZOS_CLIENT, "convert", kind,
+                          expression, "from", "michelson", "to", "binary"],
+                         stdout=subprocess.PIPE, universal_newlines=True,
+                         check=True).stdout.strip()
+    return (len(out) - 2) // 2 if out.startswith("0x") else len(out) // 2
@@ -0,0 +1,189 @@
+"""Best-output routes over the exchanges registered in a Factory.
+
+The graph has one node per asset, tez and every token, and one edge per Dex
+in each direction.  A trade is either a direct swap against one Dex (tez to
+token, token to tez) or ``TokenToTokenSwap``: token to tez on an exchange of
+the input token, then tez to token on an exchange of the output token.  Both
+legs are quoted with ``tools.amm``, so routes are exact to the mutez.
+
+Quotes are cached per pool until the pool changes, and ``quote_many`` prices
+a whole array of trade sizes against every candidate exchange at once:
+
+    python -m tools.router --factory KT1... tez KT1...token 1000000
+"""
+import argparse
+import collections
+import sys
+
+from tools import amm
+
+TEZ = "tez"
+
+Route = collections.namedtuple("Route", "path out")
+
+_CACHE_LIMIT = 4096
+
+
+def pool_from_storage(storage):
+    """The ``amm.Pool`` of a decoded Dex storage."""
+    pool = storage["pool"]
+    return amm.Pool(tez_pool=pool["tezPool"],
+                    token_pool=pool["tokenPool"],
+                    total_shares=storage["totalShares"],
+                    fee_rate=pool["feeRate"])
+
+
+class Router:
+    def __init__(self):
+        self.pools = {}
+        self.token_of = {}
+        # asset -> [(exchange, asset_out)]
+        self.adjacency = collections.defaultdict(list)
+        # exchange -> {(sells_tez, amount): out}, dropped on update_pool
+        self._quotes = {}
+        # token -> stacked pool fields of its exchanges, for quote_many
+        self._books = {}
+
+    def add_exchange(self, token, exchange, pool):
+        if exchange in self.pools:
+            raise ValueError("exchange %s already added" % exchange)
+        self.pools[exchange] = pool
+        self.token_of[exchange] = token
+        self.adjacency[TEZ].append((exchange, token))
+        self.adjacency[token].append((exchange, TEZ))
+        self._quotes[exchange] = {}
+        self._books.pop(token, None)
+
+    def update_pool(self, exchange, **fields):
+        """Apply new pool fields, e.g. after a swap seen on chain."""
+        self.pools[exchange] = self.pools[exchange]._replace(**fields)
+        self._quotes[exchange] = {}
+        self._books.pop(self.token_of[exchange], None)
+
+    def exchanges(self, token):
+        return [exchange for exchange, _ in self.adjacency.get(token, [])]
+
+    def swap(self, exchange, sells_tez, amount):
+        """Output of one leg, 0 where the Dex would fail."""
+        quotes = self._quotes[exchange]
+        key = (sells_tez, amount)
+        if key not in quotes:
+            if len(quotes) >= _CACHE_LIMIT:
+                quotes.clear()
+            pool = self.pools[exchange]
+            swap, _ = (amm.tez_to_token if sells_tez
+                       else amm.token_to_tez)(pool, amount)
+            quotes[key] = swap.out if swap.ok else 0
+        return quotes[key]
+
+    def _best(self, exchanges, sells_tez, amount):
+        best = Route(path=(), out=0)
+        for exchange in exchanges:
+            out = self.swap(exchange, sells_tez, amount)
+            if out > best.out:
+                best = Route(path=(exchange,), out=out)
+        return best
+
+    def quote(self, asset_in, asset_out, amount):
+        """The best ``Route`` for selling ``amount`` of ``asset_in``.
+
+        Outputs grow with inputs, so the best two-leg route takes the best
+        first leg and then the best second leg for its tez: each side is
+        scanned once instead of every pair of exchanges.
+        """
+        if asset_in == asset_out:
+            raise ValueError("nothing to route from %s to itself" % asset_in)
+        if asset_in == TEZ:
+            return self._best(self.exchanges(asset_out), True, amount)
+        first = self._best(self.exchanges(asset_in), False, amount)
+        if asset_out == TEZ or not first.out:
+            return first
+        second = self._best(self.exchanges(asset_out), True, first.out)
+        if not second.out:
+            return second
+        return Route(path=first.path + second.path, out=second.out)
+
+    def _book(self, token):
+        if token not in self._books:
+            exchanges = self.exchanges(token)
+            pools = [self.pools[exchange] for exchange in exchanges]
+            self._books[token] = (exchanges, [
+                [[getattr(pool, field)] for pool in pools]
+                for field in amm.Pool._fields])
+        return self._books[token]
+
+    def _best_many(self, token, sells_tez, amounts):
+        exchanges, columns = self._book(token)
+        if not exchanges:
+            return [None] * len(amounts), amm.np.zeros(len(amounts), int)
+        *fields, amounts = amm.vectorize(*columns, [amounts])
+        pool = amm.Pool(*fields)
+        swap, _ = (amm.tez_to_token if sells_tez
+                   else amm.token_to_tez)(pool, amounts)
+        outs = amm.np.where(swap.ok, swap.out, 0)
+        best = outs.argmax(axis=0)
+        out = outs[best, amm.np.arange(outs.shape[1])]
+        return [exchanges[i] if o else None for i, o in zip(best, out)], out
+
+    def quote_many(self, asset_in, asset_out, amounts):
+        """``quote`` for every trade size in ``amounts``, in one pass.
+
+        Returns ``(paths, outs)``; a path is None where no route pays out.
+        """
+        if amm.np is None:
+            raise RuntimeError("quote_many needs NumPy")
+        if asset_in == asset_out:
+            raise ValueError("nothing to route from %s to itself" % asset_in)
+        amounts = list(amounts)
+        if asset_in == TEZ:
+            firsts, outs = self._best_many(asset_out, True, amounts)
+            return [(e,) if e else None for e in firsts], outs
+        firsts, outs = self._best_many(asset_in, False, amounts)
+        if asset_out == TEZ:
+            return [(e,) if e else None for e in firsts], outs
+        seconds, outs = self._best_many(asset_out, True, list(outs))
+        paths = [(a, b) if a and b else None
+                 for a, b in zip(firsts, seconds)]
+        return paths, outs
+
+
+def load(rpc, factory, router=None):
+    """A ``Router`` over every exchange registered in ``factory``."""
+    router = router or Router()
+    storage = rpc.storage(factory)
+    for index in range(storage["tokenCount"]):
+        token = rpc.big_map_get(storage["tokenList"], index)
+        exchange = rpc.big_map_get(storage["tokenToExchange"], token)
+        router.add_exchange(token, exchange,
+                            pool_from_storage(rpc.storage(exchange)))
+    return router
+
+
+def refresh(rpc, router, exchange):
+    """Re-read the pool of ``exchange`` from the node."""
+    pool = pool_from_storage(rpc.storage(exchange))
+    router.update_pool(exchange, **pool._asdict())
+
+
+def main(argv=None):
+    from tools.rpc import Rpc
+
+    parser = argparse.ArgumentParser(description="Best Dex route for a trade")
+    parser.add_argument("--node", default="http://localhost:8732")
+    parser.add_argument("--factory", required=True)
+    parser.add_argument("asset_in", help="'tez' or a token address")
+    parser.add_argument("asset_out", help="'tez' or a token address")
+    parser.add_argument("amount", type=int, help="mutez or token units")
+    args = parser.parse_args(argv)
+
+    router = load(Rpc(args.node), args.factory)
+    route = router.quote(args.asset_in, args.asset_out, args.amount)
+    if not route.out:
+        print("no route")
+        return 1
+    print("%d via %s" % (route.out, " -> ".join(route.path)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
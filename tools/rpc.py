@@ -0,0 +1,173 @@
+"""Read contract storage and big_map entries from a Tezos node.
+
+Storage is decoded against the storage type of the contract, so records come
+back as dicts keyed by the SmartPy field names (the ``%field`` annotations),
+whatever pair layout the compiler chose.
+"""
+import collections
+import hashlib
+import json
+import urllib.error
+import urllib.request
+
+from tools.michelson import b58check, b58decode
+
+BigMap = collections.namedtuple("BigMap", "id key_type value_type")
+
+_EXPR = bytes([13, 44, 64, 27])
+_PREFIXES = {b"\x06\xa1\x9f": b"\x00\x00", b"\x06\xa1\xa1": b"\x00\x01",
+             b"\x06\xa1\xa4": b"\x00\x02"}
+
+
+def _args(node):
+    return node.get("args", [])
+
+
+def _annotation(node):
+    for annot in node.get("annots", []):
+        if annot.startswith("%"):
+            return annot[1:]
+    return None
+
+
+def _binary(node, prim):
+    """Split n-ary ``pair`` types and ``Pair`` values as right combs."""
+    args = node if isinstance(node, list) else _args(node)
+    if len(args) <= 2:
+        return args
+    return [args[0], {"prim": prim, "args": args[1:]}]
+
+
+def decode_address(raw):
+    data = bytes.fromhex(raw)
+    if data[0] == 1:
+        return b58check(b"\x02\x5a\x79" + data[1:21])
+    for prefix, tag in _PREFIXES.items():
+        if data[:2] == tag:
+            return b58check(prefix + data[2:22])
+    raise ValueError("unknown address %s" % raw)
+
+
+def decode(type_, value):
+    prim = type_["prim"]
+    if prim == "pair":
+        types = _binary(type_, "pair")
+        values = _binary(value, "Pair")
+        fields, plain = {}, []
+        for child_type, child in zip(types, values):
+            decoded = decode(child_type, child)
+            name = _annotation(child_type)
+            if name is not None:
+                fields[name] = decoded
+            elif isinstance(decoded, dict) and child_type["prim"] == "pair":
+                fields.update(decoded)
+            else:
+                plain.append(decoded)
+        return fields if fields else tuple(plain)
+    if prim == "big_map":
+        return BigMap(int(value["int"]), *_args(type_))
+    if prim in ("nat", "int", "mutez", "timestamp") and "int" in value:
+        return int(value["int"])
+    if prim in ("address", "contract") and "bytes" in value:
+        return decode_address(value["bytes"])
+    if prim in ("key_hash",) and "bytes" in value:
+        return decode_address("00" + value["bytes"])
+    if prim == "bool":
+        return value["prim"] == "True"
+    if prim == "unit":
+        return None
+    if prim == "option":
+        return None if value["prim"] == "None" else decode(
+            _args(type_)[0], _args(value)[0])
+    if prim in ("list", "set"):
+        return [decode(_args(type_)[0], item) for item in value]
+    if prim == "map":
+        key_type, value_type = _args(type_)
+        return {_hashable(decode(key_type, _args(elt)[0])):
+                decode(value_type, _args(elt)[1]) for elt in value}
+    if "string" in value:
+        return value["string"]
+    if "bytes" in value:
+        return value["bytes"]
+    if "int" in value:
+        return int(value["int"])
+    raise ValueError("cannot decode %s as %s" % (value, prim))
+
+
+def _hashable(value):
+    return tuple(value.values()) if isinstance(value, dict) else value
+
+
+def _zarith(value):
+    out = bytearray()
+    sign = 0x40 if value < 0 else 0
+    value = abs(value)
+    out.append((value & 0x3f) | sign | (0x80 if value >> 6 else 0))
+    value >>= 6
+    while value:
+        out.append((value & 0x7f) | (0x80 if value >> 7 else 0))
+        value >>= 7
+    return bytes(out)
+
+
+def _bytes(data):
+    return b"\x0a" + len(data).to_bytes(4, "big") + data
+
+
+def encode_address(address):
+    data = b58decode(address)[:-4]
+    if address.startswith("KT1"):
+        return b"\x01" + data[3:] + b"\x00"
+    return _PREFIXES[data[:3]] + data[3:]
+
+
+def encode(type_, value):
+    """Binary Micheline of ``value`` as the node expects it for packing."""
+    prim = type_["prim"]
+    if prim in ("nat", "int", "mutez"):
+        return b"\x00" + _zarith(value)
+    if prim == "address":
+        return _bytes(encode_address(value))
+    if prim == "key_hash":
+        return _bytes(encode_address(value)[1:])
+    if prim == "string":
+        data = value.encode()
+        return b"\x01" + len(data).to_bytes(4, "big") + data
+    if prim == "pair":
+        left, right = _binary(type_, "pair")
+        return b"\x07\x07" + encode(left, value[0]) + encode(right, value[1])
+    raise ValueError("cannot pack %s" % prim)
+
+
+def script_expr_hash(type_, value):
+    digest = hashlib.blake2b(b"\x05" + encode(type_, value),
+                             digest_size=32).digest()
+    return b58check(_EXPR + digest)
+
+
+class Rpc:
+    def __init__(self, node="http://localhost:8732", block="head"):
+        self.node = node.rstrip("/")
+        self.block = block
+
+    def get(self, path):
+        url = "%s/chains/main/blocks/%s/%s" % (self.node, self.block, path)
+        with urllib.request.urlopen(url) as response:
+            return json.load(response)
+
+    def storage(self, address):
+        """Decoded storage of ``address``."""
+        script = self.get("context/contracts/%s/script" % address)
+        storage_type = next(section for section in script["code"]
+                            if section["prim"] == "storage")
+        return decode(_args(storage_type)[0], script["storage"])
+
+    def big_map_get(self, big_map, key, default=None):
+        path = "context/big_maps/%d/%s" % (
+            big_map.id, script_expr_hash(big_map.key_type, key))
+        try:
+            return decode(big_map.value_type, self.get(path))
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                return default
+            raise
@@ -0,0 +1,131 @@
+"""Run every ``@sp.add_test`` scenario in parallel and report per scenario.
+
+Each scenario runs in its own SmartPy process, from a copy of its script in
+which the other scenarios are left unregistered, so a failing or slow
+scenario never hides the others:
+
+    python -m tools.run_scenarios                  # contracts/*.py
+    python -m tools.run_scenarios -j 4 contracts/Dex.py
+    python -m tools.run_scenarios --only Conformance generated/*.py
+
+Passing scenarios are cached by ``tools.build`` and are not run again until
+their script changes.
+"""
+import argparse
+import ast
+import collections
+import concurrent.futures
+import glob
+import os
+import re
+import sys
+import tempfile
+import time
+
+from tools import build
+from tools.smartpy import CONTRACTS
+
+Scenario = collections.namedtuple("Scenario", "script name lines")
+Result = collections.namedtuple("Result", "scenario ok seconds output")
+
+
+def _parse(source, script):
+    # sp.if and friends are not Python syntax, but they never change the
+    # line numbers the decorators are found at.
+    return ast.parse(re.sub(r"\bsp\.(if|else|for|while)\b", r"\1", source),
+                     script)
+
+
+def _is_add_test(decorator):
+    func = decorator.func if isinstance(decorator, ast.Call) else decorator
+    return (isinstance(func, ast.Attribute) and func.attr == "add_test" and
+            isinstance(func.value, ast.Name) and func.value.id == "sp")
+
+
+def _name(decorator, default):
+    for keyword in getattr(decorator, "keywords", []):
+        if keyword.arg == "name" and isinstance(keyword.value, ast.Constant):
+            return keyword.value.value
+    return default
+
+
+def discover(script):
+    """The scenarios of ``script`` in source order."""
+    with open(script) as f:
+        tree = _parse(f.read(), script)
+    scenarios = []
+    for node in ast.walk(tree):
+        for decorator in getattr(node, "decorator_list", []):
+            if _is_add_test(decorator):
+                scenarios.append(Scenario(
+                    script=script,
+                    name=_name(decorator, node.name),
+                    lines=(decorator.lineno, decorator.end_lineno)))
+    return sorted(scenarios, key=lambda scenario: scenario.lines)
+
+
+def isolate(scenario, others):
+    """Source of ``scenario.script`` with only ``scenario`` registered."""
+    with open(scenario.script) as f:
+        lines = f.read().split("\n")
+    for other in others:
+        if other != scenario:
+            first, last = other.lines
+            for number in range(first - 1, last):
+                lines[number] = "# " + lines[number]
+    return "\n".join(lines)
+
+
+def run(scenario, source):
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="quipuswap-scenario-") as tmp:
+        script = os.path.join(tmp, os.path.basename(scenario.script))
+        with open(script, "w") as f:
+            f.write(source)
+        returncode, output = build.test(script)
+    return Result(scenario=scenario, ok=returncode == 0,
+                  seconds=time.perf_counter() - start, output=output)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scripts", nargs="*",
+                        default=sorted(glob.glob(os.path.join(CONTRACTS,
+                                                              "*.py"))))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="scenarios run at once (default: CPU count)")
+    parser.add_argument("--only", default="",
+                        help="regular expression selecting scenario names")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the output of passing scenarios too")
+    args = parser.parse_args(argv)
+
+    only = re.compile(args.only)
+    jobs = []
+    for script in args.scripts:
+        scenarios = discover(script)
+        jobs.extend((scenario, isolate(scenario, scenarios))
+                    for scenario in scenarios if only.search(scenario.name))
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = [pool.submit(run, *job) for job in jobs]
+        results = [future.result() for future in futures]
+    wall = time.perf_counter() - start
+
+    for result in results:
+        label = "%s::%s" % (os.path.relpath(result.scenario.script),
+                            result.scenario.name)
+        print("%-60s %-4s %7.2fs" % (label, "ok" if result.ok else "FAIL",
+                                     result.seconds))
+        if args.verbose or not result.ok:
+            print(result.output)
+    failed = sum(not result.ok for result in results)
+    print("%d scenarios, %d failed, %.2fs total, %.2fs wall"
+          % (len(results), failed,
+             sum(result.seconds for result in results), wall))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""Thin wrapper around the SmartPy command line."""
+import collections
+import glob
+import os
+import re
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTRACTS = os.path.join(ROOT, "contracts")
+SMARTPY = os.environ.get("SMARTPY",
+                         os.path.expanduser("~/SmartPyBasic/SmartPy.sh"))
+
+Compiled = collections.namedtuple("Compiled", "code storage")
+
+
+def _single(out_dir, pattern):
+    found = glob.glob(os.path.join(out_dir, pattern))
+    if len(found) != 1:
+        raise RuntimeError("expected one %s in %s, found %r"
+                           % (pattern, out_dir, found))
+    return found[0]
+
+
+def contract_source(name):
+    """The ``class <name>`` block of ``contracts/<name>.py``, tests excluded."""
+    with open(os.path.join(CONTRACTS, name + ".py")) as f:
+        source = f.read()
+    body = source[source.index("class %s(" % name):]
+    tests = re.search(r"^(# Tests\n)?    @sp\.add_test", body, re.M)
+    return body[:tests.start() if tests else len(body)].rstrip() + "\n"
+
+
+def file_imports(source):
+    """Paths of the ``file:`` scripts ``source`` imports, from ``ROOT``."""
+    return re.findall(r'"file:([^"]+)"', source)
+
+
+def imports(name):
+    """The module lines above ``class <name>`` in ``contracts/<name>.py``,
+    and the scripts they import."""
+    with open(os.path.join(CONTRACTS, name + ".py")) as f:
+        source = f.read()
+    header = source[:source.index("class %s(" % name)]
+    return header, file_imports(header)
+
+
+def compile_contract(script, class_call, out_dir):
+    """Compile ``class_call`` from ``contracts/<script>`` into ``out_dir``."""
+    os.makedirs(out_dir, exist_ok=True)
+    subprocess.run([SMARTPY, "compile", os.path.join(CONTRACTS, script),
+                    class_call, out_dir],
+                   cwd=ROOT, check=True,
+                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return outputs(out_dir)
+
+
+def outputs(out_dir):
+    """The ``Compiled`` files a compilation left in ``out_dir``."""
+    return Compiled(code=_single(out_dir, "*_compiled.tz"),
+                    storage=_single(out_dir, "*_storage_init.tz"))
+
+
+def test_script(script, out_dir):
+    """Run every ``@sp.add_test`` scenario of ``script``."""
+    os.makedirs(out_dir, exist_ok=True)
+    return subprocess.run([SMARTPY, "test", script, out_dir],
+                          cwd=ROOT, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, universal_newlines=True)
@@ -0,0 +1,164 @@
+"""Break down the storage each operation allocates by big_map and key.
+
+Runs the benchmark cases (``tools.bench``) in a mockup context and reads the
+big_map diffs from every receipt.  Each diff is attributed to its storage
+field (``Token.ledger``, ``Dex.shares``, ``Factory.tokenList``...) and sized
+the way the protocol charges it: a new key costs the key, the value and a
+fixed overhead, an update costs the growth of the value.  Bytes paid outside
+big_maps are reported as ``(storage)``.
+
+    python -m tools.storage_profile                      # every case
+    python -m tools.storage_profile --only 'Dex\\.Invest' --keys
+    python -m tools.storage_profile --users 100000       # projected burn
+
+The projection assumes each of N users performs the measured operation once.
+"""
+import argparse
+import collections
+import json
+import re
+import subprocess
+import sys
+
+from tools import bench
+from tools.mockup import TEZOS_CLIENT, Mockup, binary_size
+
+# mutez burnt per byte of storage
+BYTE_COST = 250
+# bytes a new big_map key costs on top of its key and value
+KEY_OVERHEAD = 65
+
+_NEW = re.compile(r"New map\((\d+)\) of type")
+_DIFF = re.compile(r"^\s*(Set|Unset) map\((\d+)\)\[(.*?)\](?: to (.*?))?\s*$",
+                   re.M)
+
+Entry = collections.namedtuple("Entry", "field key bytes")
+Operation = collections.namedtuple("Operation",
+                                   "alias entry_point paid entries")
+
+
+def big_map_fields(code):
+    """Names of the big_map fields of ``code`` in allocation order."""
+    out = subprocess.run([TEZOS_CLIENT, "convert", "script", code,
+                          "from", "michelson", "to", "json"],
+                         stdout=subprocess.PIPE, universal_newlines=True,
+                         check=True).stdout
+    storage = next(section for section in json.loads(out)
+                   if section["prim"] == "storage")
+    fields = []
+
+    def walk(node):
+        if node["prim"] == "big_map":
+            fields.append(next(annot[1:] for annot in node.get("annots", [])
+                               if annot.startswith("%")))
+        elif node["prim"] == "pair":
+            for child in node["args"]:
+                walk(child)
+    walk(storage["args"][0])
+    return fields
+
+
+class ProfilingMockup(Mockup):
+    """A ``Mockup`` that attributes every big_map diff to its field."""
+
+    def __init__(self, compiled):
+        super().__init__()
+        self.contracts = {code: (name, big_map_fields(code))
+                          for name, (code, _) in compiled.items()}
+        self.fields = {}
+        self.stored = {}
+        self.operations = []
+        self._sizes = {}
+
+    def _size(self, expression):
+        if expression not in self._sizes:
+            self._sizes[expression] = binary_size("data", expression)
+        return self._sizes[expression]
+
+    def _record(self, alias, entry_point, receipt):
+        entries = []
+        for action, big_map, key, value in _DIFF.findall(receipt.text):
+            field = self.fields.get(int(big_map), "map(%s)" % big_map)
+            old = self.stored.pop((big_map, key), None)
+            if action == "Set":
+                new = self._size(value)
+                self.stored[(big_map, key)] = new
+                size = (new - old if old is not None
+                        else KEY_OVERHEAD + self._size(key) + new)
+            else:
+                size = -(KEY_OVERHEAD + self._size(key) + old) if old else 0
+            entries.append(Entry(field=field, key=key, bytes=size))
+        grown = sum(entry.bytes for entry in entries if entry.bytes > 0)
+        if receipt.paid_storage > grown:
+            entries.append(Entry(field="(storage)", key="",
+                                 bytes=receipt.paid_storage - grown))
+        self.operations.append(Operation(alias=alias,
+                                         entry_point=entry_point,
+                                         paid=receipt.paid_storage,
+                                         entries=entries))
+
+    def originate(self, alias, code, storage, amount=0, sender="bootstrap1"):
+        receipt = super().originate(alias, code, storage, amount, sender)
+        if code in self.contracts:
+            name, fields = self.contracts[code]
+            ids = sorted(int(i) for i in _NEW.findall(receipt.text))
+            for big_map, field in zip(ids, fields):
+                self.fields[big_map] = "%s.%s" % (name, field)
+        self._record(alias, "(origination)", receipt)
+        return receipt
+
+    def call(self, alias, entry_point, arg, amount=0, sender="bootstrap1"):
+        receipt = super().call(alias, entry_point, arg, amount, sender)
+        self._record(alias, entry_point, receipt)
+        return receipt
+
+
+def profile_case(compiled, case):
+    """The ``Operation`` measured by ``case``."""
+    with ProfilingMockup(compiled) as mockup:
+        env = bench.Env(compiled, mockup)
+        case.setup(env)
+        case.measure(env)
+        return mockup.operations[-1]
+
+
+def by_field(entries):
+    fields = collections.OrderedDict()
+    for entry in entries:
+        keys, size = fields.get(entry.field, (0, 0))
+        fields[entry.field] = (keys + (entry.key != ""), size + entry.bytes)
+    return fields
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", default="",
+                        help="regular expression selecting case names")
+    parser.add_argument("--users", type=int, default=10000,
+                        help="users to project the storage burn at")
+    parser.add_argument("--keys", action="store_true",
+                        help="also list every key written")
+    args = parser.parse_args(argv)
+
+    compiled = bench.compile_all()
+    only = re.compile(args.only)
+    for case in bench.all_cases():
+        if not only.search(case.name):
+            continue
+        operation = profile_case(compiled, case)
+        print("%s: paid %d bytes" % (case.name, operation.paid))
+        for field, (keys, size) in by_field(operation.entries).items():
+            projected = max(size, 0) * args.users
+            print("    %-24s %4d keys %+7d bytes   x%d users: %d bytes, "
+                  "%s tez" % (field, keys, size, args.users, projected,
+                              bench.tez(projected * BYTE_COST)))
+        if args.keys:
+            for entry in operation.entries:
+                if entry.key:
+                    print("        %-24s %+5d %s"
+                          % (entry.field, entry.bytes, entry.key))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Off-chain answers of the Dex and Token read-only entry points.
+
+These are Python helpers run against a node, not TZIP-16 off-chain views:
+the contracts publish no metadata, so wallets and indexers do not discover
+them.  ``GetReserves``, ``GetTezToTokenQuote`` and ``GetTokenToTezQuote``
+answer contracts through a callback; here the same answers are computed
+from the pool fields read over RPC and priced with ``tools.amm``, and
+balances are read from the Token ledger like ``GetBalances``:
+
+    python -m tools.views KT1... reserves
+    python -m tools.views KT1... tez-to-token 1000000
+    python -m tools.views KT1... token-to-tez 500
+    python -m tools.views KT1token... balances tz1... tz1...
+"""
+import argparse
+import json
+import sys
+
+from tools import amm
+from tools.router import pool_from_storage
+
+
+def reserves(storage):
+    """What ``GetReserves`` sends: the pool, shares and fee rate."""
+    pool = pool_from_storage(storage)
+    return {"tezPool": pool.tez_pool, "tokenPool": pool.token_pool,
+            "totalShares": pool.total_shares, "feeRate": pool.fee_rate}
+
+
+def tez_to_token_quote(storage, tez_in):
+    """What ``GetTezToTokenQuote`` sends, None where it would fail."""
+    swap, _ = amm.tez_to_token(pool_from_storage(storage), tez_in)
+    return swap.out if swap.ok else None
+
+
+def token_to_tez_quote(storage, tokens_in):
+    """What ``GetTokenToTezQuote`` sends, None where it would fail."""
+    swap, _ = amm.token_to_tez(pool_from_storage(storage), tokens_in)
+    return swap.out if swap.ok else None
+
+
+def balances(rpc, storage, accounts):
+    """What Token ``GetBalances`` sends: the balance of every account."""
+    return {account: rpc.big_map_get(storage["ledger"], account, 0)
+            for account in accounts}
+
+
+VIEWS = {"reserves": reserves,
+         "tez-to-token": tez_to_token_quote,
+         "token-to-tez": token_to_tez_quote,
+         "balances": balances}
+
+
+def main(argv=None):
+    from tools.rpc import Rpc
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--node", default="http://localhost:8732")
+    parser.add_argument("contract", help="the Dex, or the Token for balances")
+    parser.add_argument("view", choices=sorted(VIEWS))
+    parser.add_argument("args", nargs="*",
+                        help="mutez or tokens sold for quotes, "
+                             "addresses for balances")
+    args = parser.parse_args(argv)
+
+    rpc = Rpc(args.node)
+    storage = rpc.storage(args.contract)
+    if args.view == "reserves":
+        result = reserves(storage)
+    elif args.view == "balances":
+        result = balances(rpc, storage, args.args)
+    elif len(args.args) != 1:
+        parser.error("the %s quote needs one amount" % args.view)
+    else:
+        result = VIEWS[args.view](storage, int(args.args[0]))
+    print(json.dumps(result))
+    return 0 if result is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())